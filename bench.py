@@ -0,0 +1,358 @@
+# Mikro-benchmarklar. Ishga tushirish: python bench.py [nom ...]
+# Haqiqiy jewelry_bot.db ga tegmaydi va Telegram'ga so'rov yubormaydi.
+import collections
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+
+from telegram import CallbackQuery, Update, User  # noqa: E402
+from telegram.ext import CallbackQueryHandler  # noqa: E402
+
+import bot  # noqa: E402
+import storage  # noqa: E402
+import tracing  # noqa: E402
+
+# Router'dan oldingi holat: main() dagi CallbackQueryHandler'lar ketma-ketligi
+LEGACY_CALLBACK_PATTERNS = [
+    "^view_categories$", "^category_", "^next_product$", "^prev_product$", "^buy_", "^main_menu$",
+    "^admin_panel$", "^admin_manage_categories$", "^admin_delete_cat_confirm_", "^admin_delete_cat_execute_",
+    "^admin_manage_products_list$", "^admin_view_prod_", "^admin_delete_prod_confirm_",
+    "^admin_delete_prod_execute_", "^admin_view_orders$", "^admin_broadcast_stop_", "^admin_analytics_",
+    "^admin_noop$",
+]
+# Odatiy trafik: ko'p qismi mijozlarning ko'rib chiqishi. (eski satr, amal, argumentlar)
+SAMPLE_CALLBACKS = [
+    ("next_product", "next_product", (3, 1048577, 4)), ("next_product", "next_product", (3, 1048577, 5)),
+    ("prev_product", "prev_product", (3, 1048577, 6)), ("category_3", "category", (3,)),
+    ("buy_17", "buy", (17,)), ("view_categories", "view_categories", ()), ("main_menu", "main_menu", ()),
+    ("admin_view_prod_42", "admin_view_prod", (42,)), ("admin_delete_prod_execute_42", "admin_delete_prod_execute", (42,)),
+    ("admin_noop", "admin_noop", ()),
+]
+
+
+def make_callback_update(data, update_id=1, user_id=1):
+    user = User(id=user_id, first_name="Bench", is_bot=False)
+    query = CallbackQuery(id=str(update_id), from_user=user, chat_instance="bench", data=data)
+    return Update(update_id=update_id, callback_query=query)
+
+
+def timed(func, iterations):
+    started = time.perf_counter()
+    func(iterations)
+    return (time.perf_counter() - started) / iterations * 1e9
+
+
+def bench_callback_dispatch(iterations=200_000):
+    legacy_updates = [make_callback_update(legacy, i) for i, (legacy, _, _) in enumerate(SAMPLE_CALLBACKS)]
+    updates = [make_callback_update(bot.pack_callback(action, *args), i)
+               for i, (_, action, args) in enumerate(SAMPLE_CALLBACKS)]
+
+    async def noop(update, context):
+        return None
+
+    legacy_handlers = [CallbackQueryHandler(noop, pattern=pattern) for pattern in LEGACY_CALLBACK_PATTERNS]
+    router = bot.build_callback_router()
+
+    def run_legacy(n):
+        for i in range(n):
+            update = legacy_updates[i % len(legacy_updates)]
+            for handler in legacy_handlers:
+                if handler.check_update(update):
+                    break
+
+    def run_router(n):
+        for i in range(n):
+            router.check_update(updates[i % len(updates)])
+
+    legacy_ns = timed(run_legacy, iterations)
+    router_ns = timed(run_router, iterations)
+    print(f"callback_dispatch: regex zanjiri {legacy_ns:,.0f} ns/update, "
+          f"router {router_ns:,.0f} ns/update ({legacy_ns / router_ns:.1f}x)")
+
+
+def bench_callback_decode(iterations=500_000):
+    legacy_data = [legacy for legacy, _, _ in SAMPLE_CALLBACKS if legacy[-1].isdigit()]
+    packed_data = [bot.pack_callback(action, *args) for legacy, action, args in SAMPLE_CALLBACKS
+                   if legacy[-1].isdigit()]
+    decode_uncached = bot.unpack_callback.__wrapped__
+
+    def run_split(n):
+        for i in range(n):
+            int(legacy_data[i % len(legacy_data)].split("_")[-1])
+
+    def run_codec(n):
+        for i in range(n):
+            bot.unpack_callback(packed_data[i % len(packed_data)])[1][0]
+
+    def run_codec_uncached(n):
+        for i in range(n):
+            decode_uncached(packed_data[i % len(packed_data)])[1][0]
+
+    split_ns = timed(run_split, iterations)
+    codec_ns = timed(run_codec, iterations)
+    uncached_ns = timed(run_codec_uncached, iterations)
+    print(f"callback_decode: split {split_ns:,.0f} ns, kodek (kesh) {codec_ns:,.0f} ns, "
+          f"kodek (keshsiz) {uncached_ns:,.0f} ns; o'rtacha uzunlik: "
+          f"{sum(map(len, legacy_data)) / len(legacy_data):.0f} -> {sum(map(len, packed_data)) / len(packed_data):.0f} bayt")
+
+
+def bench_storage_backends(iterations=20_000, categories=10, products_per_category=50):
+    # Handler'lar bajaradigan odatiy so'rovlar aralashmasi: ko'rish ko'p, buyurtma kam
+    temp_dir = tempfile.mkdtemp(prefix="bench-storage-")
+    try:
+        bot.DB_NAME = os.path.join(temp_dir, "bench.db")
+        bot.setup_database()
+        results = {}
+        for backend in ("sqlite", "memory"):
+            repos = storage.open_repositories(backend, bot.DB_NAME, on_order_created=bot.record_order_in_rollups)
+            category_ids = [repos.categories.add(f"{backend}-kategoriya-{i}") for i in range(categories)]
+            product_ids = [repos.products.add(category_id, f"Mahsulot {j}", "Tavsif", 100_000 + j, None)
+                           for category_id in category_ids for j in range(products_per_category)]
+
+            def run(n):
+                for i in range(n):
+                    repos.users.save(i % 500, "Bench", None, f"{backend}_{i % 500}")
+                    repos.products.list_by_category(category_ids[i % categories])
+                    product_id = product_ids[i % len(product_ids)]
+                    repos.products.get_name(product_id)
+                    if i % 20 == 0:
+                        repos.orders.create(i % 500, None, product_id, "Mahsulot", 100_000, "+998901234567")
+
+            results[backend] = timed(run, iterations) / 1000
+        print(f"storage_backends: sqlite {results['sqlite']:,.1f} us/so'rov, xotira {results['memory']:,.1f} us/so'rov "
+              f"({results['sqlite'] / results['memory']:.1f}x)")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_stock_oversell(workers=32, attempts_per_worker=200, products=10, stock_per_product=25):
+    # Ko'p oqimli stress test: har bir oqim o'z SQLite ulanishi bilan bron qo'yadi va buyurtma beradi,
+    # ba'zilari bronsiz to'g'ridan-to'g'ri buyurtma beradi. Sotilganlar boshlang'ich zaxiradan oshmasligi kerak.
+    temp_dir = tempfile.mkdtemp(prefix="bench-stock-")
+    try:
+        bot.DB_NAME = os.path.join(temp_dir, "bench.db")
+        bot.setup_database()
+        for backend in ("sqlite", "memory"):
+            shared = storage.open_repositories(backend, bot.DB_NAME)
+            category_id = shared.categories.add(f"{backend}-stock")
+            product_ids = [shared.products.add(category_id, f"Noyob buyum {i}", None, 100_000, None)
+                           for i in range(products)]
+            for product_id in product_ids:
+                shared.products.update(product_id, stock=stock_per_product)
+            sold = {product_id: 0 for product_id in product_ids}
+            sold_lock = threading.Lock()
+            start = threading.Barrier(workers)
+
+            def worker(worker_id):
+                repos = storage.open_repositories(backend, bot.DB_NAME) if backend == "sqlite" else shared
+                start.wait()
+                for i in range(attempts_per_worker):
+                    product_id = product_ids[(worker_id + i) % products]
+                    try:
+                        reservation_id = None
+                        if i % 4:
+                            reservation_id = repos.products.reserve(product_id, worker_id, 60)
+                            if i % 10 == 1:
+                                repos.products.release_reservation(reservation_id)
+                                continue
+                        repos.orders.create(worker_id, None, product_id, "Noyob buyum", 100_000, "+998901234567",
+                                            reservation_id=reservation_id)
+                    except storage.OutOfStockError:
+                        continue
+                    with sold_lock:
+                        sold[product_id] += 1
+
+            threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            remaining = {product_id: shared.products.get(product_id)[6] for product_id in product_ids}
+            oversold = sum(max(0, count - stock_per_product) for count in sold.values())
+            lost = sum(stock_per_product - sold[product_id] - remaining[product_id] for product_id in product_ids)
+            print(f"stock_oversell[{backend}]: {workers * attempts_per_worker} urinish, {sum(sold.values())} sotildi "
+                  f"({products}x{stock_per_product} dona), ortiqcha sotuv {oversold}, yo'qolgan dona {lost}, "
+                  f"{workers * attempts_per_worker / elapsed:,.0f} urinish/s")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_flood_buckets(iterations=500_000, users=100_000):
+    buckets = bot.UserTokenBuckets(bot.FLOOD_RATE_PER_SECOND, bot.FLOOD_BURST, bot.FLOOD_MAX_TRACKED_USERS)
+    clock = [0.0]
+
+    def run(n):
+        # Har qadamda soat 1 ms oldinga: eski foydalanuvchilar chelagi muddati tugab o'chiriladi
+        for i in range(n):
+            clock[0] += 0.001
+            buckets.allow(i % users, clock[0])
+
+    allow_ns = timed(run, iterations)
+    flooder = bot.UserTokenBuckets(bot.FLOOD_RATE_PER_SECOND, bot.FLOOD_BURST, bot.FLOOD_MAX_TRACKED_USERS)
+    # Bitta foydalanuvchi 10 soniya davomida soniyasiga 100 ta update yuboradi
+    passed = sum(flooder.allow(1, i / 100) for i in range(1000))
+    print(f"flood_buckets: {allow_ns:,.0f} ns/update, kuzatilayotgan foydalanuvchilar {len(buckets):,} "
+          f"(jami {users:,}); 1000 ta update'dan {passed} tasi o'tkazildi")
+
+
+def bench_session_sweep(users=100_000, active_share=0.1):
+    # Application o'rniga: PTB kabi defaultdict ustidagi faqat o'qiladigan ko'rinish va drop_user_data
+    user_data = collections.defaultdict(dict)
+    application = types.SimpleNamespace(user_data=types.MappingProxyType(user_data),
+                                        drop_user_data=lambda user_id: user_data.pop(user_id, None))
+    sessions = bot.SessionManager(bot.SESSION_IDLE_TTL, bot.SESSION_MEMORY_BUDGET, bot.SESSION_KEEP_KEYS)
+    active_since = users * (1 - active_share)
+    for user_id in range(users):
+        session = user_data[user_id]
+        session.update(current_category_id=user_id % 10, current_product_index=user_id % 7,
+                       products_token=user_id, product_to_buy_id=user_id % 50)
+        if user_id % 5 == 0:
+            session["cart"] = {user_id % 50: 1, user_id % 30: 2}
+        sessions.touch(user_id, 0.0 if user_id < active_since else bot.SESSION_IDLE_TTL)
+    bytes_before = sum(bot.estimate_size(session) for session in user_data.values())
+    started = time.perf_counter()
+    compacted, evicted, bytes_after = sessions.sweep(application, now=bot.SESSION_IDLE_TTL + 1)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    print(f"session_sweep: {users:,} sessiya, {compacted:,} ixchamlashtirildi, {evicted:,} o'chirildi, "
+          f"~{bytes_before / 1024 / 1024:.1f} MB -> ~{bytes_after / 1024 / 1024:.1f} MB, {elapsed_ms:,.0f} ms")
+
+
+def bench_logging_overhead(iterations=20_000):
+    # Bitta process_contact'dagi kabi yozuvlar: 6 ta INFO va 2 ta DEBUG (DEBUG o'chiq), har update uchun
+    devnull = open(os.devnull, "w")
+    items = [(17, "Oltin uzuk", 1_250_000.0, 1), (23, "Kumush zanjir", 480_000.0, 2)]
+
+    legacy = logging.getLogger("bench.legacy")
+    legacy_handler = logging.StreamHandler(devnull)
+    legacy_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    legacy.addHandler(legacy_handler)
+
+    log_queue = queue.SimpleQueue()
+    queued_handler = logging.StreamHandler(devnull)
+    queued_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, queued_handler)
+    queued = logging.getLogger("bench.queued")
+    queued.addHandler(bot.LogQueueHandler(log_queue))
+    sampled = logging.getLogger("bench.sampled")
+    sampled.addHandler(bot.LogQueueHandler(log_queue))
+    sampled.addFilter(bot.RateSampleFilter(bot.LOG_SAMPLE_RATE_PER_SECOND, bot.LOG_SAMPLE_BURST))
+    for bench_logger in (legacy, queued, sampled):
+        bench_logger.propagate = False
+        bench_logger.setLevel(logging.INFO)
+
+    def run_legacy(n):
+        for i in range(n):
+            legacy.info(f"process_contact: User {i} telefon raqamini yubordi. Product ID: {17}, savat: {True}")
+            legacy.info(f"process_contact: User {i} telefon raqami: {'+998901234567'}")
+            legacy.info(f"process_contact: User {i} sotib olmoqchi bo'lgan mahsulotlar: {items}")
+            legacy.debug(f"Xabarni (ID: {i}) matn bilan tahrirlash: text={'<b>Buyurtma</b>' * 4}...")
+            legacy.info(f"process_contact: User {i} uchun buyurtma #{i} ({len(items)} qator) bazaga yozildi.")
+            legacy.info(f"process_contact: Adminga yuboriladigan xabar tayyorlandi: {'<b>Yangi</b>' * 12}...")
+            legacy.debug(f"Yangi xabarni matn bilan yuborish: text={'<b>Rahmat</b>' * 4}...")
+            legacy.info(f"process_contact: Adminga ({1}) yangi buyurtma haqida xabar muvaffaqiyatli yuborildi.")
+
+    def run_lazy(target):
+        def run(n):
+            for i in range(n):
+                target.info("process_contact: User %s telefon raqamini yubordi. Product ID: %s, savat: %s", i, 17, True)
+                target.info("process_contact: User %s telefon raqami: %s", i, "+998901234567")
+                target.info("process_contact: User %s sotib olmoqchi bo'lgan mahsulotlar: %s", i, items)
+                target.debug("Xabarni (ID: %s) matn bilan tahrirlash: text=%.30s...", i, "<b>Buyurtma</b>" * 4)
+                target.info("process_contact: User %s uchun buyurtma #%s (%s qator) bazaga yozildi.", i, i, len(items))
+                target.debug("process_contact: Adminga yuboriladigan xabar tayyorlandi: %.100s...", "<b>Yangi</b>" * 12)
+                target.debug("Yangi xabarni matn bilan yuborish: text=%.30s...", "<b>Rahmat</b>" * 4)
+                target.info("process_contact: Adminga (%s) yangi buyurtma haqida xabar muvaffaqiyatli yuborildi.", 1)
+        return run
+
+    listener.start()
+    try:
+        legacy_us = timed(run_legacy, iterations) / 1000
+        queued_us = timed(run_lazy(queued), iterations) / 1000
+        sampled_us = timed(run_lazy(sampled), iterations) / 1000
+    finally:
+        listener.stop()
+        devnull.close()
+    print(f"logging_overhead (event loop oqimida, update boshiga): sinxron f-string {legacy_us:,.1f} us, "
+          f"navbat {queued_us:,.1f} us, navbat + sampling {sampled_us:,.1f} us")
+
+
+def bench_tracing_overhead(iterations=50_000, spans_per_update=10):
+    # Bitta update: ildiz span + handler, bir nechta DB va Bot API spanlari (ichida ish yo'q, faqat o'lchash narxi)
+    def run_untraced(n):
+        for _ in range(n):
+            for _ in range(spans_per_update):
+                with tracing.span("db.fetch_one", sql="SELECT 1"):
+                    pass
+
+    def run_traced(n):
+        for _ in range(n):
+            with tracing.start_trace("update", kind="callback"):
+                for _ in range(spans_per_update):
+                    with tracing.span("db.fetch_one", sql="SELECT 1"):
+                        pass
+
+    untraced_ns = timed(run_untraced, iterations)
+    traced_ns = timed(run_traced, iterations)
+    print(f"tracing_overhead: {spans_per_update} span/update, trace'siz {untraced_ns / 1000:,.1f} us, "
+          f"trace bilan {traced_ns / 1000:,.1f} us ({traced_ns / spans_per_update:,.0f} ns/span)")
+
+
+def bench_money_aggregation(rows=1_000_000, repeats=5):
+    # Bir xil summalar: REAL (so'm, kasr bilan) va INTEGER (tiyin) ustunda SUM / GROUP BY
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE money_real (bucket INTEGER, amount REAL)")
+    conn.execute("CREATE TABLE money_minor (bucket INTEGER, amount INTEGER)")
+    amounts = [(i % 30, 1_000 + (i * 7919) % 5_000_000 / 100) for i in range(rows)]
+    conn.executemany("INSERT INTO money_real VALUES (?, ?)", amounts)
+    conn.executemany("INSERT INTO money_minor VALUES (?, ?)",
+                     [(bucket, bot.parse_money(repr(amount))) for bucket, amount in amounts])
+    exact_total = sum(bot.parse_money(repr(amount)) for _, amount in amounts)
+
+    def measure(table):
+        started = time.perf_counter()
+        for _ in range(repeats):
+            total = conn.execute(f"SELECT SUM(amount) FROM {table}").fetchone()[0]
+            conn.execute(f"SELECT bucket, SUM(amount) FROM {table} GROUP BY bucket").fetchall()
+        return (time.perf_counter() - started) / repeats * 1000, total
+
+    real_ms, real_total = measure("money_real")
+    minor_ms, minor_total = measure("money_minor")
+    real_error = real_total * bot.MONEY_MINOR_PER_UNIT - exact_total
+    print(f"money_aggregation: {rows:,} qator, REAL {real_ms:,.1f} ms (xato {real_error:+.4f} tiyin), "
+          f"INTEGER {minor_ms:,.1f} ms (xato {minor_total - exact_total} tiyin)")
+    conn.close()
+
+
+BENCHMARKS = {
+    "callback_dispatch": bench_callback_dispatch,
+    "callback_decode": bench_callback_decode,
+    "storage_backends": bench_storage_backends,
+    "stock_oversell": bench_stock_oversell,
+    "flood_buckets": bench_flood_buckets,
+    "session_sweep": bench_session_sweep,
+    "logging_overhead": bench_logging_overhead,
+    "tracing_overhead": bench_tracing_overhead,
+    "money_aggregation": bench_money_aggregation,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
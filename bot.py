@@ -1,31 +1,149 @@
+import asyncio
+import atexit
+import base64
+import binascii
+import collections
+import copy
+import csv
+import decimal
+import functools
+import gzip
+import html
+import httpx
+import io
+import json
 import logging
+import logging.handlers
+import queue
+import random
+import re
+import shutil
 import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, \
     ReplyKeyboardRemove, InputMediaPhoto
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
+    BaseHandler,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
 )
+from telegram.request import BaseRequest, HTTPXRequest
 import telegram.error
-from datetime import datetime
+from datetime import datetime, time as dt_time, timezone
 from dotenv import load_dotenv
+from storage import (ORDER_STATUSES, DuplicateNameError, OutOfStockError, add_order_status_count, open_repositories,
+                     record_price_history)
+import tracing
 import os
 load_dotenv()
 #Xudayor
 
 # Logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Handler'lar yozuvni faqat navbatga qo'yadi; formatlash va chiqarish QueueListener oqimida bajariladi,
+# shuning uchun event loop stderr/fayl I/O ni kutmaydi. LOG_FORMAT=json: har bir yozuv bitta JSON qator.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+LOG_SAMPLE_RATE_PER_SECOND = 20  # issiq yo'llardagi INFO/DEBUG yozuvlar, har bir logger uchun alohida
+LOG_SAMPLE_BURST = 50
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": self.formatTime(record), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Standart prepare() traceback'ni xabar matniga qo'shib yuboradi; JSON'da u alohida maydonda bo'lishi uchun
+    # faqat argumentlar joylanadi, traceback esa exc_text ga matn sifatida olinadi (exc_info oqimlararo o'tmaydi).
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RateSampleFilter(logging.Filter):
+    # Token chelak: soniyasiga `rate` ta, ketma-ket `burst` tagacha yozuv o'tadi, qolgani tashlanadi.
+    # WARNING va undan yuqorisi doim o'tadi.
+    def __init__(self, rate_per_second, burst):
+        super().__init__()
+        self.rate = rate_per_second
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        self.dropped += 1
+        return False
+
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    if log_format == "json":
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    root_logger = logging.getLogger()
+    root_logger.handlers[:] = [LogQueueHandler(log_queue)]
+    root_logger.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)  # chiqishda navbatdagi yozuvlar yo'qolmasin
+    return listener
+
+
+log_sample_filters = []
+
+
+def sampled_logger(name):
+    sample_filter = RateSampleFilter(LOG_SAMPLE_RATE_PER_SECOND, LOG_SAMPLE_BURST)
+    log_sample_filters.append(sample_filter)
+    hot_logger = logging.getLogger(name)
+    hot_logger.addFilter(sample_filter)
+    return hot_logger
+
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
+messages_logger = sampled_logger(f"{__name__}.messages")  # send_or_edit_message
+orders_logger = sampled_logger(f"{__name__}.orders")  # process_contact, admin_view_orders
+sampled_logger("httpx")  # har bir Bot API so'rovi uchun INFO yozuv
 
 # Global
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
-DB_NAME = "jewelry_bot.db"
+DB_NAME = os.getenv("DB_NAME", "jewelry_bot.db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | memory (faqat test va benchmarklar uchun)
 
 # Conversation States (Admin)
 (ASK_CATEGORY_NAME,
@@ -44,37 +162,276 @@ DB_NAME = "jewelry_bot.db"
 
 
 EDIT_PRICE_ENTRY_PRODUCT_ID, EDIT_PRICE_ASK_NEW_PRICE = range(12, 14)
+IMPORT_SELECT_MODE, IMPORT_ASK_DOCUMENT = range(14, 16)
+BROADCAST_SELECT_SEGMENT, BROADCAST_ASK_TEXT, BROADCAST_CONFIRM = range(22, 25)
+ASK_EDIT_PRODUCT_NEW_STOCK = 25
+(BULK_SELECT_OPERATION,
+ BULK_SELECT_SOURCE,
+ BULK_ASK_NAME_FILTER,
+ BULK_ASK_PRICE_CHANGE,
+ BULK_SELECT_TARGET,
+ BULK_CONFIRM,
+ ) = range(16, 22)
+
+# Callback data
+CALLBACK_CODEC_VERSION = 1
+CALLBACK_DECODE_CACHE_SIZE = 4096
+CALLBACK_PAYLOAD_STORE_SIZE = 2048
+
+# Catalog import
+IMPORT_CHUNK_SIZE = 500
+IMPORT_MAX_FILE_SIZE = 20 * 1024 * 1024  # Bot API orqali yuklab olish chegarasi
+IMPORT_MAX_REPORTED_ERRORS = 20
+IMPORT_ALLOWED_EXTENSIONS = (".csv", ".json", ".jsonl")
+
+# Money: summalar bazada butun son - tiyinda (1 so'm = 100 tiyin) saqlanadi, faqat ko'rsatishda so'mga aylanadi
+MONEY_MINOR_PER_UNIT = 100
+SCHEMA_VERSION_INTEGER_MONEY = 1  # PRAGMA user_version: REAL narxlar tiyinli INTEGER ga o'tkazilgan
+# jadval -> pul ustunlari (migratsiya va yangi jadvallar uchun)
+MONEY_COLUMNS = {
+    "products": ("price",),
+    "orders": ("product_price_at_order",),
+    "orders_archive": ("product_price_at_order",),
+    "order_items": ("product_price_at_order",),
+    "order_items_archive": ("product_price_at_order",),
+    "sales_rollup": ("revenue",),
+    "sales_product_totals": ("revenue",),
+    "sales_category_totals": ("revenue",),
+    "sales_customer_totals": ("revenue",),
+}
+
+# Bulk price changes: "+10%", "-5000", "=150000", ixtiyoriy yaxlitlash: "+10% 1000 up"
+BULK_PRICE_CHANGE_RE = re.compile(
+    r"^\s*([+\-=])\s*(\d+(?:[.,]\d+)?)\s*(%?)\s*(?:(\d+)\s*(up|down|yuqori|past)?)?\s*$", re.IGNORECASE)
+BULK_ROUND_MODES = {"up": "up", "yuqori": "up", "down": "down", "past": "down"}
+
+# Deep links: t.me/<bot>?start=p_<id> (mahsulot kartasi) yoki c_<id> (kategoriya)
+START_PAYLOAD_RE = re.compile(r"(p|c)_(\d+)")
+
+# Broadcast
+BROADCAST_RATE_PER_SECOND = 25  # Telegram umumiy chegarasi ~30 xabar/soniya
+BROADCAST_CONCURRENCY = 10
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_MAX_ATTEMPTS = 3
+BROADCAST_PROGRESS_INTERVAL = 5  # soniya
+
+# Order archive
+ORDER_ARCHIVE_AFTER_DAYS = int(os.getenv("ORDER_ARCHIVE_AFTER_DAYS", "180"))
+ORDER_ARCHIVE_INTERVAL = 6 * 60 * 60  # soniya
+ORDER_ARCHIVE_BATCH_SIZE = 500
+ORDER_ARCHIVE_BATCH_PAUSE = 0.2  # soniya
+
+# Order status queues (admin)
+ORDER_QUEUE_PAGE_SIZE = 10
+ORDER_STATUS_LABELS = {
+    "new": "🆕 Yangi",
+    "contacted": "📞 Bog'lanildi",
+    "confirmed": "✅ Tasdiqlandi",
+    "shipped": "🚚 Yuborildi",
+    "cancelled": "❌ Bekor qilindi",
+}
+
+# Funnel analytics: handlerlar hodisani xotiradagi halqa buferga qo'yadi, fon vazifasi partiyalab yozadi
+FUNNEL_STAGES = ("categories", "category", "product", "buy", "order")  # kodlar bazada: faqat oxiridan qo'shing
+FUNNEL_STAGE_TITLES = {
+    "categories": "Kategoriyalar ro'yxati",
+    "category": "Kategoriya ochildi",
+    "product": "Mahsulotlar varaqlandi",
+    "buy": "Sotib olish bosildi",
+    "order": "Buyurtma berildi",
+}
+FUNNEL_BUFFER_SIZE = 20_000  # to'lsa eng eski hodisalar tashlanadi (funnel_events_dropped_total)
+FUNNEL_FLUSH_INTERVAL = 10  # soniya
+FUNNEL_FLUSH_BATCH_SIZE = 2000
+FUNNEL_EVENTS_RETENTION_DAYS = 30  # xom hodisalar; soatlik yig'indilar saqlanib qoladi
+FUNNEL_REPORT_RANGES_DAYS = (1, 7, 30)
+
+# Price history (admin)
+PRICE_HISTORY_RANGES_DAYS = (30, 90, 365)
+PRICE_HISTORY_SHOWN = 15  # ko'rsatiladigan oxirgi o'zgarishlar
+
+# Customer order history (/myorders)
+ORDER_HISTORY_PAGE_SIZE = 5
+ORDER_HISTORY_CACHE_USERS = 1024  # sahifalari xotirada saqlanadigan mijozlar (LRU)
+
+# Backup
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_FILE_PREFIX = "jewelry_bot-"
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL_HOURS", "24")) * 60 * 60  # soniya
+BACKUP_RETENTION = int(os.getenv("BACKUP_RETENTION", "7"))
+BACKUP_PAGES_PER_STEP = 64
+BACKUP_STEP_PAUSE = 0.05  # soniya
+
+# Database maintenance: kunlik, kam yuklangan soatda (UTC; 23:00 UTC = 04:00 Toshkent)
+MAINTENANCE_HOUR_UTC = int(os.getenv("MAINTENANCE_HOUR_UTC", "23"))
+MAINTENANCE_STEP_BUDGET = 5.0  # soniya: ANALYZE, checkpoint va vacuum qadamlarining har biri uchun
+MAINTENANCE_ANALYSIS_LIMIT = 1000  # PRAGMA analysis_limit: ANALYZE har indeksdan taxminan shuncha qator o'qiydi
+MAINTENANCE_BUSY_TIMEOUT_MS = 200  # qulf band bo'lsa kutish, keyin qadam o'tkazib yuboriladi
+WAL_CHECKPOINT_INTERVAL = 15 * 60  # soniya
+WAL_MAX_BYTES = int(os.getenv("WAL_MAX_MB", "16")) * 1024 * 1024  # shundan katta WAL TRUNCATE bilan qisqartiriladi
+INCREMENTAL_VACUUM_PAGES = 256  # bitta tranzaksiyada bo'shatiladigan sahifalar
+INCREMENTAL_VACUUM_PAUSE = 0.05  # soniya: qadamlar orasida yozuvchilarga navbat
+
+# Stock reservations
+STOCK_RESERVATION_TTL = 15 * 60  # soniya: mijoz telefon raqamini yuborguncha dona band turadi
+STOCK_SWEEP_INTERVAL = 60  # soniya
+
+# Cart
+CART_MAX_ITEMS = 20
+CART_MAX_QUANTITY = 10
+
+# Flood protection (ADMIN_ID cheklanmaydi)
+FLOOD_RATE_PER_SECOND = 3
+FLOOD_BURST = 8
+FLOOD_MAX_TRACKED_USERS = 50_000
+
+# Product navigation: ketma-ket "Keyingisi"/"Oldingisi" bosishlar bitta tahrirga birlashtiriladi
+NAV_RENDER_DELAY = 0.35  # soniya: oxirgi bosishdan keyin shuncha kutiladi
+NAV_RENDER_MAX_DELAY = 1.0  # soniya: to'xtovsiz bosishda ham karta shundan kechikmay yangilanadi
+
+# Sessions (context.user_data); ADMIN_ID sessiyasiga tegilmaydi
+SESSION_IDLE_TTL = 60 * 60  # soniya: shundan ko'p jim turgan sessiya ixchamlashtiriladi yoki o'chiriladi
+SESSION_KEEP_KEYS = ("cart",)  # ixchamlashtirilganda faqat shu kalitlar qoladi
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "64")) * 1024 * 1024  # bayt
+SESSION_SWEEP_INTERVAL = 5 * 60  # soniya
+
+# Tracing (har bir Update uchun spanlar, aylanuvchi JSONL faylga); TRACE_FILE= bo'sh bo'lsa o'chiq
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUP_COUNT = 3
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", "1000"))  # bundan sekin trace'lar doim saqlanadi
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))  # qolgan (tez, xatosiz) trace'lar ulushi
+
+# HTTP transport (Bot API mijozi). Vaqtlar soniyada. get_updates uchun alohida so'rov obyekti va pool:
+# uzoq kutadigan polling chiquvchi so'rovlarning ulanishlarini band qilmaydi.
+# http_version "2" uchun python-telegram-bot[http2] kerak.
+TRANSPORT_METHOD_TIMEOUTS = {  # Bot API metodi -> chaqiruvda vaqt berilmaganda ishlatiladigan qiymatlar
+    "sendPhoto": {"write": 30.0},
+    "editMessageMedia": {"write": 30.0},
+    "sendDocument": {"read": 30.0, "write": 60.0},
+    "getFile": {"read": 30.0},
+}
+TRANSPORT_PROFILES = {
+    "standard": {
+        "pool_size": 64, "keepalive_connections": 32, "keepalive_expiry": 30.0, "http_version": "1.1",
+        "connect_timeout": 5.0, "read_timeout": 5.0, "write_timeout": 5.0, "pool_timeout": 3.0,
+        "media_write_timeout": 20.0, "method_timeouts": TRANSPORT_METHOD_TIMEOUTS,
+        "get_updates": {"pool_size": 1, "keepalive_connections": 1, "keepalive_expiry": 60.0, "http_version": "1.1",
+                        "connect_timeout": 5.0, "read_timeout": 5.0, "write_timeout": 5.0, "pool_timeout": 1.0},
+    },
+    # Ko'p parallel handler va broadcast: katta pool, ulanishlar uzoqroq saqlanadi, navbatda uzoqroq kutiladi
+    "busy": {
+        "pool_size": 256, "keepalive_connections": 128, "keepalive_expiry": 60.0, "http_version": "1.1",
+        "connect_timeout": 5.0, "read_timeout": 10.0, "write_timeout": 10.0, "pool_timeout": 10.0,
+        "media_write_timeout": 30.0, "method_timeouts": TRANSPORT_METHOD_TIMEOUTS,
+        "get_updates": {"pool_size": 1, "keepalive_connections": 1, "keepalive_expiry": 60.0, "http_version": "1.1",
+                        "connect_timeout": 5.0, "read_timeout": 5.0, "write_timeout": 5.0, "pool_timeout": 1.0},
+    },
+    # Bitta HTTP/2 ulanish ustida multiplexing: kam ulanish, tez javob kutiladi
+    "http2": {
+        "pool_size": 16, "keepalive_connections": 4, "keepalive_expiry": 120.0, "http_version": "2",
+        "connect_timeout": 3.0, "read_timeout": 5.0, "write_timeout": 5.0, "pool_timeout": 3.0,
+        "media_write_timeout": 20.0, "method_timeouts": TRANSPORT_METHOD_TIMEOUTS,
+        "get_updates": {"pool_size": 1, "keepalive_connections": 1, "keepalive_expiry": 120.0, "http_version": "2",
+                        "connect_timeout": 3.0, "read_timeout": 5.0, "write_timeout": 5.0, "pool_timeout": 1.0},
+    },
+}
+TRANSPORT_PROFILE = os.getenv("TRANSPORT_PROFILE", "standard")
+
+# Sales analytics
+ANALYTICS_BUCKETS_SHOWN = 7
+ANALYTICS_TOP_SHOWN = 5
+
+# "Birga sotib olishadi" tavsiyalari (bitta mijoz xarid qilgan mahsulotlar juftligi)
+RECOMMENDATIONS_TOP_K = 5  # har bir mahsulot uchun saqlanadigan qo'shnilar
+RECOMMENDATIONS_SHOWN = 3  # kartada ko'rsatiladigan tugmalar
+RECOMMENDATIONS_INTERVAL = 15 * 60  # soniya
+RECOMMENDATIONS_BATCH_SIZE = 500  # bir tranzaksiyada qayta ishlanadigan buyurtmalar
+RECOMMENDATIONS_BATCH_PAUSE = 0.05  # soniya
+
+
+# --- Metrics ---
+class MetricsRegistry:
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def set_max(self, name, value):
+        with self._lock:
+            self._values[name] = max(self._values.get(name, value), value)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+
+metrics = MetricsRegistry()
+
+
+# --- Money ---
+def parse_money(text):
+    # "150000", "150 000", "149999,50" -> tiyin (int); noto'g'ri qiymat uchun None
+    try:
+        amount = decimal.Decimal(str(text).replace(" ", "").replace(",", "."))
+    except decimal.InvalidOperation:
+        return None
+    if not amount.is_finite():
+        return None
+    return int((amount * MONEY_MINOR_PER_UNIT).to_integral_value(decimal.ROUND_HALF_UP))
+
+
+def format_money(minor, sign=False):
+    # Tiyin -> "1,250,000" (butun so'mgacha yaxlitlanadi, avvalgi :,.0f ko'rinishi)
+    minor = minor or 0
+    units, remainder = divmod(abs(minor), MONEY_MINOR_PER_UNIT)
+    units += remainder * 2 >= MONEY_MINOR_PER_UNIT
+    prefix = "-" if minor < 0 and units else ("+" if sign else "")
+    return f"{prefix}{units:,}"
 
 
 # --- Database ---
-def db_query(query, params=()):
+def db_connect():
     conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
-    cursor.execute(query, params)
-    conn.commit()
-    last_row_id = cursor.lastrowid
-    conn.close()
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+
+def db_query(query, params=()):
+    with tracing.span("db.query", sql=query):
+        conn = db_connect()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        conn.commit()
+        last_row_id = cursor.lastrowid
+        conn.close()
     return last_row_id
 
 
 def db_fetch_one(query, params=()):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
-    cursor.execute(query, params)
-    result = cursor.fetchone()
-    conn.close()
+    with tracing.span("db.fetch_one", sql=query):
+        conn = db_connect()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        result = cursor.fetchone()
+        conn.close()
     return result
 
 
 def db_fetch_all(query, params=()):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
-    cursor.execute(query, params)
-    result = cursor.fetchall()
-    conn.close()
+    with tracing.span("db.fetch_all", sql=query):
+        conn = db_connect()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        result = cursor.fetchall()
+        conn.close()
     return result
 
 
@@ -99,6 +456,20 @@ def alter_table_add_column_if_not_exists(table_name, column_name, column_type):
         conn.close()
 
 
+def enable_incremental_vacuum():
+    # auto_vacuum rejimini faqat VACUUM o'zgartiradi: bir martalik, bot so'rovlarni qabul qilishidan oldin
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        started_at = time.monotonic()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        logger.info("auto_vacuum = INCREMENTAL yoqildi (VACUUM %.2f s).", time.monotonic() - started_at)
+    finally:
+        conn.close()
+
+
 def setup_database():
     db_query("""
              CREATE TABLE IF NOT EXISTS categories
@@ -131,7 +502,7 @@ def setup_database():
                  description
                  TEXT,
                  price
-                 REAL
+                 INTEGER
                  NOT
                  NULL,
                  image_file_id
@@ -179,7 +550,8 @@ def setup_database():
              ) ON DELETE SET NULL
                  )""")
     alter_table_add_column_if_not_exists("orders", "product_name_at_order", "TEXT")
-    alter_table_add_column_if_not_exists("orders", "product_price_at_order", "REAL")
+    alter_table_add_column_if_not_exists("orders", "product_price_at_order", "INTEGER")
+    alter_table_add_column_if_not_exists("orders", "status", f"TEXT NOT NULL DEFAULT '{ORDER_STATUSES[0]}'")
     db_query("""
              CREATE TABLE IF NOT EXISTS users
              (
@@ -195,9 +567,1059 @@ def setup_database():
                  TEXT
                  UNIQUE
              )""")
+    alter_table_add_column_if_not_exists("users", "is_blocked", "INTEGER NOT NULL DEFAULT 0")
+    # NULL: zaxira hisobi yuritilmaydi (cheklanmagan); son: band qilinmagan mavjud donalar
+    alter_table_add_column_if_not_exists("products", "stock", "INTEGER")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS stock_reservations
+             (
+                 id         INTEGER PRIMARY KEY AUTOINCREMENT,
+                 product_id INTEGER NOT NULL REFERENCES products (id) ON DELETE CASCADE,
+                 user_id    INTEGER NOT NULL,
+                 expires_at REAL    NOT NULL
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_stock_reservations_expires ON stock_reservations (expires_at)")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS broadcasts
+             (
+                 id                  INTEGER PRIMARY KEY AUTOINCREMENT,
+                 kind                TEXT    NOT NULL,
+                 text                TEXT,
+                 product_id          INTEGER,
+                 segment             TEXT    NOT NULL DEFAULT 'all',
+                 status              TEXT    NOT NULL DEFAULT 'running',
+                 last_user_id        INTEGER NOT NULL DEFAULT 0,
+                 sent_count          INTEGER NOT NULL DEFAULT 0,
+                 failed_count        INTEGER NOT NULL DEFAULT 0,
+                 blocked_count       INTEGER NOT NULL DEFAULT 0,
+                 admin_chat_id       INTEGER,
+                 progress_message_id INTEGER,
+                 created_at          DATETIME DEFAULT CURRENT_TIMESTAMP,
+                 finished_at         DATETIME
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_products_category_name ON products (category_id, name)")
+    db_query("CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)")
+    db_query("CREATE INDEX IF NOT EXISTS idx_orders_timestamp ON orders (timestamp)")
+    # Holat navbatlari: WHERE status = ? ORDER BY timestamp DESC indeksdan o'qiladi
+    db_query("CREATE INDEX IF NOT EXISTS idx_orders_status_timestamp ON orders (status, timestamp)")
+    # Mijozning buyurtmalar tarixi (/myorders): WHERE user_id = ? ORDER BY timestamp DESC, id DESC
+    db_query("CREATE INDEX IF NOT EXISTS idx_orders_user_timestamp ON orders (user_id, timestamp)")
+    # Har bir holatdagi (arxivlanmagan) buyurtmalar soni: buyurtma yozilganda, holat o'zgarganda
+    # va arxivlanganda shu tranzaksiyaning o'zida yangilanadi
+    db_query("""
+             CREATE TABLE IF NOT EXISTS order_status_counts
+             (
+                 status      TEXT PRIMARY KEY,
+                 order_count INTEGER NOT NULL DEFAULT 0
+             ) WITHOUT ROWID""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS orders_archive
+             (
+                 id                     INTEGER PRIMARY KEY,
+                 user_id                INTEGER NOT NULL,
+                 user_username          TEXT,
+                 product_id             INTEGER,
+                 phone_number           TEXT    NOT NULL,
+                 timestamp              DATETIME,
+                 product_name_at_order  TEXT,
+                 product_price_at_order INTEGER
+             )""")
+    alter_table_add_column_if_not_exists("orders_archive", "status", f"TEXT NOT NULL DEFAULT '{ORDER_STATUSES[0]}'")
+    db_query("CREATE INDEX IF NOT EXISTS idx_orders_archive_timestamp ON orders_archive (timestamp)")
+    db_query("CREATE INDEX IF NOT EXISTS idx_orders_archive_user ON orders_archive (user_id, timestamp)")
+    # Savatdan berilgan buyurtma qatorlari; orders qatori sarlavha (birinchi mahsulot, jami summa)
+    db_query("""
+             CREATE TABLE IF NOT EXISTS order_items
+             (
+                 id                     INTEGER PRIMARY KEY AUTOINCREMENT,
+                 order_id               INTEGER NOT NULL REFERENCES orders (id) ON DELETE CASCADE,
+                 product_id             INTEGER REFERENCES products (id) ON DELETE SET NULL,
+                 product_name_at_order  TEXT,
+                 product_price_at_order INTEGER,
+                 quantity               INTEGER NOT NULL DEFAULT 1
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS order_items_archive
+             (
+                 id                     INTEGER PRIMARY KEY,
+                 order_id               INTEGER NOT NULL,
+                 product_id             INTEGER,
+                 product_name_at_order  TEXT,
+                 product_price_at_order INTEGER,
+                 quantity               INTEGER NOT NULL DEFAULT 1
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_order_items_archive_order ON order_items_archive (order_id)")
+    # Statistika uchun yig'ma jadvallar: har bir buyurtmada oshirib boriladi
+    db_query("""
+             CREATE TABLE IF NOT EXISTS sales_rollup
+             (
+                 period      TEXT    NOT NULL,
+                 bucket      TEXT    NOT NULL,
+                 revenue     INTEGER NOT NULL DEFAULT 0,
+                 order_count INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (period, bucket)
+             ) WITHOUT ROWID""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS sales_product_totals
+             (
+                 product_id   INTEGER PRIMARY KEY,
+                 product_name TEXT,
+                 revenue      INTEGER NOT NULL DEFAULT 0,
+                 order_count  INTEGER NOT NULL DEFAULT 0
+             )""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS sales_category_totals
+             (
+                 category_id INTEGER PRIMARY KEY,
+                 revenue     INTEGER NOT NULL DEFAULT 0,
+                 order_count INTEGER NOT NULL DEFAULT 0
+             )""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS sales_customer_totals
+             (
+                 user_id        INTEGER PRIMARY KEY,
+                 order_count    INTEGER NOT NULL DEFAULT 0,
+                 revenue        INTEGER NOT NULL DEFAULT 0,
+                 first_order_at DATETIME,
+                 last_order_at  DATETIME
+             )""")
+    db_query("CREATE TABLE IF NOT EXISTS sales_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)")
+    db_query("CREATE INDEX IF NOT EXISTS idx_sales_product_totals_revenue ON sales_product_totals (revenue)")
+    db_query("CREATE INDEX IF NOT EXISTS idx_sales_category_totals_revenue ON sales_category_totals (revenue)")
+    # Voronka: xom hodisalar (faqat qo'shiladi), soatlik yig'indilar va soat ichidagi noyob foydalanuvchilar
+    db_query("""
+             CREATE TABLE IF NOT EXISTS funnel_events
+             (
+                 id         INTEGER PRIMARY KEY,
+                 created_at REAL    NOT NULL,
+                 stage      INTEGER NOT NULL,
+                 user_id    INTEGER NOT NULL,
+                 subject_id INTEGER
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_funnel_events_created ON funnel_events (created_at)")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS funnel_hourly
+             (
+                 bucket TEXT    NOT NULL,
+                 stage  INTEGER NOT NULL,
+                 events INTEGER NOT NULL DEFAULT 0,
+                 users  INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (bucket, stage)
+             ) WITHOUT ROWID""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS funnel_hourly_users
+             (
+                 bucket  TEXT    NOT NULL,
+                 stage   INTEGER NOT NULL,
+                 user_id INTEGER NOT NULL,
+                 PRIMARY KEY (bucket, stage, user_id)
+             ) WITHOUT ROWID""")
+    # Tavsiyalar: mijoz "savati" (har bir mijoz xarid qilgan mahsulotlar), juftliklar soni va tayyor top-K
+    db_query("""
+             CREATE TABLE IF NOT EXISTS recommendation_baskets
+             (
+                 user_id    INTEGER NOT NULL,
+                 product_id INTEGER NOT NULL,
+                 PRIMARY KEY (user_id, product_id)
+             ) WITHOUT ROWID""")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS product_cooccurrence
+             (
+                 product_id       INTEGER NOT NULL,
+                 other_product_id INTEGER NOT NULL,
+                 score            INTEGER NOT NULL DEFAULT 0,
+                 PRIMARY KEY (product_id, other_product_id)
+             ) WITHOUT ROWID""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_product_cooccurrence_score ON product_cooccurrence (product_id, score)")
+    db_query("""
+             CREATE TABLE IF NOT EXISTS product_recommendations
+             (
+                 product_id             INTEGER NOT NULL,
+                 rank                   INTEGER NOT NULL,
+                 recommended_product_id INTEGER NOT NULL,
+                 score                  INTEGER NOT NULL,
+                 PRIMARY KEY (product_id, rank)
+             ) WITHOUT ROWID""")
+    migrate_money_to_minor_units()
+    # Narx tarixi: har bir narx o'zgarishi o'sha tranzaksiyada qo'shiladi (storage.record_price_history).
+    # Pul migratsiyasidan keyin: narxlar allaqachon tiyinda
+    db_query("""
+             CREATE TABLE IF NOT EXISTS price_history
+             (
+                 id         INTEGER PRIMARY KEY,
+                 product_id INTEGER  NOT NULL,
+                 price      INTEGER  NOT NULL,
+                 changed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+             )""")
+    db_query("CREATE INDEX IF NOT EXISTS idx_price_history_product_changed ON price_history (product_id, changed_at)")
+    # Tarixi yo'q mahsulotlar uchun joriy narx boshlang'ich nuqta bo'ladi (undan oldingi narx noma'lum)
+    db_query("INSERT INTO price_history (product_id, price) SELECT p.id, p.price FROM products p "
+             "WHERE NOT EXISTS (SELECT 1 FROM price_history h WHERE h.product_id = p.id)")
+    enable_incremental_vacuum()
     logger.info("Ma'lumotlar bazasi sozlandi (kerak bo'lsa, 'orders' jadvali yangilandi).")
 
 
+def rebuild_table_with_integer_money(conn, table, columns):
+    # SQLite ustun turini o'zgartira olmaydi: jadval yangi sxema bilan qayta yaratiladi (sqlite.org/lang_altertable
+    # dagi 12 qadamli usul), pul ustunlari ko'chirishda tiyinga aylantiriladi. Indekslar qayta tiklanadi.
+    table_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if not table_sql:
+        return False
+    retyped = [column for column in columns if re.search(rf"\b{column}\s+REAL\b", table_sql[0], re.IGNORECASE)]
+    if not retyped:
+        return False
+    new_sql = table_sql[0]
+    for column in retyped:
+        new_sql = re.sub(rf"(\b{column}\s+)REAL\b", r"\1INTEGER", new_sql, flags=re.IGNORECASE)
+    new_table = f"{table}__money"
+    new_sql = re.sub(rf"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?[\"`]?{table}[\"`]?",
+                     f"CREATE TABLE {new_table}", new_sql, flags=re.IGNORECASE)
+    index_sqls = [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))]
+    column_names = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    select_list = ", ".join(
+        f"CAST(ROUND({name} * {MONEY_MINOR_PER_UNIT}) AS INTEGER)" if name in retyped else name
+        for name in column_names)
+    has_sequence = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone()
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone() \
+        if has_sequence else None
+    conn.execute(new_sql)
+    conn.execute(f"INSERT INTO {new_table} ({', '.join(column_names)}) SELECT {select_list} FROM {table}")
+    conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+    for index_sql in index_sqls:
+        conn.execute(index_sql)
+    if sequence:
+        # AUTOINCREMENT: o'chirilgan eng katta id'lar qayta berilmasin
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+    return True
+
+
+def migrate_money_to_minor_units():
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION_INTEGER_MONEY:
+            return
+        # Jadvallarni qayta yaratishda tashqi kalitlar vaqtincha o'chiriladi (tranzaksiyadan tashqarida)
+        conn.execute("PRAGMA foreign_keys = OFF")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rebuilt = [table for table, columns in MONEY_COLUMNS.items()
+                       if rebuild_table_with_integer_money(conn, table, columns)]
+            violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+            if violations:
+                logger.warning("Pul migratsiyasi: migratsiyadan oldin ham mavjud bo'lgan %s ta tashqi kalit buzilishi.",
+                               len(violations))
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION_INTEGER_MONEY}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if rebuilt:
+            logger.info("Pul ustunlari tiyinli INTEGER ga o'tkazildi: %s", ", ".join(rebuilt))
+    finally:
+        conn.close()
+
+
+# --- Order Archive ---
+ORDER_COLUMNS = ("id, user_id, user_username, product_id, phone_number, timestamp, "
+                 "product_name_at_order, product_price_at_order, status")
+ORDER_ITEM_COLUMNS = "id, order_id, product_id, product_name_at_order, product_price_at_order, quantity"
+
+
+def get_app_meta(key, default=None):
+    row = db_fetch_one("SELECT value FROM app_meta WHERE key = ?", (key,))
+    return row[0] if row else default
+
+
+def orders_source_sql(after_id=None, table="orders", columns=ORDER_COLUMNS):
+    # Arxiv bilan faqat kerak bo'lsa birlashtiriladi: after_id (qayta ishlangan buyurtmalar chegarasi) berilgan
+    # va u arxivdagi eng katta id'dan katta bo'lsa, so'ralgan buyurtmalar hammasi "issiq" jadvalda (id'lar AUTOINCREMENT)
+    if get_app_meta("orders_archived_until") is None:
+        return table
+    if after_id is not None and after_id >= (db_fetch_one("SELECT MAX(id) FROM orders_archive")[0] or 0):
+        return table
+    return f"(SELECT {columns} FROM {table} UNION ALL SELECT {columns} FROM {table}_archive)"
+
+
+def order_items_source_sql(after_id=None):
+    return orders_source_sql(after_id, "order_items", ORDER_ITEM_COLUMNS)
+
+
+def recent_orders_source_sql(limit):
+    # Oxirgi N ta buyurtma odatda to'liq "issiq" jadvalda bo'ladi
+    hot_count = db_fetch_one("SELECT COUNT(*) FROM (SELECT 1 FROM orders LIMIT ?)", (limit,))[0]
+    return "orders" if hot_count >= limit else orders_source_sql()
+
+
+def archive_orders_batch(cutoff, batch_size=ORDER_ARCHIVE_BATCH_SIZE):
+    conn = db_connect()
+    try:
+        with conn:
+            rows = conn.execute("SELECT id, timestamp FROM orders WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                                (cutoff, batch_size)).fetchall()
+            if not rows:
+                return 0
+            order_ids = [order_id for order_id, _ in rows]
+            placeholders = ",".join("?" * len(order_ids))
+            conn.execute(f"INSERT OR REPLACE INTO orders_archive ({ORDER_COLUMNS}) "
+                         f"SELECT {ORDER_COLUMNS} FROM orders WHERE id IN ({placeholders})", order_ids)
+            conn.execute(f"INSERT OR REPLACE INTO order_items_archive ({ORDER_ITEM_COLUMNS}) "
+                         f"SELECT {ORDER_ITEM_COLUMNS} FROM order_items WHERE order_id IN ({placeholders})", order_ids)
+            conn.execute(f"DELETE FROM order_items WHERE order_id IN ({placeholders})", order_ids)
+            for status, count in conn.execute(f"SELECT status, COUNT(*) FROM orders WHERE id IN ({placeholders}) "
+                                              f"GROUP BY status", order_ids).fetchall():
+                add_order_status_count(conn, status, -count)
+            conn.execute(f"DELETE FROM orders WHERE id IN ({placeholders})", order_ids)
+            conn.execute("INSERT INTO app_meta (key, value) VALUES ('orders_archived_until', ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)", (rows[-1][1],))
+        return len(order_ids)
+    finally:
+        conn.close()
+
+
+async def archive_old_orders_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # orders.timestamp CURRENT_TIMESTAMP (UTC) bilan yoziladi, chegara ham SQLite'da hisoblanadi
+    cutoff = db_fetch_one("SELECT datetime('now', ?)", (f"-{ORDER_ARCHIVE_AFTER_DAYS} days",))[0]
+    total_moved = 0
+    started_at = time.monotonic()
+    while True:
+        try:
+            moved = archive_orders_batch(cutoff)
+        except sqlite3.Error as e:
+            logger.error("Buyurtmalarni arxivlashda xatolik: %s", e)
+            break
+        total_moved += moved
+        if moved < ORDER_ARCHIVE_BATCH_SIZE:
+            break
+        # Partiyalar orasida yozish qulfini bo'shatib, boshqa handlerlarga navbat beramiz
+        await asyncio.sleep(ORDER_ARCHIVE_BATCH_PAUSE)
+    if total_moved:
+        logger.info("%s dan eski %s ta buyurtma arxivga ko'chirildi (%.1f s).", cutoff, total_moved,
+                    time.monotonic() - started_at)
+
+
+def backfill_order_status_counts():
+    # Bir martalik: status ustuni qo'shilgandan keyin mavjud buyurtmalar bo'yicha sonlar
+    conn = db_connect()
+    try:
+        with conn:
+            if conn.execute("SELECT 1 FROM app_meta WHERE key = 'order_status_counts_backfilled'").fetchone():
+                return
+            conn.execute("DELETE FROM order_status_counts")
+            conn.execute("INSERT INTO order_status_counts (status, order_count) "
+                         "SELECT status, COUNT(*) FROM orders GROUP BY status")
+            conn.execute("INSERT INTO app_meta (key, value) VALUES ('order_status_counts_backfilled', CURRENT_TIMESTAMP)")
+    finally:
+        conn.close()
+
+
+# --- Backup ---
+def backup_snapshot_paths():
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = [name for name in os.listdir(BACKUP_DIR)
+             if name.startswith(BACKUP_FILE_PREFIX) and name.endswith(".db.gz")]
+    # Yaratilish vaqti bo'yicha: nomdagi belgi ilgari mahalliy vaqtda edi, endi UTC ("Z"), alifbo tartibi
+    # o'tish paytida vaqt tartibiga mos kelmasligi mumkin
+    paths = [os.path.join(BACKUP_DIR, name) for name in names]
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def create_backup_snapshot():
+    # Alohida oqimda ishlaydi: backup() har qadamdan keyin progress orqali uxlaydi va
+    # qadamlar orasida manba bazadagi qulfni bo'shatadi, yozuvchilar to'xtab qolmaydi
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%SZ")
+    raw_path = os.path.join(BACKUP_DIR, f"{BACKUP_FILE_PREFIX}{stamp}.db.tmp")
+    gz_path = os.path.join(BACKUP_DIR, f"{BACKUP_FILE_PREFIX}{stamp}.db.gz")
+    source = sqlite3.connect(DB_NAME)
+    target = sqlite3.connect(raw_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP,
+                      progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE))
+        integrity = target.execute("PRAGMA integrity_check").fetchone()[0]
+        if integrity != "ok":
+            raise sqlite3.DatabaseError(f"integrity_check: {integrity}")
+    except Exception:
+        target.close()
+        os.remove(raw_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    try:
+        with open(raw_path, "rb") as raw_file, gzip.open(gz_path + ".tmp", "wb") as gz_file:
+            shutil.copyfileobj(raw_file, gz_file)
+        os.replace(gz_path + ".tmp", gz_path)
+    finally:
+        os.remove(raw_path)
+    return gz_path
+
+
+def rotate_backup_snapshots(retention=BACKUP_RETENTION):
+    paths = backup_snapshot_paths()
+    expired = paths[:max(len(paths) - max(retention, 1), 0)]
+    for path in expired:
+        os.remove(path)
+    return len(expired)
+
+
+async def backup_database_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    started_at = time.monotonic()
+    try:
+        snapshot_path = await asyncio.to_thread(create_backup_snapshot)
+        removed = await asyncio.to_thread(rotate_backup_snapshots)
+    except (sqlite3.Error, OSError) as e:
+        metrics.inc("backup_failures_total")
+        logger.error("Bazaning zaxira nusxasini olishda xatolik: %s", e)
+        return
+    duration = time.monotonic() - started_at
+    size = os.path.getsize(snapshot_path)
+    metrics.inc("backup_success_total")
+    metrics.set("backup_last_duration_seconds", round(duration, 3))
+    metrics.set("backup_last_size_bytes", size)
+    # Boshqa barcha vaqt belgilari kabi UTC (SQLite CURRENT_TIMESTAMP formati)
+    metrics.set("backup_last_success_at", datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"))
+    logger.info("Zaxira nusxa yaratildi: %s (%s bayt, %.2f s), eskilaridan %s tasi o'chirildi.",
+                snapshot_path, size, duration, removed)
+
+
+# --- Database Maintenance ---
+def database_file_stats(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    wal_path = f"{DB_NAME}-wal"
+    return {"pages": conn.execute("PRAGMA page_count").fetchone()[0],
+            "free_pages": conn.execute("PRAGMA freelist_count").fetchone()[0],
+            "page_size": page_size,
+            "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0}
+
+
+def run_with_time_budget(conn, budget, statement):
+    # Muddat tugasa SQLite so'rovni o'zi to'xtatadi (progress handler -> "interrupted"); tranzaksiya orqaga qaytadi
+    deadline = time.monotonic() + budget
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+    try:
+        return conn.execute(statement).fetchall()
+    except sqlite3.OperationalError as e:
+        if "interrupted" not in str(e):
+            raise
+        logger.warning("Texnik xizmat: '%s' %.1f s ichida tugamadi, to'xtatildi.", statement, budget)
+        return None
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def checkpoint_wal(conn, truncate=False):
+    # Odatda PASSIVE: hech kimni kutmaydi. WAL chegaradan oshgan bo'lsa TRUNCATE: faylni nolga qisqartiradi
+    wal_path = f"{DB_NAME}-wal"
+    wal_bytes = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    mode = "TRUNCATE" if truncate or wal_bytes > WAL_MAX_BYTES else "PASSIVE"
+    busy, log_frames, checkpointed_frames = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    metrics.inc("wal_checkpoints_total")
+    if busy:
+        metrics.inc("wal_checkpoints_busy_total")
+    return mode, wal_bytes, busy, log_frames, checkpointed_frames
+
+
+def run_database_maintenance(step_budget=MAINTENANCE_STEP_BUDGET):
+    # Alohida oqimda ishlaydi. Har bir qadam vaqt bilan cheklangan, vacuum kichik tranzaksiyalarga bo'lingan
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    try:
+        conn.execute(f"PRAGMA busy_timeout = {MAINTENANCE_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA journal_size_limit = {WAL_MAX_BYTES}")
+        before = database_file_stats(conn)
+        timings = {}
+
+        started = time.monotonic()
+        conn.execute(f"PRAGMA analysis_limit = {MAINTENANCE_ANALYSIS_LIMIT}")
+        if run_with_time_budget(conn, step_budget, "ANALYZE") is not None:
+            run_with_time_budget(conn, step_budget, "PRAGMA optimize")
+        timings["analyze"] = time.monotonic() - started
+
+        started = time.monotonic()
+        try:
+            checkpoint_wal(conn)
+        except sqlite3.OperationalError as e:
+            logger.warning("Texnik xizmat: WAL checkpoint bajarilmadi: %s", e)
+        timings["checkpoint"] = time.monotonic() - started
+
+        started = time.monotonic()
+        deadline = started + step_budget
+        freed = 0
+        free_pages = before["free_pages"]
+        while free_pages and time.monotonic() < deadline:
+            try:
+                # execute() pragmani bir marta "qadam"laydi va faqat bitta sahifa bo'shatiladi; executescript oxirigacha
+                conn.executescript(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})")
+            except sqlite3.OperationalError as e:
+                logger.warning("Texnik xizmat: incremental_vacuum to'xtatildi: %s", e)
+                break
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            freed += max(free_pages - remaining, 0)
+            free_pages = remaining
+            time.sleep(INCREMENTAL_VACUUM_PAUSE)
+        timings["vacuum"] = time.monotonic() - started
+        if freed:
+            # Vacuum yozuvlari WAL ga tushadi: ularni asosiy faylga o'tkazib, WAL ni qisqartiramiz
+            try:
+                checkpoint_wal(conn, truncate=True)
+            except sqlite3.OperationalError as e:
+                logger.warning("Texnik xizmat: WAL checkpoint bajarilmadi: %s", e)
+        return before, database_file_stats(conn), freed, timings
+    finally:
+        conn.close()
+
+
+async def database_maintenance_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    started_at = time.monotonic()
+    try:
+        before, after, freed, timings = await asyncio.to_thread(run_database_maintenance)
+    except sqlite3.Error as e:
+        metrics.inc("maintenance_failures_total")
+        logger.error("Bazaga texnik xizmat ko'rsatishda xatolik: %s", e)
+        return
+    duration = time.monotonic() - started_at
+    metrics.inc("maintenance_runs_total")
+    metrics.set("maintenance_last_duration_seconds", round(duration, 3))
+    metrics.set("maintenance_last_freed_pages", freed)
+    metrics.set("db_size_bytes", after["pages"] * after["page_size"])
+    logger.info("Texnik xizmat (%.2f s; analyze %.2f, checkpoint %.2f, vacuum %.2f): "
+                "sahifalar %s -> %s, bo'sh %s -> %s, WAL %s -> %s bayt.",
+                duration, timings["analyze"], timings["checkpoint"], timings["vacuum"],
+                before["pages"], after["pages"], before["free_pages"], after["free_pages"],
+                before["wal_bytes"], after["wal_bytes"])
+
+
+async def checkpoint_wal_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    def run():
+        conn = sqlite3.connect(DB_NAME, isolation_level=None)
+        try:
+            conn.execute(f"PRAGMA busy_timeout = {MAINTENANCE_BUSY_TIMEOUT_MS}")
+            conn.execute(f"PRAGMA journal_size_limit = {WAL_MAX_BYTES}")
+            return checkpoint_wal(conn)
+        finally:
+            conn.close()
+
+    try:
+        mode, wal_bytes, busy, log_frames, checkpointed_frames = await asyncio.to_thread(run)
+    except sqlite3.Error as e:
+        logger.warning("WAL checkpoint xatoligi: %s", e)
+        return
+    metrics.set("wal_size_bytes", wal_bytes)
+    if mode == "TRUNCATE" or busy:
+        logger.info("WAL checkpoint (%s): %s bayt, %s/%s kadr ko'chirildi%s.", mode, wal_bytes,
+                    checkpointed_frames, log_frames, ", o'quvchilar band" if busy else "")
+
+
+# --- Sales Rollups ---
+# Buyurtma narxi admin_view_orders dagi kabi aniqlanadi
+ORDER_PRICE_SQL = "COALESCE(o.product_price_at_order, p.price, 0)"
+ORDER_ITEM_AMOUNT_SQL = "COALESCE(i.product_price_at_order, p.price, 0) * i.quantity"
+SALES_PERIOD_FORMATS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+
+def record_order_in_rollups(conn, order_id, sign=1):
+    # Buyurtma yozilgan (yoki holati o'zgargan) tranzaksiya ichida chaqiriladi; sign=-1 buyurtmani yig'indilardan
+    # chiqaradi. first_order_at/last_order_at qayta hisoblanmaydi: ular faqat buyurtma qo'shilganda suriladi
+    user_id, product_id, product_name, price, timestamp, category_id = conn.execute(
+        f"SELECT o.user_id, o.product_id, COALESCE(o.product_name_at_order, p.name), {ORDER_PRICE_SQL}, "
+        f"o.timestamp, p.category_id FROM orders o LEFT JOIN products p ON o.product_id = p.id WHERE o.id = ?",
+        (order_id,)).fetchone()
+    # Mahsulot va kategoriya bo'yicha summalar buyurtma qatorlaridan; qatorsiz (eski) buyurtma o'zi bitta qator
+    lines = conn.execute(
+        f"SELECT i.product_id, COALESCE(i.product_name_at_order, p.name), {ORDER_ITEM_AMOUNT_SQL}, p.category_id "
+        f"FROM order_items i LEFT JOIN products p ON i.product_id = p.id WHERE i.order_id = ?", (order_id,)).fetchall() \
+        or [(product_id, product_name, price, category_id)]
+    product_revenue, product_names, category_revenue = collections.Counter(), {}, collections.Counter()
+    for line_product_id, line_product_name, amount, line_category_id in lines:
+        if line_product_id is not None:
+            product_revenue[line_product_id] += amount
+            product_names[line_product_id] = line_product_name
+        category_revenue[line_category_id or 0] += amount
+    conn.executemany(
+        "INSERT INTO sales_rollup (period, bucket, revenue, order_count) VALUES (?, strftime(?, ?), ?, ?) "
+        "ON CONFLICT (period, bucket) DO UPDATE SET revenue = revenue + excluded.revenue, "
+        "order_count = order_count + excluded.order_count",
+        [(period, fmt, timestamp, price * sign, sign) for period, fmt in SALES_PERIOD_FORMATS.items()])
+    conn.executemany(
+        "INSERT INTO sales_product_totals (product_id, product_name, revenue, order_count) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (product_id) DO UPDATE SET product_name = excluded.product_name, "
+        "revenue = revenue + excluded.revenue, order_count = order_count + excluded.order_count",
+        [(line_product_id, product_names[line_product_id], amount * sign, sign)
+         for line_product_id, amount in product_revenue.items()])
+    conn.executemany(
+        "INSERT INTO sales_category_totals (category_id, revenue, order_count) VALUES (?, ?, ?) "
+        "ON CONFLICT (category_id) DO UPDATE SET revenue = revenue + excluded.revenue, "
+        "order_count = order_count + excluded.order_count",
+        [(category_id, amount * sign, sign) for category_id, amount in category_revenue.items()])
+    customer_order_count = conn.execute(
+        "INSERT INTO sales_customer_totals (user_id, order_count, revenue, first_order_at, last_order_at) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET order_count = order_count + excluded.order_count, "
+        "revenue = revenue + excluded.revenue, "
+        "last_order_at = MAX(last_order_at, excluded.last_order_at) RETURNING order_count",
+        (user_id, sign, price * sign, timestamp, timestamp)).fetchone()[0]
+    # Mijoz birinchi/ikkinchi buyurtmasiga yetganda (yoki undan qaytganda) hisoblagich o'zgaradi
+    counter_name = {1: "customers", 2: "repeat_customers"}.get(customer_order_count if sign > 0
+                                                               else customer_order_count + 1)
+    if counter_name:
+        conn.execute("INSERT INTO sales_counters (name, value) VALUES (?, ?) "
+                     "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value", (counter_name, sign))
+
+
+def record_order_status_in_rollups(conn, order_id, previous, status):
+    # Bekor qilingan buyurtma statistikadan chiqariladi, bekor qilishdan qaytgani yana qo'shiladi
+    if status == "cancelled":
+        record_order_in_rollups(conn, order_id, -1)
+    elif previous == "cancelled":
+        record_order_in_rollups(conn, order_id)
+
+
+def backfill_sales_rollups():
+    # Bir martalik: mavjud buyurtmalar tarixidan yig'ma jadvallarni to'ldiradi
+    conn = db_connect()
+    try:
+        # v2: bekor qilingan buyurtmalarsiz; avvalgi to'ldirish bir marta qayta hisoblanadi
+        if conn.execute("SELECT 1 FROM app_meta WHERE key = 'sales_rollups_backfilled_v2'").fetchone():
+            return
+        started_at = datetime.now()
+        source = f"(SELECT * FROM {orders_source_sql()} WHERE status IS NOT 'cancelled')"
+        items_source = order_items_source_sql()
+        lines_source = (
+            f"(SELECT i.order_id, i.product_id, COALESCE(i.product_name_at_order, p.name) AS product_name, "
+            f"{ORDER_ITEM_AMOUNT_SQL} AS amount, p.category_id "
+            f"FROM {items_source} i JOIN {source} o ON o.id = i.order_id LEFT JOIN products p ON i.product_id = p.id "
+            f"UNION ALL "
+            f"SELECT o.id, o.product_id, COALESCE(o.product_name_at_order, p.name), {ORDER_PRICE_SQL}, p.category_id "
+            f"FROM {source} o LEFT JOIN products p ON o.product_id = p.id "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {items_source} i WHERE i.order_id = o.id))")
+        with conn:
+            for table in ("sales_rollup", "sales_product_totals", "sales_category_totals",
+                          "sales_customer_totals", "sales_counters"):
+                conn.execute(f"DELETE FROM {table}")
+            for period, fmt in SALES_PERIOD_FORMATS.items():
+                conn.execute(
+                    f"INSERT INTO sales_rollup (period, bucket, revenue, order_count) "
+                    f"SELECT ?, strftime(?, o.timestamp), SUM({ORDER_PRICE_SQL}), COUNT(*) "
+                    f"FROM {source} o LEFT JOIN products p ON o.product_id = p.id GROUP BY 2",
+                    (period, fmt))
+            conn.execute(
+                f"INSERT INTO sales_product_totals (product_id, product_name, revenue, order_count) "
+                f"SELECT l.product_id, MAX(l.product_name), SUM(l.amount), COUNT(DISTINCT l.order_id) "
+                f"FROM {lines_source} l WHERE l.product_id IS NOT NULL GROUP BY l.product_id")
+            conn.execute(
+                f"INSERT INTO sales_category_totals (category_id, revenue, order_count) "
+                f"SELECT COALESCE(l.category_id, 0), SUM(l.amount), COUNT(DISTINCT l.order_id) "
+                f"FROM {lines_source} l GROUP BY 1")
+            conn.execute(
+                f"INSERT INTO sales_customer_totals (user_id, order_count, revenue, first_order_at, last_order_at) "
+                f"SELECT o.user_id, COUNT(*), SUM({ORDER_PRICE_SQL}), MIN(o.timestamp), MAX(o.timestamp) "
+                f"FROM {source} o LEFT JOIN products p ON o.product_id = p.id GROUP BY o.user_id")
+            conn.execute("INSERT INTO sales_counters (name, value) "
+                         "SELECT 'customers', COUNT(*) FROM sales_customer_totals")
+            conn.execute("INSERT INTO sales_counters (name, value) "
+                         "SELECT 'repeat_customers', COUNT(*) FROM sales_customer_totals WHERE order_count >= 2")
+            conn.execute("INSERT INTO app_meta (key, value) VALUES ('sales_rollups_backfilled_v2', CURRENT_TIMESTAMP)")
+        logger.info("Statistika jadvallari buyurtmalar tarixidan to'ldirildi (%.2f s).",
+                    (datetime.now() - started_at).total_seconds())
+    finally:
+        conn.close()
+
+
+# --- Funnel Events ---
+FUNNEL_STAGE_CODES = {stage: code for code, stage in enumerate(FUNNEL_STAGES)}
+
+
+class FunnelEventBuffer:
+    # Cheklangan halqa bufer: record() faqat deque.append, bazaga tegmaydi. To'lganda eng eskisi tashlanadi
+    def __init__(self, capacity):
+        self._events = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def record(self, stage, user_id, subject_id=None):
+        if len(self._events) == self._events.maxlen:
+            self.dropped += 1
+        self._events.append((time.time(), FUNNEL_STAGE_CODES[stage], user_id, subject_id))
+
+    def drain(self, limit):
+        events = []
+        while self._events and len(events) < limit:
+            events.append(self._events.popleft())
+        return events
+
+    def __len__(self):
+        return len(self._events)
+
+
+funnel_events = FunnelEventBuffer(FUNNEL_BUFFER_SIZE)
+
+
+def write_funnel_events(events):
+    # Bitta tranzaksiya: xom hodisalar + soatlik yig'indilar (noyob foydalanuvchi soatiga bir marta sanaladi)
+    conn = db_connect()
+    try:
+        with conn:
+            conn.executemany("INSERT INTO funnel_events (created_at, stage, user_id, subject_id) VALUES (?, ?, ?, ?)",
+                             events)
+            event_counts, new_users = collections.Counter(), collections.Counter()
+            for created_at, stage, user_id, _ in events:
+                key = (time.strftime("%Y-%m-%d %H", time.gmtime(created_at)), stage)
+                event_counts[key] += 1
+                if conn.execute("INSERT OR IGNORE INTO funnel_hourly_users (bucket, stage, user_id) VALUES (?, ?, ?)",
+                                (*key, user_id)).rowcount:
+                    new_users[key] += 1
+            conn.executemany(
+                "INSERT INTO funnel_hourly (bucket, stage, events, users) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (bucket, stage) DO UPDATE SET events = events + excluded.events, "
+                "users = users + excluded.users",
+                [(bucket, stage, count, new_users[bucket, stage]) for (bucket, stage), count in event_counts.items()])
+    finally:
+        conn.close()
+
+
+def prune_funnel_events(retention_days=FUNNEL_EVENTS_RETENTION_DAYS):
+    cutoff = time.time() - retention_days * 24 * 60 * 60
+    conn = db_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM funnel_events WHERE created_at < ?", (cutoff,))
+            conn.execute("DELETE FROM funnel_hourly_users WHERE bucket < ?",
+                         (time.strftime("%Y-%m-%d %H", time.gmtime(cutoff)),))
+    finally:
+        conn.close()
+
+
+async def flush_funnel_events_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    written = 0
+    while True:
+        events = funnel_events.drain(FUNNEL_FLUSH_BATCH_SIZE)
+        if not events:
+            break
+        try:
+            write_funnel_events(events)
+        except sqlite3.Error as e:
+            metrics.inc("funnel_events_failed_total", len(events))
+            logger.error("Voronka hodisalarini yozishda xatolik (%s ta yo'qoldi): %s", len(events), e)
+            break
+        written += len(events)
+        await asyncio.sleep(0)
+    metrics.inc("funnel_events_written_total", written)
+    metrics.set("funnel_events_dropped_total", funnel_events.dropped)
+    metrics.set("funnel_buffer_size", len(funnel_events))
+
+
+async def prune_funnel_events_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        prune_funnel_events()
+    except sqlite3.Error as e:
+        logger.error("Eski voronka hodisalarini o'chirishda xatolik: %s", e)
+
+
+def fetch_funnel_report(days):
+    since = time.strftime("%Y-%m-%d %H", time.gmtime(time.time() - days * 24 * 60 * 60))
+    totals = {stage: (events, users) for stage, events, users in db_fetch_all(
+        "SELECT stage, SUM(events), SUM(users) FROM funnel_hourly WHERE bucket >= ? GROUP BY stage", (since,))}
+    return [(stage, *totals.get(code, (0, 0))) for code, stage in enumerate(FUNNEL_STAGES)]
+
+
+# --- Recommendations ---
+# product_id -> ((tavsiya_id, nomi), ...); karta ko'rsatishda faqat shu lug'atdan o'qiladi
+product_recommendations = {}
+
+
+def refresh_recommendations_batch(batch_size=RECOMMENDATIONS_BATCH_SIZE):
+    # Faqat oxirgi qayta ishlangan buyurtmadan keyingilar. Juftlik bitta mijoz uchun bir marta sanaladi:
+    # mahsulot mijoz savatiga birinchi marta tushganda uning savatdagi har bir mahsuloti bilan +1.
+    last_order_id = int(get_app_meta("recommendations_last_order_id", 0))
+    source, items_source = orders_source_sql(last_order_id), order_items_source_sql(last_order_id)
+    conn = db_connect()
+    try:
+        with conn:
+            upper_id = conn.execute(f"SELECT MAX(id) FROM (SELECT id FROM {source} WHERE id > ? ORDER BY id LIMIT ?)",
+                                    (last_order_id, batch_size)).fetchone()[0]
+            if upper_id is None:
+                return 0, set()
+            lines = conn.execute(
+                f"SELECT o.user_id, i.product_id, MIN(o.id) FROM {source} o JOIN {items_source} i ON i.order_id = o.id "
+                f"WHERE o.id > ? AND o.id <= ? AND i.product_id IS NOT NULL GROUP BY 1, 2 "
+                f"UNION ALL "
+                f"SELECT o.user_id, o.product_id, MIN(o.id) FROM {source} o WHERE o.id > ? AND o.id <= ? "
+                f"AND o.product_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM {items_source} i WHERE i.order_id = o.id) "
+                f"GROUP BY 1, 2 ORDER BY 3",
+                (last_order_id, upper_id, last_order_id, upper_id)).fetchall()
+            touched = set()
+            for user_id, product_id, _ in lines:
+                if not conn.execute("INSERT OR IGNORE INTO recommendation_baskets (user_id, product_id) VALUES (?, ?)",
+                                    (user_id, product_id)).rowcount:
+                    continue
+                others = [row[0] for row in conn.execute(
+                    "SELECT product_id FROM recommendation_baskets WHERE user_id = ? AND product_id != ?",
+                    (user_id, product_id))]
+                conn.executemany(
+                    "INSERT INTO product_cooccurrence (product_id, other_product_id, score) VALUES (?, ?, 1) "
+                    "ON CONFLICT (product_id, other_product_id) DO UPDATE SET score = score + 1",
+                    [pair for other_id in others for pair in ((product_id, other_id), (other_id, product_id))])
+                if others:
+                    touched.add(product_id)
+                    touched.update(others)
+            for product_id in touched:
+                conn.execute("DELETE FROM product_recommendations WHERE product_id = ?", (product_id,))
+                conn.execute(
+                    "INSERT INTO product_recommendations (product_id, rank, recommended_product_id, score) "
+                    "SELECT ?, ROW_NUMBER() OVER (ORDER BY score DESC, other_product_id), other_product_id, score "
+                    "FROM (SELECT other_product_id, score FROM product_cooccurrence WHERE product_id = ? "
+                    "ORDER BY score DESC, other_product_id LIMIT ?)",
+                    (product_id, product_id, RECOMMENDATIONS_TOP_K))
+            conn.execute("INSERT INTO app_meta (key, value) VALUES ('recommendations_last_order_id', ?) "
+                         "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (str(upper_id),))
+        return upper_id - last_order_id, touched
+    finally:
+        conn.close()
+
+
+def load_product_recommendations():
+    # O'chirilgan mahsulotlar JOIN orqali tushib qoladi, nomlar esa har yuklashda yangilanadi
+    recommendations = collections.defaultdict(list)
+    for product_id, recommended_id, name in db_fetch_all(
+            "SELECT r.product_id, r.recommended_product_id, p.name FROM product_recommendations r "
+            "JOIN products p ON p.id = r.recommended_product_id ORDER BY r.product_id, r.rank"):
+        recommendations[product_id].append((recommended_id, name))
+    product_recommendations.clear()
+    product_recommendations.update((product_id, tuple(items)) for product_id, items in recommendations.items())
+    metrics.set("recommendations_products", len(product_recommendations))
+
+
+async def refresh_recommendations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    started_at = time.monotonic()
+    processed, touched = 0, set()
+    while True:
+        try:
+            batch_processed, batch_touched = refresh_recommendations_batch()
+        except sqlite3.Error as e:
+            logger.error("Tavsiyalarni yangilashda xatolik: %s", e)
+            break
+        processed += batch_processed
+        touched |= batch_touched
+        if not batch_processed:
+            break
+        await asyncio.sleep(RECOMMENDATIONS_BATCH_PAUSE)
+    load_product_recommendations()
+    if touched:
+        logger.info("Tavsiyalar yangilandi: %s ta yangi buyurtma, %s ta mahsulot qayta hisoblandi (%.2f s).",
+                    processed, len(touched), time.monotonic() - started_at)
+
+
+# --- Storage ---
+# Katalog, savat, buyurtma va foydalanuvchi handlerlari shu omborlar orqali ishlaydi. Import, ommaviy amallar,
+# e'lonlar, statistika, tavsiyalar, voronka, arxiv va zaxira nusxa SQLite'ga xos bo'lib qoladi va to'g'ridan-to'g'ri
+# DB_NAME bilan ishlaydi, shuning uchun bot faqat "sqlite" bilan ishga tushadi (main); "memory" - test va bench uchun.
+repos = open_repositories(STORAGE_BACKEND, DB_NAME, on_order_created=record_order_in_rollups,
+                          on_order_status_changed=record_order_status_in_rollups,
+                          recent_orders_source=recent_orders_source_sql)
+
+
+async def release_expired_reservations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    released = repos.products.release_expired_reservations()
+    if released:
+        metrics.inc("stock_reservations_expired_total", released)
+        logger.info("Muddati o'tgan %s ta bron bekor qilindi, donalar zaxiraga qaytarildi.", released)
+
+
+# --- Broadcast ---
+class BroadcastRateLimiter:
+    # Barcha yuborishlar uchun umumiy tezlik chegarasi (Telegram: ~30 xabar/soniya)
+    def __init__(self, rate_per_second):
+        self.interval = 1.0 / rate_per_second
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+broadcast_rate_limiter = BroadcastRateLimiter(BROADCAST_RATE_PER_SECOND)
+broadcast_tasks = {}
+
+
+def broadcast_segment_sql(segment):
+    if segment == "buyers":
+        return "AND id IN (SELECT user_id FROM sales_customer_totals)"
+    if segment == "nonbuyers":
+        return "AND id NOT IN (SELECT user_id FROM sales_customer_totals)"
+    return ""
+
+
+def count_broadcast_recipients(segment, after_user_id=0):
+    return db_fetch_one(f"SELECT COUNT(*) FROM users WHERE id > ? AND is_blocked = 0 {broadcast_segment_sql(segment)}",
+                        (after_user_id,))[0]
+
+
+def fetch_broadcast_recipients(segment, after_user_id, limit=BROADCAST_BATCH_SIZE):
+    # Keyset sahifalash: OFFSET ishlatilmaydi, qayta ishga tushganda last_user_id dan davom etadi
+    rows = db_fetch_all(
+        f"SELECT id FROM users WHERE id > ? AND is_blocked = 0 {broadcast_segment_sql(segment)} ORDER BY id LIMIT ?",
+        (after_user_id, limit))
+    return [row[0] for row in rows]
+
+
+def save_broadcast_checkpoint(broadcast_id, last_user_id, sent, failed, blocked_ids):
+    conn = db_connect()
+    try:
+        with conn:
+            if blocked_ids:
+                conn.executemany("UPDATE users SET is_blocked = 1 WHERE id = ?", [(uid,) for uid in blocked_ids])
+            conn.execute(
+                "UPDATE broadcasts SET last_user_id = ?, sent_count = sent_count + ?, failed_count = failed_count + ?, "
+                "blocked_count = blocked_count + ? WHERE id = ?",
+                (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+    finally:
+        conn.close()
+
+
+def build_broadcast_content(kind, text, product_id):
+    if kind != "product":
+        return {"text": text, "photo": None, "reply_markup": None}
+    product = repos.products.get(product_id)
+    if not product:
+        return None
+    _, name, description, price, image_file_id, _, _ = product
+    caption = f"<b>{name}</b>\n"
+    if description: caption += f"<i>{description}</i>\n"
+    caption += f"\nNarxi: <b>{format_money(price)} so'm</b>"
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🛍️ Sotib olish", callback_data=pack_callback("buy", product_id))]])
+    return {"text": caption, "photo": image_file_id, "reply_markup": reply_markup}
+
+
+async def send_broadcast_message(bot, user_id, content, semaphore):
+    async with semaphore:
+        for _ in range(BROADCAST_MAX_ATTEMPTS):
+            await broadcast_rate_limiter.wait()
+            try:
+                if content["photo"]:
+                    await bot.send_photo(chat_id=user_id, photo=content["photo"], caption=content["text"],
+                                         reply_markup=content["reply_markup"], parse_mode='HTML')
+                else:
+                    await bot.send_message(chat_id=user_id, text=content["text"],
+                                           reply_markup=content["reply_markup"], parse_mode='HTML')
+                return "sent"
+            except telegram.error.RetryAfter as e:
+                logger.warning("Broadcast: flood limit, %s soniya kutiladi.", e.retry_after)
+                broadcast_rate_limiter.pause(e.retry_after)
+            except telegram.error.Forbidden:
+                return "blocked"
+            except (telegram.error.TimedOut, telegram.error.NetworkError):
+                await asyncio.sleep(1)
+            except telegram.error.TelegramError as e:
+                logger.debug("Broadcast: %s ga yuborilmadi: %s", user_id, e)
+                return "failed"
+        return "failed"
+
+
+def format_broadcast_progress(status, sent, failed, blocked, total, rate):
+    titles = {"running": "📣 Xabar yuborilmoqda...", "done": "✅ Xabar yuborish yakunlandi.",
+              "cancelled": "⏹ Xabar yuborish to'xtatildi.", "error": "❗️ Xabar yuborish xatolik bilan to'xtadi."}
+    return (f"{titles[status]}\n\n"
+            f"Yuborildi: {sent}\n"
+            f"Botni bloklaganlar: {blocked}\n"
+            f"Xatolar: {failed}\n"
+            f"Qolgan (taxminan): {max(total, 0)}\n"
+            f"Tezlik: {rate:.1f} xabar/soniya")
+
+
+async def report_broadcast_progress(bot, broadcast_id, chat_id, message_id, text, running):
+    reply_markup = None
+    if running:
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton("⏹ To'xtatish", callback_data=pack_callback("admin_broadcast_stop", broadcast_id))]])
+    try:
+        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=reply_markup)
+    except telegram.error.TelegramError as e:
+        logger.debug("Broadcast #%s: progress xabarini yangilab bo'lmadi: %s", broadcast_id, e)
+
+
+async def run_broadcast(bot, broadcast_id):
+    (kind, text, product_id, segment, last_user_id, sent, failed, blocked,
+     admin_chat_id, progress_message_id) = db_fetch_one(
+        "SELECT kind, text, product_id, segment, last_user_id, sent_count, failed_count, blocked_count, "
+        "admin_chat_id, progress_message_id FROM broadcasts WHERE id = ?", (broadcast_id,))
+    content = build_broadcast_content(kind, text, product_id)
+    final_status = "done"
+    started_at = time.monotonic()
+    sent_this_run = 0
+    last_report_at = started_at
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    logger.info("Broadcast #%s boshlandi (segment=%s, davom etish nuqtasi: user_id > %s)",
+                broadcast_id, segment, last_user_id)
+    try:
+        if content is None:
+            raise ValueError(f"mahsulot topilmadi (ID: {product_id})")
+        while True:
+            status = db_fetch_one("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,))[0]
+            if status != "running":
+                final_status = status
+                break
+            recipients = fetch_broadcast_recipients(segment, last_user_id)
+            if not recipients:
+                break
+            results = await asyncio.gather(
+                *(send_broadcast_message(bot, user_id, content, semaphore) for user_id in recipients))
+            blocked_ids = [user_id for user_id, result in zip(recipients, results) if result == "blocked"]
+            batch_sent = results.count("sent")
+            batch_failed = results.count("failed")
+            last_user_id = recipients[-1]
+            save_broadcast_checkpoint(broadcast_id, last_user_id, batch_sent, batch_failed, blocked_ids)
+            sent, failed, blocked = sent + batch_sent, failed + batch_failed, blocked + len(blocked_ids)
+            sent_this_run += batch_sent
+
+            now = time.monotonic()
+            if admin_chat_id and progress_message_id and now - last_report_at >= BROADCAST_PROGRESS_INTERVAL:
+                last_report_at = now
+                remaining = count_broadcast_recipients(segment, after_user_id=last_user_id)
+                await report_broadcast_progress(
+                    bot, broadcast_id, admin_chat_id, progress_message_id,
+                    format_broadcast_progress("running", sent, failed, blocked, remaining,
+                                              sent_this_run / (now - started_at)), running=True)
+    except Exception as e:
+        logger.error("Broadcast #%s xatolik bilan to'xtadi: %s", broadcast_id, e)
+        final_status = "error"
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+
+    db_query("UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+             (final_status, broadcast_id))
+    elapsed = time.monotonic() - started_at
+    rate = sent_this_run / elapsed if elapsed > 0 else 0
+    logger.info("Broadcast #%s tugadi (%s): yuborildi=%s, xato=%s, bloklangan=%s, %.1f xabar/s",
+                broadcast_id, final_status, sent, failed, blocked, rate)
+    if admin_chat_id and progress_message_id:
+        await report_broadcast_progress(bot, broadcast_id, admin_chat_id, progress_message_id,
+                                        format_broadcast_progress(final_status, sent, failed, blocked, 0, rate),
+                                        running=False)
+
+
+def start_broadcast_task(application, broadcast_id):
+    if broadcast_id in broadcast_tasks:
+        return
+    broadcast_tasks[broadcast_id] = application.create_task(run_broadcast(application.bot, broadcast_id),
+                                                            name=f"broadcast_{broadcast_id}")
+
+
+def resume_broadcasts(application):
+    for (broadcast_id,) in db_fetch_all("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"):
+        logger.info("Broadcast #%s qayta ishga tushirilmoqda (oldingi checkpointdan).", broadcast_id)
+        start_broadcast_task(application, broadcast_id)
+
+
 # --- Helpers ---
 def is_admin(update: Update) -> bool:
     if not update.effective_user:
@@ -205,24 +1627,29 @@ def is_admin(update: Update) -> bool:
     return update.effective_user.id == ADMIN_ID
 
 
+async def reject_non_admin_callback(update: Update) -> None:
+    logger.warning("Admin bo'lmagan foydalanuvchi (%s) admin callback yubordi: %s",
+                   update.effective_user.id if update.effective_user else None, update.callback_query.data)
+    await update.callback_query.answer("Sizda bu amal uchun ruxsat yo'q.", show_alert=True)
+
+
+def admin_conversation_entry(handler):
+    # Conversation kirish nuqtalari router'dan o'tmaydi: soxta callback_data bilan kirishni shu yerda to'xtatamiz
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not is_admin(update):
+            await reject_non_admin_callback(update)
+            return ConversationHandler.END
+        return await handler(update, context)
+    return wrapper
+
+
 async def save_user_info(user_obj):
     if not user_obj: return
     try:
-        db_query(
-            "INSERT OR IGNORE INTO users (id, first_name, last_name, username) VALUES (?, ?, ?, ?)",
-            (user_obj.id, user_obj.first_name, user_obj.last_name, user_obj.username)
-        )
-        current_db_user = db_fetch_one("SELECT first_name, last_name, username FROM users WHERE id = ?", (user_obj.id,))
-        if current_db_user and \
-                (current_db_user[0] != user_obj.first_name or \
-                 current_db_user[1] != user_obj.last_name or \
-                 (current_db_user[2] != user_obj.username and user_obj.username is not None)):
-            db_query(
-                "UPDATE users SET first_name = ?, last_name = ?, username = ? WHERE id = ?",
-                (user_obj.first_name, user_obj.last_name, user_obj.username, user_obj.id)
-            )
+        repos.users.save(user_obj.id, user_obj.first_name, user_obj.last_name, user_obj.username)
     except Exception as e:
-        logger.error(f"Foydalanuvchi ma'lumotlarini saqlashda xatolik ({user_obj.id if user_obj else 'N/A'}): {e}")
+        logger.error("Foydalanuvchi ma'lumotlarini saqlashda xatolik (%s): %s", user_obj.id, e)
 
 
 async def send_or_edit_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str,
@@ -231,40 +1658,40 @@ async def send_or_edit_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
     if delete_previous and message_id_to_edit:
         try:
             await context.bot.delete_message(chat_id=chat_id, message_id=message_id_to_edit)
-            logger.debug(f"Oldindan mavjud xabar (ID: {message_id_to_edit}) o'chirildi.")
+            messages_logger.debug("Oldindan mavjud xabar (ID: %s) o'chirildi.", message_id_to_edit)
             message_id_to_edit = None
         except telegram.error.BadRequest:
-            logger.debug(f"Oldindan mavjud xabar (ID: {message_id_to_edit}) o'chirilmadi (ehtimol allaqachon yo'q).")
+            messages_logger.debug("Oldindan mavjud xabar (ID: %s) o'chirilmadi (ehtimol allaqachon yo'q).", message_id_to_edit)
             message_id_to_edit = None
         except Exception as e_del:
-            logger.warning(f"Oldindan mavjud xabarni o'chirishda xatolik: {e_del}")
+            messages_logger.warning("Oldindan mavjud xabarni o'chirishda xatolik: %s", e_del)
             pass
 
     try:
         if message_id_to_edit:
             if photo_file_id:
-                logger.debug(
-                    f"Xabarni (ID: {message_id_to_edit}) rasm bilan tahrirlash: photo={photo_file_id}, caption={text[:30]}...")
+                messages_logger.debug("Xabarni (ID: %s) rasm bilan tahrirlash: photo=%s, caption=%.30s...",
+                                      message_id_to_edit, photo_file_id, text)
                 await context.bot.edit_message_media(
                     chat_id=chat_id, message_id=message_id_to_edit,
                     media=InputMediaPhoto(media=photo_file_id, caption=text, parse_mode=parse_mode),
                     reply_markup=reply_markup
                 )
             else:
-                logger.debug(f"Xabarni (ID: {message_id_to_edit}) matn bilan tahrirlash: text={text[:30]}...")
+                messages_logger.debug("Xabarni (ID: %s) matn bilan tahrirlash: text=%.30s...", message_id_to_edit, text)
                 await context.bot.edit_message_text(
                     chat_id=chat_id, message_id=message_id_to_edit, text=text,
                     reply_markup=reply_markup, parse_mode=parse_mode
                 )
         else:
             if photo_file_id:
-                logger.debug(f"Yangi xabarni rasm bilan yuborish: photo={photo_file_id}, caption={text[:30]}...")
+                messages_logger.debug("Yangi xabarni rasm bilan yuborish: photo=%s, caption=%.30s...", photo_file_id, text)
                 await context.bot.send_photo(
                     chat_id=chat_id, photo=photo_file_id, caption=text,
                     reply_markup=reply_markup, parse_mode=parse_mode
                 )
             else:
-                logger.debug(f"Yangi xabarni matn bilan yuborish: text={text[:30]}...")
+                messages_logger.debug("Yangi xabarni matn bilan yuborish: text=%.30s...", text)
                 await context.bot.send_message(
                     chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode
                 )
@@ -272,49 +1699,244 @@ async def send_or_edit_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int,
         if "message to edit not found" in str(e).lower() or \
                 "message can't be edited" in str(e).lower() or \
                 "there is no text in the message to edit" in str(e).lower():
-            logger.warning(f"Xabarni tahrirlab bo'lmadi ({e}), yangisi yuboriladi.")
-            if photo_file_id:
-                await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=text,
-                                             reply_markup=reply_markup, parse_mode=parse_mode)
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup,
-                                               parse_mode=parse_mode)
+            messages_logger.warning("Xabarni tahrirlab bo'lmadi (%s), yangisi yuboriladi.", e)
+            with tracing.span("send_fallback", reason="edit_failed"):
+                if photo_file_id:
+                    await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=text,
+                                                 reply_markup=reply_markup, parse_mode=parse_mode)
+                else:
+                    await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup,
+                                                   parse_mode=parse_mode)
         elif "message is not modified" in str(e).lower():
-            logger.debug(f"Xabar o'zgartirilmadi (message is not modified): {text[:30]}")
+            messages_logger.debug("Xabar o'zgartirilmadi (message is not modified): %.30s", text)
             pass
         else:
-            logger.error(f"send_or_edit_message da (BadRequest): {e} - Text: {text[:100]}")
+            messages_logger.error("send_or_edit_message da (BadRequest): %s - Text: %.100s", e, text)
             final_text = text + ("\n(Xabarni yangilashda muammo yuz berdi)" if message_id_to_edit else "")
-            if photo_file_id:
-                await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=final_text,
-                                             reply_markup=reply_markup, parse_mode=parse_mode)
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=final_text, reply_markup=reply_markup,
-                                               parse_mode=parse_mode)
+            with tracing.span("send_fallback", reason="bad_request"):
+                if photo_file_id:
+                    await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=final_text,
+                                                 reply_markup=reply_markup, parse_mode=parse_mode)
+                else:
+                    await context.bot.send_message(chat_id=chat_id, text=final_text, reply_markup=reply_markup,
+                                                   parse_mode=parse_mode)
     except Exception as e:
-        logger.error(f"send_or_edit_message da kutilmagan xatolik: {e} (Text: {text[:50]})")
+        messages_logger.error("send_or_edit_message da kutilmagan xatolik: %s (Text: %.50s)", e, text)
         final_text = text + ("\n(Xabarni yangilashda jiddiy muammo yuz berdi)" if message_id_to_edit else "")
         try:
-            if photo_file_id:
-                await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=final_text,
-                                             reply_markup=reply_markup, parse_mode=parse_mode)
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=final_text, reply_markup=reply_markup,
-                                               parse_mode=parse_mode)
+            with tracing.span("send_fallback", reason="unexpected_error"):
+                if photo_file_id:
+                    await context.bot.send_photo(chat_id=chat_id, photo=photo_file_id, caption=final_text,
+                                                 reply_markup=reply_markup, parse_mode=parse_mode)
+                else:
+                    await context.bot.send_message(chat_id=chat_id, text=final_text, reply_markup=reply_markup,
+                                                   parse_mode=parse_mode)
         except Exception as e_fallback:
-            logger.critical(f"send_or_edit_message da YAKUNIY fallback xatoligi: {e_fallback}")
+            messages_logger.critical("send_or_edit_message da YAKUNIY fallback xatoligi: %s", e_fallback)
+
+
+# --- Callback Data Codec ---
+# callback_data = "#" + base64url(versiya, amal kodi, argumentlar). Telegram chegarasi: 64 bayt.
+# Argumentlar: 0 = None, 1 = butun son (zigzag varint), 2 = qisqa matn (uzunlik + UTF-8).
+# DIQQAT: CALLBACK_ACTIONS ga faqat oxiridan qo'shing, aks holda eski tugmalar noto'g'ri o'qiladi.
+CALLBACK_ACTIONS = (
+    "view_categories", "category", "next_product", "prev_product", "buy", "main_menu",
+    "admin_panel", "admin_manage_categories", "admin_add_category_prompt", "admin_edit_cat_prompt",
+    "admin_delete_cat_confirm", "admin_delete_cat_execute", "admin_add_product_start",
+    "admin_manage_products_list", "admin_view_prod", "admin_edit_prod_field", "admin_edit_price_entry",
+    "admin_delete_prod_confirm", "admin_delete_prod_execute", "admin_view_orders", "admin_noop",
+    "admin_cancel_conv", "prodcat", "prod_setcat", "admin_import_catalog_start", "admin_import_mode",
+    "admin_bulk_start", "bulk_op", "bulk_src", "bulk_dst", "bulk_confirm", "admin_analytics",
+    "admin_broadcast_start", "admin_broadcast_product", "admin_broadcast_stop", "bc_seg", "bc_confirm",
+    "cart_add", "cart_remove", "cart_view", "cart_item_remove", "cart_clear", "cart_checkout",
+    "related_product", "admin_order_queue", "admin_order", "admin_order_status", "my_orders",
+    "admin_price_history", "admin_funnel", "admin_share_link",
+)
+CALLBACK_ACTION_CODES = {action: code for code, action in enumerate(CALLBACK_ACTIONS)}
+CALLBACK_DATA_MARKER = "#"
+CALLBACK_DATA_MAX_BYTES = 64
+
+
+def _pack_varint(value, out):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _unpack_varint(raw, pos):
+    result = shift = 0
+    while True:
+        byte = raw[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def pack_callback(action, *args):
+    out = bytearray((CALLBACK_CODEC_VERSION, CALLBACK_ACTION_CODES[action]))
+    for arg in args:
+        if arg is None:
+            out.append(0)
+        elif isinstance(arg, int):
+            out.append(1)
+            _pack_varint((arg << 1) if arg >= 0 else ((-arg << 1) - 1), out)
+        else:
+            encoded = str(arg).encode("utf-8")
+            out.append(2)
+            _pack_varint(len(encoded), out)
+            out += encoded
+    data = CALLBACK_DATA_MARKER + base64.urlsafe_b64encode(out).rstrip(b"=").decode("ascii")
+    if len(data) > CALLBACK_DATA_MAX_BYTES:
+        raise ValueError(f"callback_data {CALLBACK_DATA_MAX_BYTES} baytdan uzun: {action} {args}")
+    return data
+
+
+def _parse_legacy_callback(data):
+    # Kodek'dan oldingi tugmalar (masalan, "category_5", "admin_view_prod_12") hali chatlarda qolgan
+    if data in CALLBACK_ACTION_CODES:
+        return data, ()
+    prefix, separator, raw_arg = data.rpartition("_")
+    if not separator or prefix not in CALLBACK_ACTION_CODES:
+        return None, ()
+    if raw_arg.isdigit():
+        return prefix, (int(raw_arg),)
+    return prefix, (None if raw_arg == "None" else raw_arg,)
+
+
+@functools.lru_cache(maxsize=CALLBACK_DECODE_CACHE_SIZE)
+def unpack_callback(data):
+    # Natija keshlanadi: bitta update uchun bir necha marta chaqirilsa ham faqat bir marta dekodlanadi
+    if not data or data[0] != CALLBACK_DATA_MARKER:
+        return _parse_legacy_callback(data or "")
+    try:
+        # base64.urlsafe_b64decode dan ~2 barobar tez
+        raw = binascii.a2b_base64(data[1:].replace("-", "+").replace("_", "/") + "=" * (-(len(data) - 1) % 4))
+        if raw[0] != CALLBACK_CODEC_VERSION:
+            return None, ()
+        action = CALLBACK_ACTIONS[raw[1]]
+        args = []
+        pos = 2
+        while pos < len(raw):
+            tag = raw[pos]
+            pos += 1
+            if tag == 0:
+                args.append(None)
+            elif tag == 1:
+                value = raw[pos]
+                if value < 0x80:
+                    pos += 1
+                else:
+                    value, pos = _unpack_varint(raw, pos)
+                args.append((value >> 1) if not value & 1 else -((value + 1) >> 1))
+            else:
+                length, pos = _unpack_varint(raw, pos)
+                args.append(raw[pos:pos + length].decode("utf-8"))
+                pos += length
+        return action, tuple(args)
+    except (binascii.Error, ValueError, IndexError, UnicodeDecodeError):
+        return None, ()
+
+
+def get_callback_args(query):
+    return unpack_callback(query.data)[1]
+
+
+def callback_action(*actions):
+    # ConversationHandler ichidagi CallbackQueryHandler'lar uchun pattern
+    actions = frozenset(actions)
+    return lambda data: isinstance(data, str) and unpack_callback(data)[0] in actions
+
+
+class CallbackPayloadStore:
+    # 64 baytga sig'maydigan ma'lumotlar (ro'yxatlar, kursorlar, filtrlar) uchun cheklangan LRU ombor.
+    # Tugmada faqat qisqa token saqlanadi. key berilsa (masalan, kategoriya), bir xil ma'lumot uchun
+    # barcha foydalanuvchilar bitta tokenni bo'lishadi: har bir ochilish ombordan joy olmaydi.
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = collections.OrderedDict()  # token -> (key, payload)
+        self._tokens_by_key = {}
+        # Qayta ishga tushgandan keyin eski tokenlar yangi ma'lumotlarga mos kelib qolmasligi uchun
+        self._next_token = random.randrange(1 << 20, 1 << 30)
+
+    def put(self, payload, key=None):
+        if key is not None:
+            token = self._tokens_by_key.get(key)
+            if token is not None and self._items[token][1] == payload:
+                self._items.move_to_end(token)
+                return token
+        token = self._next_token
+        self._next_token += 1
+        self._items[token] = (key, payload)
+        if key is not None:
+            self._tokens_by_key[key] = token
+        if len(self._items) > self.max_items:
+            evicted_token, (evicted_key, _) = self._items.popitem(last=False)
+            if evicted_key is not None and self._tokens_by_key.get(evicted_key) == evicted_token:
+                del self._tokens_by_key[evicted_key]
+        return token
+
+    def get(self, token):
+        item = self._items.get(token)
+        if item is None:
+            return None
+        self._items.move_to_end(token)
+        return item[1]
+
+    def __len__(self):
+        return len(self._items)
+
+
+callback_payloads = CallbackPayloadStore(CALLBACK_PAYLOAD_STORE_SIZE)
 
 
 # --- User handlers ---
+def build_main_menu_keyboard(user_id):
+    keyboard = [[InlineKeyboardButton("🛍️ Mahsulotlarni ko'rish", callback_data=pack_callback("view_categories"))],
+                [InlineKeyboardButton("📦 Buyurtmalarim", callback_data=pack_callback("my_orders"))]]
+    if user_id == ADMIN_ID:
+        keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data=pack_callback("admin_panel"))])
+    return keyboard
+
+
+def build_start_link(bot_username, kind, target_id):
+    return f"https://t.me/{bot_username}?start={kind}_{target_id}"
+
+
+async def open_start_payload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # Reklama havolasi: kategoriyalar va varaqlashni chetlab, kartani bitta so'rovda ochamiz
+    match = START_PAYLOAD_RE.fullmatch(context.args[0])
+    if not match:
+        return False
+    kind, target_id = match[1], int(match[2])
+    if kind == "p":
+        # Bitta mahsulotdan iborat ro'yxat (show_related_product kabi): kategoriyani yuklash shart emas
+        product = repos.products.get(target_id)
+        products = [(product[0], product[1], product[3], product[4], product[2])] if product else []
+    else:
+        products = load_category_products(target_id)
+    if not products:
+        metrics.inc("deep_link_misses_total")
+        await update.message.reply_text("Havoladagi mahsulot endi mavjud emas." if kind == "p"
+                                        else "Havoladagi kategoriya endi mavjud emas yoki unda mahsulotlar yo'q.")
+        return False
+    metrics.inc("deep_link_opens_total")
+    funnel_events.record("product" if kind == "p" else "category", update.effective_user.id, target_id)
+    start_browsing_category(context, target_id if kind == "c" else None, products)
+    await display_product(update, context, update.message.chat_id)
+    return True
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     await save_user_info(user)
+    if update.message and context.args and await open_start_payload(update, context):
+        return
     welcome_text = (f"Assalomu alaykum, {user.mention_html()}!\n"
                     f"Zargarlik buyumlari do'konimizga xush kelibsiz!")
-    keyboard = [[InlineKeyboardButton("🛍️ Mahsulotlarni ko'rish", callback_data="view_categories")]]
-    if is_admin(update):
-        keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data="admin_panel")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = InlineKeyboardMarkup(build_main_menu_keyboard(user.id))
 
     if update.message:
         await update.message.reply_html(welcome_text, reply_markup=reply_markup)
@@ -327,37 +1949,76 @@ async def view_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     await query.answer()
     await save_user_info(query.from_user)
-    categories = db_fetch_all("SELECT id, name FROM categories ORDER BY name")
+    funnel_events.record("categories", query.from_user.id)
+    categories = repos.categories.list()
     text_to_send = "Quyidagi kategoriyalardan birini tanlang:"
     if not categories:
         text_to_send = "Hozircha kategoriyalar mavjud emas."
-        keyboard_buttons = [[InlineKeyboardButton("⬅️ Orqaga (Bosh menyu)", callback_data="main_menu")]]
+        keyboard_buttons = [[InlineKeyboardButton("⬅️ Orqaga (Bosh menyu)", callback_data=pack_callback("main_menu"))]]
     else:
-        keyboard_buttons = [[InlineKeyboardButton(cat_name, callback_data=f"category_{cat_id}")] for cat_id, cat_name in
+        keyboard_buttons = [[InlineKeyboardButton(cat_name, callback_data=pack_callback("category", cat_id))] for cat_id, cat_name in
                             categories]
-        keyboard_buttons.append([InlineKeyboardButton("⬅️ Orqaga (Bosh menyu)", callback_data="main_menu")])
+        if context.user_data.get('cart'):
+            keyboard_buttons.append([InlineKeyboardButton(f"🧺 Savat ({sum(context.user_data['cart'].values())} ta)",
+                                                          callback_data=pack_callback("cart_view"))])
+        keyboard_buttons.append([InlineKeyboardButton("⬅️ Orqaga (Bosh menyu)", callback_data=pack_callback("main_menu"))])
     reply_markup = InlineKeyboardMarkup(keyboard_buttons)
     await send_or_edit_message(context, query.message.chat_id, text_to_send, reply_markup, query.message.message_id,
                                delete_previous=True)
 
 
+def load_category_products(category_id):
+    return repos.products.list_by_category(category_id)
+
+
+def start_browsing_category(context: ContextTypes.DEFAULT_TYPE, category_id, products):
+    # Mahsulotlar ro'yxati user_data da emas, umumiy LRU omborda; sessiyada faqat token va indeks
+    context.user_data['current_category_id'] = category_id
+    context.user_data['current_product_index'] = 0
+    context.user_data.pop('replaced_products_token', None)
+    context.user_data['products_token'] = callback_payloads.put(
+        products, key=None if category_id is None else ("category", category_id)) if products else None
+
+
+def get_browsing_products(context: ContextTypes.DEFAULT_TYPE):
+    token = context.user_data.get('products_token')
+    products = callback_payloads.get(token) if token else None
+    if products is None and context.user_data.get('current_category_id') is not None:
+        # Ro'yxat ombordan chiqib ketgan: bazadan qayta yuklaymiz. Eski token'li tugmalar hali chatda turibdi,
+        # sync_browsing_state ularni shu ro'yxatniki deb biladi va joriy indeksni saqlab qoladi
+        category_id = context.user_data['current_category_id']
+        products = load_category_products(category_id)
+        context.user_data['replaced_products_token'] = token
+        context.user_data['products_token'] = callback_payloads.put(products, key=("category", category_id))
+    return products
+
+
+def sync_browsing_state(context: ContextTypes.DEFAULT_TYPE, nav_args):
+    # Boshqa (eski) xabardagi tugma bosilgan yoki sessiya tozalangan bo'lsa, holatni tugmadan tiklaymiz
+    if len(nav_args) != 3:
+        return
+    category_id, token, index = nav_args
+    current_tokens = (context.user_data.get('products_token'), context.user_data.get('replaced_products_token'))
+    if token not in current_tokens or category_id != context.user_data.get('current_category_id'):
+        context.user_data['current_category_id'] = category_id
+        context.user_data['products_token'] = token
+        context.user_data['current_product_index'] = index
+
+
 async def show_products_in_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     await save_user_info(query.from_user)
-    category_id = int(query.data.split("_")[1])
-    context.user_data['current_category_id'] = category_id
-    context.user_data['current_product_index'] = 0
-    products = db_fetch_all(
-        "SELECT id, name, price, image_file_id, description FROM products WHERE category_id = ? ORDER BY name",
-        (category_id,))
+    category_id = get_callback_args(query)[0]
+    funnel_events.record("category", query.from_user.id, category_id)
+    products = load_category_products(category_id)
+    start_browsing_category(context, category_id, products)
     if not products:
         reply_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("⬅️ Kategoriyalarga qaytish", callback_data="view_categories")]])
+            [[InlineKeyboardButton("⬅️ Kategoriyalarga qaytish", callback_data=pack_callback("view_categories"))]])
         await send_or_edit_message(context, query.message.chat_id, "Bu kategoriyada hozircha mahsulotlar mavjud emas.",
                                    reply_markup, query.message.message_id, delete_previous=True)
         return
-    context.user_data['products_in_category'] = products
     await display_product(update, context, query.message.chat_id, edit_message=False,
                           delete_previous_message_id=query.message.message_id)
 
@@ -365,7 +2026,7 @@ async def show_products_in_category(update: Update, context: ContextTypes.DEFAUL
 async def display_product(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int,
                           message_id_to_edit: int = None, edit_message: bool = False,
                           delete_previous_message_id: int = None):
-    products = context.user_data.get('products_in_category', [])
+    products = get_browsing_products(context)
     current_index = context.user_data.get('current_product_index', 0)
     if not products or current_index >= len(products):
         logger.warning("display_product: Mahsulotlar ro'yxati bo'sh yoki indeks chegaradan tashqarida.")
@@ -374,7 +2035,7 @@ async def display_product(update: Update, context: ContextTypes.DEFAULT_TYPE, ch
                                        "Mahsulot topilmadi yoki ro'yxatda xatolik. Kategoriyalarga qayting.",
                                        reply_markup=InlineKeyboardMarkup(
                                            [[InlineKeyboardButton("📜 Kategoriyalarga qaytish",
-                                                                  callback_data="view_categories")]]),
+                                                                  callback_data=pack_callback("view_categories"))]]),
                                        message_id_to_edit=update.callback_query.message.message_id,
                                        delete_previous=True)
         else:
@@ -385,15 +2046,31 @@ async def display_product(update: Update, context: ContextTypes.DEFAULT_TYPE, ch
     product_id, name, price, image_file_id, description = product
     caption = f"<b>{name}</b>\n"
     if description: caption += f"<i>{description}</i>\n"
-    caption += f"\nNarxi: <b>{price:,.0f} so'm</b>"
+    caption += f"\nNarxi: <b>{format_money(price)} so'm</b>"
 
+    # Navigatsiya tugmalari ro'yxat tokeni va joriy indeksni o'zida olib yuradi (sessiya yo'qolsa ham ishlaydi)
+    nav_args = (context.user_data.get('current_category_id'), context.user_data.get('products_token'), current_index)
     keyboard_nav = []
     row = []
-    if current_index > 0: row.append(InlineKeyboardButton("⬅️ Oldingisi", callback_data="prev_product"))
-    if current_index < len(products) - 1: row.append(InlineKeyboardButton("Keyingisi ➡️", callback_data="next_product"))
+    if current_index > 0:
+        row.append(InlineKeyboardButton("⬅️ Oldingisi", callback_data=pack_callback("prev_product", *nav_args)))
+    if current_index < len(products) - 1:
+        row.append(InlineKeyboardButton("Keyingisi ➡️", callback_data=pack_callback("next_product", *nav_args)))
     if row: keyboard_nav.append(row)
-    keyboard_nav.append([InlineKeyboardButton(f"🛍️ Sotib olish", callback_data=f"buy_{product_id}")])
-    keyboard_nav.append([InlineKeyboardButton("📜 Kategoriyalarga qaytish", callback_data="view_categories")])
+    keyboard_nav.append([InlineKeyboardButton(f"🛍️ Sotib olish", callback_data=pack_callback("buy", product_id))])
+    cart = context.user_data.get('cart') or {}
+    in_cart = cart.get(product_id, 0)
+    cart_row = [InlineKeyboardButton(f"🛒 Savatga ({in_cart})" if in_cart else "🛒 Savatga",
+                                     callback_data=pack_callback("cart_add", product_id, *nav_args))]
+    if in_cart:
+        cart_row.append(InlineKeyboardButton("➖ Savatdan", callback_data=pack_callback("cart_remove", product_id, *nav_args)))
+    keyboard_nav.append(cart_row)
+    if cart:
+        keyboard_nav.append([InlineKeyboardButton(f"🧺 Savat ({sum(cart.values())} ta)", callback_data=pack_callback("cart_view"))])
+    for related_id, related_name in product_recommendations.get(product_id, ())[:RECOMMENDATIONS_SHOWN]:
+        keyboard_nav.append([InlineKeyboardButton(f"🤝 {related_name}",
+                                                  callback_data=pack_callback("related_product", related_id))])
+    keyboard_nav.append([InlineKeyboardButton("📜 Kategoriyalarga qaytish", callback_data=pack_callback("view_categories"))])
     reply_markup = InlineKeyboardMarkup(keyboard_nav)
 
     effective_message_id_for_editing = None
@@ -416,45 +2093,120 @@ async def display_product(update: Update, context: ContextTypes.DEFAULT_TYPE, ch
                                delete_previous=delete_flag and not edit_message)
 
 
+class NavigationCoalescer:
+    # Chat bo'yicha kutilayotgan karta chizilishi: [muddat, eng_kech_muddat, oxirgi_update].
+    # Indeks har bosishda darhol o'zgaradi, karta esa bosishlar to'xtagach bir marta chiziladi.
+    def __init__(self, delay, max_delay):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._pending = {}
+
+    def schedule(self, update, context, chat_id):
+        now = time.monotonic()
+        pending = self._pending.get(chat_id)
+        if pending:
+            pending[0] = min(now + self.delay, pending[1])
+            pending[2] = update
+            metrics.inc("nav_taps_coalesced_total")
+            return
+        self._pending[chat_id] = [now + self.delay, now + self.max_delay, update]
+        context.application.create_task(self._render_later(context, chat_id), update=update)
+
+    def discard(self, chat_id):
+        # Boshqa amal xabarni o'zgartirgan bo'lsa, eski kartani qayta chizmaymiz
+        self._pending.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def _render_later(self, context, chat_id):
+        pending = self._pending.get(chat_id)
+        while pending is not None and pending is self._pending.get(chat_id):
+            remaining = pending[0] - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+        if pending is None or self._pending.get(chat_id) is not pending:
+            return
+        del self._pending[chat_id]
+        update = pending[2]
+        metrics.inc("nav_renders_total")
+        await save_user_info(update.callback_query.from_user)
+        await display_product(update, context, chat_id, edit_message=True)
+
+
+navigation_coalescer = NavigationCoalescer(NAV_RENDER_DELAY, NAV_RENDER_MAX_DELAY)
+
+
 async def next_product(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query;
-    await query.answer();
-    await save_user_info(query.from_user)
+    sync_browsing_state(context, get_callback_args(query))
     current_index = context.user_data.get('current_product_index', 0)
-    products_len = len(context.user_data.get('products_in_category', []))
+    products_len = len(get_browsing_products(context) or [])
     if current_index < products_len - 1:
         context.user_data['current_product_index'] += 1
-        await display_product(update, context, query.message.chat_id, edit_message=True)
+        funnel_events.record("product", query.from_user.id, get_browsing_products(context)[current_index + 1][0])
+        await query.answer()
+        navigation_coalescer.schedule(update, context, query.message.chat_id)
     else:
         await query.answer("Bu oxirgi mahsulot.")
 
 
 async def prev_product(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query;
-    await query.answer();
-    await save_user_info(query.from_user)
+    sync_browsing_state(context, get_callback_args(query))
     current_index = context.user_data.get('current_product_index', 0)
     if current_index > 0:
         context.user_data['current_product_index'] -= 1
-        await display_product(update, context, query.message.chat_id, edit_message=True)
+        funnel_events.record("product", query.from_user.id, get_browsing_products(context)[current_index - 1][0])
+        await query.answer()
+        navigation_coalescer.schedule(update, context, query.message.chat_id)
     else:
         await query.answer("Bu birinchi mahsulot.")
 
 
+async def show_related_product(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Tavsiya boshqa kategoriyada bo'lishi mumkin: bitta mahsulotdan iborat ro'yxat sifatida ko'rsatamiz
+    query = update.callback_query
+    product = repos.products.get(get_callback_args(query)[0])
+    if not product:
+        await query.answer("Bu mahsulot endi mavjud emas.")
+        return
+    await query.answer()
+    await save_user_info(query.from_user)
+    product_id, name, description, price, image_file_id, _, _ = product
+    start_browsing_category(context, None, [(product_id, name, price, image_file_id, description)])
+    await display_product(update, context, query.message.chat_id, edit_message=True)
+
+
 async def buy_product_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query;
     await query.answer();
     await save_user_info(query.from_user)
-    product_id = int(query.data.split("_")[1])
+    product_id = get_callback_args(query)[0]
+    funnel_events.record("buy", query.from_user.id, product_id)
     context.user_data['product_to_buy_id'] = product_id
-    product = db_fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
-    if not product:
+    product_name = repos.products.get_name(product_id)
+    if product_name is None:
         await send_or_edit_message(context, query.message.chat_id, "Mahsulot topilmadi.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return
+    # Avvalgi (tugallanmagan) bron bo'lsa bo'shatamiz, so'ng yangisini qo'yamiz
+    release_pending_reservations(context)
+    try:
+        context.user_data['stock_reservation_id'] = repos.products.reserve(product_id, query.from_user.id,
+                                                                           STOCK_RESERVATION_TTL)
+    except OutOfStockError:
+        del context.user_data['product_to_buy_id']
+        await send_or_edit_message(context, query.message.chat_id,
+                                   f"😔 Afsuski, <b>{product_name}</b> hozircha qolmagan.",
+                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                                       "📜 Kategoriyalarga qaytish", callback_data=pack_callback("view_categories"))]]),
+                                   message_id_to_edit=query.message.message_id, delete_previous=True)
+        return
 
     await send_or_edit_message(context, query.message.chat_id,
-                               f"<b>{product[0]}</b> uchun buyurtma berish uchun telefon raqamingizni yuboring...",
+                               f"<b>{product_name}</b> uchun buyurtma berish uchun telefon raqamingizni yuboring...",
                                reply_markup=ReplyKeyboardMarkup.from_button(
                                    KeyboardButton(text="📱 Telefon raqamni yuborish", request_contact=True),
                                    resize_keyboard=True, one_time_keyboard=True),
@@ -467,10 +2219,12 @@ async def process_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.effective_user
     await save_user_info(user)
     product_id = context.user_data.get('product_to_buy_id')
-    logger.info(f"process_contact: User {user.id} telefon raqamini yubordi. Product ID: {product_id}")
+    checkout_cart = context.user_data.get('checkout_cart', False)
+    orders_logger.info("process_contact: User %s telefon raqamini yubordi. Product ID: %s, savat: %s",
+                       user.id, product_id, checkout_cart)
 
-    if not product_id:
-        logger.warning(f"process_contact: User {user.id} uchun product_id topilmadi.")
+    if not product_id and not checkout_cart:
+        orders_logger.warning("process_contact: User %s uchun product_id topilmadi.", user.id)
         await update.message.reply_text(
             "Xatolik: Qaysi mahsulotni sotib olmoqchi ekanligingiz aniqlanmadi. Iltimos, qaytadan boshlang.",
             reply_markup=ReplyKeyboardRemove()
@@ -492,8 +2246,8 @@ async def process_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         elif len(cleaned_text) == 12 and cleaned_text.startswith('998'):
             phone_number = "+" + cleaned_text
         else:
-            logger.info(
-                f"process_contact: User {user.id} noto'g'ri formatda telefon raqam kiritdi: {update.message.text}")
+            orders_logger.info("process_contact: User %s noto'g'ri formatda telefon raqam kiritdi: %s",
+                               user.id, update.message.text)
             await update.message.reply_text(
                 "Telefon raqam noto'g'ri formatda. Iltimos, (+998xxxxxxxxx) formatida kiriting yoki tugmani bosing.",
                 reply_markup=ReplyKeyboardMarkup.from_button(
@@ -504,97 +2258,345 @@ async def process_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return
 
     if not phone_number:
-        logger.warning(f"process_contact: User {user.id} uchun telefon raqam olinmadi.")
+        orders_logger.warning("process_contact: User %s uchun telefon raqam olinmadi.", user.id)
         await update.message.reply_text("Telefon raqam olinmadi. Iltimos, qaytadan urinib ko'ring.",
                                         reply_markup=ReplyKeyboardRemove())
         return
 
-    logger.info(f"process_contact: User {user.id} telefon raqami: {phone_number}")
-
-    product = db_fetch_one("SELECT name, price FROM products WHERE id = ?", (product_id,))
-    if not product:
-        logger.warning(f"process_contact: User {user.id} uchun mahsulot (ID: {product_id}) bazadan topilmadi.")
+    orders_logger.info("process_contact: User %s telefon raqami: %s", user.id, phone_number)
+
+    requested = list(context.user_data.get('cart', {}).items()) if checkout_cart else [(product_id, 1)]
+    items = []
+    for item_product_id, quantity in requested:
+        product = repos.products.get_name_and_price(item_product_id)
+        if product:
+            items.append((item_product_id, product[0], product[1], quantity))
+    if not items:
+        orders_logger.warning("process_contact: User %s uchun mahsulotlar (%s) bazadan topilmadi.", user.id, requested)
+        release_pending_reservations(context)
         await update.message.reply_text("Mahsulot topilmadi.", reply_markup=ReplyKeyboardRemove())
         await start_after_action(update, context)
         return
 
-    product_name, product_price = product
-    logger.info(
-        f"process_contact: User {user.id} sotib olmoqchi bo'lgan mahsulot: {product_name}, Narxi: {product_price}")
+    orders_logger.info("process_contact: User %s sotib olmoqchi bo'lgan mahsulotlar: %s", user.id, items)
 
     try:
-        order_params = (user.id, user.username, product_id, product_name, product_price, phone_number)
-        logger.info(f"process_contact: Buyurtmani bazaga yozish uchun parametrlar: {order_params}")
-        db_query(
-            "INSERT INTO orders (user_id, user_username, product_id, product_name_at_order, product_price_at_order, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
-            order_params
-        )
-        logger.info(
-            f"process_contact: User {user.id} uchun buyurtma (Mahsulot ID: {product_id}) bazaga muvaffaqiyatli yozildi.")
+        reservation_ids = context.user_data.pop('checkout_reservation_ids', None) if checkout_cart else \
+            [context.user_data.pop('stock_reservation_id', None)]
+        # Sarlavha, qatorlar va bronlar bitta tranzaksiyada: savatdagi mahsulotlar soniga qaramay bitta commit
+        order_id = repos.orders.create_with_items(user.id, user.username, phone_number, items,
+                                                  [r for r in reservation_ids or [] if r is not None])
+        orders_logger.info("process_contact: User %s uchun buyurtma #%s (%s qator) bazaga yozildi.", user.id, order_id, len(items))
+        order_history_cache.invalidate(user.id)
+        funnel_events.record("order", user.id, order_id)
+        if checkout_cart:
+            context.user_data.pop('cart', None)
         await update.message.reply_text(
             "✅ Rahmat! Buyurtmangiz qabul qilindi. Tez orada siz bilan bog'lanamiz.",
             reply_markup=ReplyKeyboardRemove()
         )
 
         admin_message = (
-            f"📢 <b>Yangi buyurtma!</b>\n\n"
+            f"📢 <b>Yangi buyurtma #{order_id}!</b>\n\n"
             f"👤 Mijoz: {user.mention_html()} (ID: <code>{user.id}</code>)\n"
             f"📞 Telefon: <code>{phone_number}</code>\n"
-            f"🛍️ Mahsulot: {product_name}\n"
-            f"💰 Narxi: {product_price:,.0f} so'm"
+            f"{format_order_items(items)}"
         )
-        logger.info(f"process_contact: Adminga yuboriladigan xabar tayyorlandi: {admin_message[:100]}...")
+        orders_logger.debug("process_contact: Adminga yuboriladigan xabar tayyorlandi: %.100s...", admin_message)
         try:
-            await context.bot.send_message(chat_id=ADMIN_ID, text=admin_message, parse_mode='HTML')
-            logger.info(f"process_contact: Adminga ({ADMIN_ID}) yangi buyurtma haqida xabar muvaffaqiyatli yuborildi.")
+            await context.bot.send_message(chat_id=ADMIN_ID, text=admin_message, parse_mode='HTML',
+                                           reply_markup=build_order_status_keyboard(order_id, ORDER_STATUSES[0]))
+            orders_logger.info("process_contact: Adminga (%s) yangi buyurtma haqida xabar muvaffaqiyatli yuborildi.", ADMIN_ID)
         except telegram.error.BadRequest as e:
-            logger.error(
-                f"process_contact: Adminga xabar yuborishda BadRequest xatoligi: {e}. ADMIN_ID: {ADMIN_ID}. Bot adminga yozish huquqiga egami? Admin botni bloklamaganmi?")
+            orders_logger.error(
+                "process_contact: Adminga xabar yuborishda BadRequest xatoligi: %s. ADMIN_ID: %s. "
+                "Bot adminga yozish huquqiga egami? Admin botni bloklamaganmi?", e, ADMIN_ID)
         except Exception as e:
-            logger.error(f"process_contact: Adminga xabar yuborishda kutilmagan xatolik: {e}")
+            orders_logger.error("process_contact: Adminga xabar yuborishda kutilmagan xatolik: %s", e)
 
+    except OutOfStockError as e:
+        sold_out_name = next((name for item_product_id, name, _, _ in items if item_product_id == e.args[0]), "")
+        orders_logger.info("process_contact: User %s uchun mahsulot (ID: %s) qolmagan, bron muddati o'tgan.", user.id, e.args[0])
+        await update.message.reply_text(
+            f"😔 Afsuski, {sold_out_name} hozircha qolmagan. Buyurtma qabul qilinmadi.",
+            reply_markup=ReplyKeyboardRemove()
+        )
     except Exception as e_db:
-        logger.error(
-            f"process_contact: Buyurtmani bazaga saqlashda yoki adminga xabar yuborishda umumiy xatolik: {e_db}")
+        orders_logger.error(
+            "process_contact: Buyurtmani bazaga saqlashda yoki adminga xabar yuborishda umumiy xatolik: %s", e_db)
         await update.message.reply_text(
             "❌ Buyurtmani qayta ishlashda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko'ring.",
             reply_markup=ReplyKeyboardRemove()
         )
 
-    if 'product_to_buy_id' in context.user_data:
-        del context.user_data['product_to_buy_id']
-    await start_after_action(update, context)
+    if 'product_to_buy_id' in context.user_data:
+        del context.user_data['product_to_buy_id']
+    context.user_data.pop('checkout_cart', None)
+    await start_after_action(update, context)
+
+
+def format_order_items(items):
+    if len(items) == 1 and items[0][3] == 1:
+        _, name, price, _ = items[0]
+        return f"🛍️ Mahsulot: {name}\n💰 Narxi: {format_money(price)} so'm"
+    lines = [f"• {name} × {quantity} — {format_money(price * quantity)} so'm" for _, name, price, quantity in items]
+    total = sum(price * quantity for _, _, price, quantity in items)
+    return "🛍️ Mahsulotlar:\n" + "\n".join(lines) + f"\n💰 Jami: {format_money(total)} so'm"
+
+
+async def start_after_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    welcome_text = "Bosh menyu:"
+    reply_markup = InlineKeyboardMarkup(build_main_menu_keyboard(update.effective_user.id if update.effective_user else None))
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=welcome_text, reply_markup=reply_markup,
+                                   parse_mode='HTML')
+
+
+async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await save_user_info(query.from_user)
+    welcome_text = (f"Assalomu alaykum, {query.from_user.mention_html()}!\n"
+                    f"Zargarlik buyumlari do'konimizga xush kelibsiz!")
+    reply_markup = InlineKeyboardMarkup(build_main_menu_keyboard(query.from_user.id))
+    await send_or_edit_message(context, query.message.chat_id, welcome_text, reply_markup, query.message.message_id,
+                               delete_previous=True)
+
+
+# --- Order History ---
+class OrderHistoryCache:
+    # Mijoz -> {kursor: (matn, tugmalar)}. Mijoz yangi buyurtma berganda yoki holat o'zgarganda tozalanadi,
+    # shuning uchun "Keyingilar"/"Boshiga" bosishlar bazaga tushmaydi
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._pages = collections.OrderedDict()
+
+    def get(self, user_id, cursor):
+        pages = self._pages.get(user_id)
+        page = pages.get(cursor) if pages else None
+        if page is None:
+            metrics.inc("order_history_cache_misses_total")
+            return None
+        self._pages.move_to_end(user_id)
+        metrics.inc("order_history_cache_hits_total")
+        return page
+
+    def put(self, user_id, cursor, page):
+        self._pages.setdefault(user_id, {})[cursor] = page
+        self._pages.move_to_end(user_id)
+        if len(self._pages) > self.max_users:
+            self._pages.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._pages.pop(user_id, None)
+
+
+order_history_cache = OrderHistoryCache(ORDER_HISTORY_CACHE_USERS)
+
+
+def render_order_history_page(user_id, before=None):
+    orders = repos.orders.list_by_user(user_id, ORDER_HISTORY_PAGE_SIZE + 1, before)
+    has_more = len(orders) > ORDER_HISTORY_PAGE_SIZE
+    orders = orders[:ORDER_HISTORY_PAGE_SIZE]
+    if not orders:
+        text = "Sizda hali buyurtmalar yo'q." if before is None else "Boshqa buyurtmalar yo'q."
+    else:
+        text = "<b>📦 Buyurtmalaringiz:</b>\n" + "".join(
+            f"\n<b>#{order_id}</b> · {format_order_timestamp(timestamp_str)}\n"
+            f"{html.escape(product_name)} — {format_money(price)} so'm\n"
+            f"{ORDER_STATUS_LABELS.get(status, status)}\n"
+            for order_id, timestamp_str, product_name, price, status in orders)
+    navigation = []
+    if before is not None:
+        navigation.append(InlineKeyboardButton("⏮ Boshiga", callback_data=pack_callback("my_orders")))
+    if has_more:
+        last_id, last_timestamp = orders[-1][0], orders[-1][1]
+        navigation.append(InlineKeyboardButton("Keyingilar ➡️",
+                                               callback_data=pack_callback("my_orders", last_timestamp, last_id)))
+    keyboard = [navigation] if navigation else []
+    keyboard.append([InlineKeyboardButton("🏠 Bosh menyu", callback_data=pack_callback("main_menu"))])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def my_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /myorders buyrug'i va "Buyurtmalarim" tugmasi; sahifa kursori tugmada: oxirgi (timestamp, id)
+    query = update.callback_query
+    user = query.from_user if query else update.effective_user
+    if query:
+        await query.answer()
+    await save_user_info(user)
+    args = get_callback_args(query) if query else ()
+    before = tuple(args[:2]) if len(args) >= 2 else None
+    page = order_history_cache.get(user.id, before)
+    if page is None:
+        page = render_order_history_page(user.id, before)
+        order_history_cache.put(user.id, before, page)
+    text, reply_markup = page
+    if query:
+        await send_or_edit_message(context, query.message.chat_id, text, reply_markup, query.message.message_id)
+    else:
+        await update.message.reply_html(text, reply_markup=reply_markup)
+
+
+# --- Cart ---
+def release_session_reservations(session):
+    # Tugallanmagan "Sotib olish" yoki savat rasmiylashtirish bronlarini zaxiraga qaytaradi
+    reservation_ids = session.pop('checkout_reservation_ids', None) or []
+    reservation_ids.append(session.pop('stock_reservation_id', None))
+    for reservation_id in reservation_ids:
+        if reservation_id is not None:
+            repos.products.release_reservation(reservation_id)
+    session.pop('checkout_cart', None)
+
+
+def release_pending_reservations(context: ContextTypes.DEFAULT_TYPE):
+    release_session_reservations(context.user_data)
+
+
+def build_cart_view(context: ContextTypes.DEFAULT_TYPE):
+    cart = context.user_data.get('cart') or {}
+    lines, keyboard, total = [], [], 0
+    for product_id, quantity in list(cart.items()):
+        product = repos.products.get_name_and_price(product_id)
+        if not product:
+            del cart[product_id]
+            continue
+        name, price = product
+        total += price * quantity
+        lines.append(f"• {name} × {quantity} — {format_money(price * quantity)} so'm")
+        keyboard.append([InlineKeyboardButton(f"➖ {name[:25]}", callback_data=pack_callback("cart_item_remove", product_id))])
+    back_button = [InlineKeyboardButton("📜 Kategoriyalarga qaytish", callback_data=pack_callback("view_categories"))]
+    if not lines:
+        return "🧺 Savatingiz bo'sh.", InlineKeyboardMarkup([back_button])
+    keyboard.append([InlineKeyboardButton("✅ Rasmiylashtirish", callback_data=pack_callback("cart_checkout"))])
+    keyboard.append([InlineKeyboardButton("🗑️ Savatni tozalash", callback_data=pack_callback("cart_clear"))])
+    keyboard.append(back_button)
+    text = "<b>🧺 Savatingiz:</b>\n\n" + "\n".join(lines) + f"\n\nJami: <b>{format_money(total)} so'm</b>"
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, notice: str = None) -> None:
+    query = update.callback_query
+    text, reply_markup = build_cart_view(context)
+    if notice:
+        text = f"{notice}\n\n{text}"
+    await send_or_edit_message(context, query.message.chat_id, text, reply_markup, query.message.message_id,
+                               delete_previous=True)
+
+
+async def cart_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await show_cart(update, context)
+
+
+async def cart_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    product_id, *nav_args = get_callback_args(query)
+    cart = context.user_data.setdefault('cart', {})
+    if product_id not in cart and len(cart) >= CART_MAX_ITEMS:
+        await query.answer(f"Savatda ko'pi bilan {CART_MAX_ITEMS} xil mahsulot bo'lishi mumkin.", show_alert=True)
+        return
+    if cart.get(product_id, 0) >= CART_MAX_QUANTITY:
+        await query.answer(f"Bitta mahsulotdan ko'pi bilan {CART_MAX_QUANTITY} dona.", show_alert=True)
+        return
+    cart[product_id] = cart.get(product_id, 0) + 1
+    await query.answer("🛒 Savatga qo'shildi")
+    sync_browsing_state(context, nav_args)
+    await display_product(update, context, query.message.chat_id, edit_message=True)
+
 
+async def cart_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    product_id, *nav_args = get_callback_args(query)
+    cart = context.user_data.get('cart') or {}
+    if cart.get(product_id, 0) > 1:
+        cart[product_id] -= 1
+    else:
+        cart.pop(product_id, None)
+    await query.answer("Savatdan olindi")
+    sync_browsing_state(context, nav_args)
+    await display_product(update, context, query.message.chat_id, edit_message=True)
 
-async def start_after_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    welcome_text = "Bosh menyu:"
-    keyboard = [[InlineKeyboardButton("🛍️ Mahsulotlarni ko'rish", callback_data="view_categories")]]
-    current_user_is_admin = False
-    if update.effective_user and update.effective_user.id == ADMIN_ID:
-        current_user_is_admin = True
 
-    if current_user_is_admin:
-        keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data="admin_panel")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await context.bot.send_message(chat_id=update.effective_chat.id, text=welcome_text, reply_markup=reply_markup,
-                                   parse_mode='HTML')
+async def cart_item_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    (context.user_data.get('cart') or {}).pop(get_callback_args(query)[0], None)
+    await show_cart(update, context)
 
 
-async def main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cart_clear(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer("Savat tozalandi")
+    context.user_data.pop('cart', None)
+    await show_cart(update, context)
+
+
+async def cart_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     await save_user_info(query.from_user)
-    welcome_text = (f"Assalomu alaykum, {query.from_user.mention_html()}!\n"
-                    f"Zargarlik buyumlari do'konimizga xush kelibsiz!")
-    keyboard = [[InlineKeyboardButton("🛍️ Mahsulotlarni ko'rish", callback_data="view_categories")]]
-    if query.from_user.id == ADMIN_ID:
-        keyboard.append([InlineKeyboardButton("🛠️ Admin Panel", callback_data="admin_panel")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await send_or_edit_message(context, query.message.chat_id, welcome_text, reply_markup, query.message.message_id,
-                               delete_previous=True)
+    release_pending_reservations(context)
+    context.user_data.pop('product_to_buy_id', None)
+    cart = context.user_data.get('cart') or {}
+    funnel_events.record("buy", query.from_user.id)
+    # Barcha donalar bitta tranzaksiyada bron qilinadi; yetmagan mahsulot soni qolganicha kamaytiriladi
+    # (umuman qolmagani savatdan olinadi) va mijozga aytiladi
+    reservation_ids, shortages = repos.products.reserve_many(cart, query.from_user.id, STOCK_RESERVATION_TTL)
+    sold_out_names, reduced_names = [], []
+    for product_id, available in shortages.items():
+        name = repos.products.get_name(product_id) or "Noma'lum"
+        if available:
+            cart[product_id] = available
+            reduced_names.append(f"{name} ({available} ta)")
+        else:
+            del cart[product_id]
+            sold_out_names.append(name)
+    notices = []
+    if sold_out_names:
+        notices.append(f"😔 Afsuski, qolmagan: {', '.join(sold_out_names)}.")
+    if reduced_names:
+        notices.append(f"⚠️ Yetarli emas, soni qolganicha kamaytirildi: {', '.join(reduced_names)}.")
+    notice = "\n".join(notices) or None
+    if not cart:
+        await show_cart(update, context, notice)
+        return
+    context.user_data['checkout_cart'] = True
+    context.user_data['checkout_reservation_ids'] = reservation_ids
+    text = f"Savatdagi {sum(cart.values())} ta mahsulot uchun buyurtma berish uchun telefon raqamingizni yuboring..."
+    await send_or_edit_message(context, query.message.chat_id, f"{notice}\n\n{text}" if notice else text,
+                               reply_markup=ReplyKeyboardMarkup.from_button(
+                                   KeyboardButton(text="📱 Telefon raqamni yuborish", request_contact=True),
+                                   resize_keyboard=True, one_time_keyboard=True),
+                               message_id_to_edit=query.message.message_id, delete_previous=True)
 
 
 # --- Admin Panel ---
+def build_order_queue_buttons():
+    # Sonlar order_status_counts dan: panel ochilishi buyurtmalar soniga bog'liq emas
+    counts = repos.orders.status_counts()
+    buttons = [InlineKeyboardButton(f"{ORDER_STATUS_LABELS[status]}: {counts.get(status, 0)}",
+                                    callback_data=pack_callback("admin_order_queue", status))
+               for status in ORDER_STATUSES]
+    return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+
+def build_admin_panel_keyboard():
+    return [
+        [InlineKeyboardButton("🗂️ Kategoriyalarni boshqarish", callback_data=pack_callback("admin_manage_categories"))],
+        [InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data=pack_callback("admin_add_category_prompt"))],
+        [InlineKeyboardButton("📦 Mahsulot qo'shish", callback_data=pack_callback("admin_add_product_start"))],
+        [InlineKeyboardButton("📥 Katalogni import qilish", callback_data=pack_callback("admin_import_catalog_start"))],
+        [InlineKeyboardButton("📝 Mahsulotlarni boshqarish", callback_data=pack_callback("admin_manage_products_list"))],
+        [InlineKeyboardButton("🧮 Ommaviy amallar", callback_data=pack_callback("admin_bulk_start"))],
+        [InlineKeyboardButton("📈 Buyurtmalarni ko'rish", callback_data=pack_callback("admin_view_orders"))],
+        *build_order_queue_buttons(),
+        [InlineKeyboardButton("📊 Statistika", callback_data=pack_callback("admin_analytics", "day"))],
+        [InlineKeyboardButton("📣 Xabar yuborish", callback_data=pack_callback("admin_broadcast_start"))],
+        [InlineKeyboardButton("🏠 Bosh menyuga qaytish", callback_data=pack_callback("main_menu"))]
+    ]
+
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_to_save = update.callback_query.from_user if update.callback_query else update.effective_user
     await save_user_info(user_to_save)
@@ -604,14 +2606,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     if update.callback_query: await update.callback_query.answer()
     text = "Admin Paneliga xush kelibsiz! Quyidagi amallardan birini tanlang:"
-    keyboard = [
-        [InlineKeyboardButton("🗂️ Kategoriyalarni boshqarish", callback_data="admin_manage_categories")],
-        [InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="admin_add_category_prompt")],
-        [InlineKeyboardButton("📦 Mahsulot qo'shish", callback_data="admin_add_product_start")],
-        [InlineKeyboardButton("📝 Mahsulotlarni boshqarish", callback_data="admin_manage_products_list")],
-        [InlineKeyboardButton("📈 Buyurtmalarni ko'rish", callback_data="admin_view_orders")],
-        [InlineKeyboardButton("🏠 Bosh menyuga qaytish", callback_data="main_menu")]
-    ]
+    keyboard = build_admin_panel_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     msg_to_handle = update.callback_query.message if update.callback_query else update.message
     await send_or_edit_message(context, msg_to_handle.chat_id, text, reply_markup,
@@ -621,14 +2616,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
 async def admin_panel_after_conv_end(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = "Admin Panel:"
-    keyboard = [
-        [InlineKeyboardButton("🗂️ Kategoriyalarni boshqarish", callback_data="admin_manage_categories")],
-        [InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="admin_add_category_prompt")],
-        [InlineKeyboardButton("📦 Mahsulot qo'shish", callback_data="admin_add_product_start")],
-        [InlineKeyboardButton("📝 Mahsulotlarni boshqarish", callback_data="admin_manage_products_list")],
-        [InlineKeyboardButton("📈 Buyurtmalarni ko'rish", callback_data="admin_view_orders")],
-        [InlineKeyboardButton("🏠 Bosh menyuga qaytish", callback_data="main_menu")]
-    ]
+    keyboard = build_admin_panel_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(text, reply_markup=reply_markup)
 
@@ -636,14 +2624,7 @@ async def admin_panel_after_conv_end(update: Update, context: ContextTypes.DEFAU
 async def admin_panel_after_callback_action(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE,
                                             message_text_prefix=""):
     text = message_text_prefix + "\nAdmin Panel:" if message_text_prefix and message_text_prefix.strip() else "Admin Panel:"
-    keyboard = [
-        [InlineKeyboardButton("🗂️ Kategoriyalarni boshqarish", callback_data="admin_manage_categories")],
-        [InlineKeyboardButton("➕ Kategoriya qo'shish", callback_data="admin_add_category_prompt")],
-        [InlineKeyboardButton("📦 Mahsulot qo'shish", callback_data="admin_add_product_start")],
-        [InlineKeyboardButton("📝 Mahsulotlarni boshqarish", callback_data="admin_manage_products_list")],
-        [InlineKeyboardButton("📈 Buyurtmalarni ko'rish", callback_data="admin_view_orders")],
-        [InlineKeyboardButton("🏠 Bosh menyuga qaytish", callback_data="main_menu")]
-    ]
+    keyboard = build_admin_panel_keyboard()
     reply_markup = InlineKeyboardMarkup(keyboard)
     await send_or_edit_message(context, query.message.chat_id, text, reply_markup, query.message.message_id,
                                delete_previous=True)
@@ -653,20 +2634,21 @@ async def admin_panel_after_callback_action(query: Update.callback_query, contex
 async def admin_manage_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    categories = db_fetch_all("SELECT id, name FROM categories ORDER BY name")
+    categories = repos.categories.list()
     text = "Kategoriyalarni boshqarish:\n"
     keyboard = []
     if categories:
         for cat_id, cat_name in categories:
             keyboard.append([
-                InlineKeyboardButton(f"{cat_name[:25]}", callback_data=f"admin_noop"),
-                InlineKeyboardButton("✏️", callback_data=f"admin_edit_cat_prompt_{cat_id}"),
-                InlineKeyboardButton("🗑️", callback_data=f"admin_delete_cat_confirm_{cat_id}")
+                InlineKeyboardButton(f"{cat_name[:25]}", callback_data=pack_callback("admin_noop")),
+                InlineKeyboardButton("🔗", callback_data=pack_callback("admin_share_link", "c", cat_id)),
+                InlineKeyboardButton("✏️", callback_data=pack_callback("admin_edit_cat_prompt", cat_id)),
+                InlineKeyboardButton("🗑️", callback_data=pack_callback("admin_delete_cat_confirm", cat_id))
             ])
     else:
         text += "\nHozircha kategoriyalar mavjud emas."
-    keyboard.append([InlineKeyboardButton("➕ Yangi Kategoriya Qo'shish", callback_data="admin_add_category_prompt")])
-    keyboard.append([InlineKeyboardButton("⬅️ Admin Panelga", callback_data="admin_panel")])
+    keyboard.append([InlineKeyboardButton("➕ Yangi Kategoriya Qo'shish", callback_data=pack_callback("admin_add_category_prompt"))])
+    keyboard.append([InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await send_or_edit_message(context, query.message.chat_id, text, reply_markup, query.message.message_id,
                                delete_previous=True)
@@ -686,9 +2668,9 @@ async def admin_save_category(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Kategoriya nomi bo'sh bo'lishi mumkin emas.");
         return ASK_CATEGORY_NAME
     try:
-        db_query("INSERT INTO categories (name) VALUES (?)", (category_name,))
+        repos.categories.add(category_name)
         await update.message.reply_text(f"✅ '{category_name}' kategoriyasi qo'shildi.")
-    except sqlite3.IntegrityError:
+    except DuplicateNameError:
         await update.message.reply_text(f"❗️ '{category_name}' allaqachon mavjud.")
     except Exception as e:
         await update.message.reply_text(f"Xatolik: {e}")
@@ -699,15 +2681,15 @@ async def admin_save_category(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def admin_edit_category_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    cat_id = int(query.data.split("_")[-1])
-    category = db_fetch_one("SELECT name FROM categories WHERE id = ?", (cat_id,))
-    if not category:
+    cat_id = get_callback_args(query)[0]
+    category_name = repos.categories.get_name(cat_id)
+    if category_name is None:
         await send_or_edit_message(context, query.message.chat_id, "Kategoriya topilmadi.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return ConversationHandler.END
     context.user_data['edit_category_id'] = cat_id
     await send_or_edit_message(context, query.message.chat_id,
-                               f"'{category[0]}' uchun yangi nom kiriting (/cancel):",
+                               f"'{category_name}' uchun yangi nom kiriting (/cancel):",
                                message_id_to_edit=query.message.message_id, delete_previous=True)
     return ASK_CATEGORY_EDIT_NAME
 
@@ -720,9 +2702,9 @@ async def admin_save_edited_category(update: Update, context: ContextTypes.DEFAU
         await admin_panel_after_conv_end(update, context);
         return ConversationHandler.END
     try:
-        db_query("UPDATE categories SET name = ? WHERE id = ?", (new_name, cat_id))
+        repos.categories.rename(cat_id, new_name)
         await update.message.reply_text(f"✅ Kategoriya nomi '{new_name}' ga o'zgartirildi.")
-    except sqlite3.IntegrityError:
+    except DuplicateNameError:
         await update.message.reply_text(f"❗️ '{new_name}' nomli kategoriya allaqachon mavjud.")
     except Exception as e:
         await update.message.reply_text(f"Xatolik: {e}")
@@ -734,34 +2716,33 @@ async def admin_save_edited_category(update: Update, context: ContextTypes.DEFAU
 async def admin_delete_category_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    cat_id = int(query.data.split("_")[-1])
-    category = db_fetch_one("SELECT name FROM categories WHERE id = ?", (cat_id,))
-    products_in_category = db_fetch_all("SELECT id FROM products WHERE category_id = ?", (cat_id,))
-    if not category:
+    cat_id = get_callback_args(query)[0]
+    category_name = repos.categories.get_name(cat_id)
+    products_in_category = repos.products.count_in_category(cat_id)
+    if category_name is None:
         await send_or_edit_message(context, query.message.chat_id, "Kategoriya topilmadi.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return
     warning_text = ""
     if products_in_category:
-        warning_text = f"\n\n⚠️ Diqqat! Bu kategoriyada {len(products_in_category)} ta mahsulot bor. Ular kategoriyasiz qoladi."
+        warning_text = f"\n\n⚠️ Diqqat! Bu kategoriyada {products_in_category} ta mahsulot bor. Ular kategoriyasiz qoladi."
     keyboard = [
-        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"admin_delete_cat_execute_{cat_id}")],
-        [InlineKeyboardButton("❌ Yo'q, bekor qilish", callback_data="admin_manage_categories")]
+        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=pack_callback("admin_delete_cat_execute", cat_id))],
+        [InlineKeyboardButton("❌ Yo'q, bekor qilish", callback_data=pack_callback("admin_manage_categories"))]
     ]
     await send_or_edit_message(context, query.message.chat_id,
-                               f"Haqiqatan ham '{category[0]}' kategoriyasini o'chirmoqchimisiz?{warning_text}",
+                               f"Haqiqatan ham '{category_name}' kategoriyasini o'chirmoqchimisiz?{warning_text}",
                                InlineKeyboardMarkup(keyboard), query.message.message_id, delete_previous=True)
 
 
 async def admin_delete_category_execute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    cat_id = int(query.data.split("_")[-1])
-    cat_name_tuple = db_fetch_one("SELECT name FROM categories WHERE id = ?", (cat_id,))
-    cat_name = cat_name_tuple[0] if cat_name_tuple else "Noma'lum"
+    cat_id = get_callback_args(query)[0]
+    cat_name = repos.categories.get_name(cat_id) or "Noma'lum"
     text_to_show = ""
     try:
-        db_query("DELETE FROM categories WHERE id = ?", (cat_id,))
+        repos.categories.delete(cat_id)
         text_to_show = f"🗑️ '{cat_name}' kategoriyasi o'chirildi."
     except Exception as e:
         logger.error(f"Kategoriyani o'chirishda xatolik: {e}")
@@ -773,20 +2754,19 @@ async def admin_delete_category_execute(update: Update, context: ContextTypes.DE
 async def admin_manage_products_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    products = db_fetch_all(
-        "SELECT p.id, p.name, c.name as category_name FROM products p LEFT JOIN categories c ON p.category_id = c.id ORDER BY p.name")
+    products = repos.products.list_with_category_names()
     text = "Mahsulotlarni boshqarish:\n(Tahrirlash uchun mahsulot nomiga bosing)\n"
     keyboard = []
     if products:
         for prod_id, prod_name, cat_name in products:
             keyboard.append([
                 InlineKeyboardButton(f"{prod_name[:20]}.. ({cat_name or 'Kategoriyasiz'})",
-                                     callback_data=f"admin_view_prod_{prod_id}"),
+                                     callback_data=pack_callback("admin_view_prod", prod_id)),
             ])
     else:
         text += "\nHozircha mahsulotlar mavjud emas."
-    keyboard.append([InlineKeyboardButton("📦 Yangi Mahsulot Qo'shish", callback_data="admin_add_product_start")])
-    keyboard.append([InlineKeyboardButton("⬅️ Admin Panelga", callback_data="admin_panel")])
+    keyboard.append([InlineKeyboardButton("📦 Yangi Mahsulot Qo'shish", callback_data=pack_callback("admin_add_product_start"))])
+    keyboard.append([InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))])
     reply_markup = InlineKeyboardMarkup(keyboard)
     await send_or_edit_message(context, query.message.chat_id, text, reply_markup, query.message.message_id,
                                delete_previous=True)
@@ -795,16 +2775,14 @@ async def admin_manage_products_list(update: Update, context: ContextTypes.DEFAU
 async def admin_view_single_product(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    product_id = int(query.data.split("_")[-1])
-    product = db_fetch_one(
-        "SELECT p.id, p.name, p.description, p.price, p.image_file_id, c.name as category_name FROM products p LEFT JOIN categories c ON p.category_id = c.id WHERE p.id = ?",
-        (product_id,))
+    product_id = get_callback_args(query)[0]
+    product = repos.products.get(product_id)
     if not product:
         await send_or_edit_message(context, query.message.chat_id, "Mahsulot topilmadi.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return
 
-    _id, name, desc, price, img_id, cat_name = product
+    _id, name, desc, price, img_id, cat_name, stock = product
     context.user_data['current_editing_product_id'] = _id
 
     caption = f"<b>Mahsulot: {name}</b>\n"
@@ -813,34 +2791,116 @@ async def admin_view_single_product(update: Update, context: ContextTypes.DEFAUL
     else:
         caption += "Kategoriya: Belgilanmagan\n"
     if desc: caption += f"Tavsif: <i>{desc}</i>\n"
-    caption += f"Narxi: {price:,.0f} so'm"
+    caption += f"Narxi: {format_money(price)} so'm\n"
+    caption += f"Zaxira: {stock} dona" if stock is not None else "Zaxira: hisobsiz"
 
     keyboard = [
-        [InlineKeyboardButton("✏️ Nomini", callback_data=f"admin_edit_prod_field_name"),
-         InlineKeyboardButton("✏️ Tavsifini", callback_data=f"admin_edit_prod_field_desc")],
-        [InlineKeyboardButton("✏️ Narxini", callback_data=f"admin_edit_price_entry_{_id}"),
-         InlineKeyboardButton("✏️ Rasmini", callback_data=f"admin_edit_prod_field_image")],
-        [InlineKeyboardButton("✏️ Kategoriyasini", callback_data=f"admin_edit_prod_field_category")],
-        [InlineKeyboardButton("🗑️ O'CHIRISH", callback_data=f"admin_delete_prod_confirm_{_id}")],
-        [InlineKeyboardButton("⬅️ Mahsulotlar ro'yxatiga", callback_data="admin_manage_products_list")],
-        [InlineKeyboardButton("🏠 Admin Panelga", callback_data="admin_panel")]
+        [InlineKeyboardButton("✏️ Nomini", callback_data=pack_callback("admin_edit_prod_field", "name")),
+         InlineKeyboardButton("✏️ Tavsifini", callback_data=pack_callback("admin_edit_prod_field", "desc"))],
+        [InlineKeyboardButton("✏️ Narxini", callback_data=pack_callback("admin_edit_price_entry", _id)),
+         InlineKeyboardButton("✏️ Rasmini", callback_data=pack_callback("admin_edit_prod_field", "image"))],
+        [InlineKeyboardButton("✏️ Kategoriyasini", callback_data=pack_callback("admin_edit_prod_field", "category")),
+         InlineKeyboardButton("📦 Zaxirasini", callback_data=pack_callback("admin_edit_prod_field", "stock"))],
+        [InlineKeyboardButton("📈 Narx tarixi", callback_data=pack_callback("admin_price_history", _id)),
+         InlineKeyboardButton("🔗 Havola", callback_data=pack_callback("admin_share_link", "p", _id))],
+        [InlineKeyboardButton("📣 Mijozlarga yuborish", callback_data=pack_callback("admin_broadcast_product", _id))],
+        [InlineKeyboardButton("🗑️ O'CHIRISH", callback_data=pack_callback("admin_delete_prod_confirm", _id))],
+        [InlineKeyboardButton("⬅️ Mahsulotlar ro'yxatiga", callback_data=pack_callback("admin_manage_products_list"))],
+        [InlineKeyboardButton("🏠 Admin Panelga", callback_data=pack_callback("admin_panel"))]
     ]
     await send_or_edit_message(context, query.message.chat_id, caption, InlineKeyboardMarkup(keyboard),
                                query.message.message_id, photo_file_id=img_id, delete_previous=True)
 
 
+async def admin_price_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    args = get_callback_args(query)
+    product_id, days = args[0], args[1] if len(args) > 1 else PRICE_HISTORY_RANGES_DAYS[0]
+    name = repos.products.get_name(product_id) or "Noma'lum"
+    # price_history.changed_at CURRENT_TIMESTAMP (UTC) bilan yoziladi
+    until = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    since = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - days * 24 * 60 * 60))
+    history = repos.products.price_history(product_id, since, until)
+    text = f"<b>📈 {html.escape(name)}</b>: oxirgi {days} kundagi narxlar (UTC)\n"
+    if not history:
+        text += "\nBu davr uchun narx tarixi yo'q."
+    else:
+        prices = [price for _, price in history]
+        known_at_start = history[0][0] <= since
+        changes = history[1:] if known_at_start else history
+        start_price = f"{format_money(prices[0])} so'm" if known_at_start else "noma'lum"
+        text += (f"\n{days} kun oldin: {start_price}\n"
+                 f"Hozir: {format_money(prices[-1])} so'm\n"
+                 f"Eng past / eng yuqori: {format_money(min(prices))} / {format_money(max(prices))} so'm\n")
+        if changes:
+            text += f"\n<b>O'zgarishlar ({len(changes)}):</b>\n" + "\n".join(
+                f"{changed_at[:16]} — {format_money(price)} so'm" for changed_at, price in changes[-PRICE_HISTORY_SHOWN:])
+        else:
+            text += "\nBu davrda narx o'zgarmagan."
+    keyboard = [[InlineKeyboardButton(f"{'• ' if range_days == days else ''}{range_days} kun",
+                                      callback_data=pack_callback("admin_price_history", product_id, range_days))
+                 for range_days in PRICE_HISTORY_RANGES_DAYS],
+                [InlineKeyboardButton("⬅️ Mahsulotga", callback_data=pack_callback("admin_view_prod", product_id))]]
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               query.message.message_id, delete_previous=True)
+
+
+async def admin_price_at(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /priceat <mahsulot_id> <YYYY-MM-DD[ HH:MM]> (UTC): nizoli buyurtmalar uchun o'sha paytdagi narx
+    try:
+        product_id = int(context.args[0])
+        moment = datetime.fromisoformat(" ".join(context.args[1:3]))
+    except (IndexError, ValueError):
+        await update.message.reply_text("Foydalanish: /priceat <mahsulot_id> <YYYY-MM-DD> [HH:MM] (UTC)")
+        return
+    if len(context.args) < 3:
+        moment = moment.replace(hour=23, minute=59, second=59)
+    at = moment.strftime("%Y-%m-%d %H:%M:%S")
+    price = repos.products.price_at(product_id, at)
+    name = repos.products.get_name(product_id) or f"ID {product_id}"
+    if price is None:
+        await update.message.reply_text(f"{name}: {at} holatiga narx ma'lumoti yo'q.")
+    else:
+        await update.message.reply_text(f"{name}: {at} (UTC) holatidagi narx {format_money(price)} so'm.")
+
+
+async def admin_share_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Kanal/reklama postlari uchun: havola bosilganda /start to'g'ridan-to'g'ri kartani ochadi
+    query = update.callback_query
+    kind, target_id = get_callback_args(query)
+    if kind == "p":
+        name = repos.products.get_name(target_id)
+        back_button = InlineKeyboardButton("⬅️ Mahsulotga", callback_data=pack_callback("admin_view_prod", target_id))
+    else:
+        name = repos.categories.get_name(target_id)
+        back_button = InlineKeyboardButton("⬅️ Kategoriyalarga", callback_data=pack_callback("admin_manage_categories"))
+    if name is None:
+        await query.answer("Topilmadi.")
+        return
+    await query.answer()
+    link = build_start_link(context.bot.username, kind, target_id)
+    text = (f"🔗 <b>{html.escape(name)}</b> uchun havola:\n<code>{link}</code>\n\n"
+            f"Havolani bosgan mijozga {'mahsulot kartasi' if kind == 'p' else 'kategoriyaning birinchi mahsuloti'} "
+            f"darhol ochiladi.")
+    keyboard = [[InlineKeyboardButton("📤 Ulashish", url="https://t.me/share/url?" + urllib.parse.urlencode(
+        {"url": link, "text": name}))], [back_button]]
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               query.message.message_id, delete_previous=True)
+
+
 async def admin_add_product_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query;
     await query.answer()
-    categories = db_fetch_all("SELECT id, name FROM categories ORDER BY name")
+    categories = repos.categories.list()
     if not categories:
         await send_or_edit_message(context, query.message.chat_id, "Avval kategoriya qo'shing.", InlineKeyboardMarkup(
-            [[InlineKeyboardButton("⬅️ Admin Panelga", callback_data="admin_panel")]]), query.message.message_id,
+            [[InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]]), query.message.message_id,
                                    delete_previous=True)
         return ConversationHandler.END
-    keyboard = [[InlineKeyboardButton(name, callback_data=f"prodcat_{cat_id}")] for cat_id, name in categories]
-    keyboard.append([InlineKeyboardButton("Kategoriyasiz qo'shish", callback_data="prodcat_None")])
-    keyboard.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="admin_cancel_conv")])
+    keyboard = [[InlineKeyboardButton(name, callback_data=pack_callback("prodcat", cat_id))] for cat_id, name in categories]
+    keyboard.append([InlineKeyboardButton("Kategoriyasiz qo'shish", callback_data=pack_callback("prodcat", None))])
+    keyboard.append([InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))])
     await send_or_edit_message(context, query.message.chat_id, "Mahsulot uchun kategoriyani tanlang:",
                                InlineKeyboardMarkup(keyboard), query.message.message_id, delete_previous=True)
     return SELECT_PRODUCT_CATEGORY
@@ -849,8 +2909,7 @@ async def admin_add_product_start(update: Update, context: ContextTypes.DEFAULT_
 async def admin_ask_product_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query;
     await query.answer()
-    category_id_str = query.data.split("_")[1]
-    context.user_data['new_product_category_id'] = int(category_id_str) if category_id_str != "None" else None
+    context.user_data['new_product_category_id'] = get_callback_args(query)[0]
     await send_or_edit_message(context, query.message.chat_id, "Mahsulot nomini kiriting (/cancel):",
                                message_id_to_edit=query.message.message_id, delete_previous=True)
     return ASK_PRODUCT_NAME
@@ -875,7 +2934,8 @@ async def admin_ask_product_price(update: Update, context: ContextTypes.DEFAULT_
 
 async def admin_ask_product_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
-        price = float(update.message.text.replace(",", "."))
+        price = parse_money(update.message.text)
+        if price is None: raise ValueError
         if price <= 0: await update.message.reply_text("Narx > 0 bo'lishi kerak."); return ASK_PRODUCT_PRICE
         context.user_data['new_product_price'] = price
         await update.message.reply_text("Mahsulot rasmini yuboring (ixtiyoriy, /skip, /cancel):")
@@ -899,8 +2959,7 @@ async def admin_save_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
     description = context.user_data.get('new_product_description')
     price = context.user_data['new_product_price']
     try:
-        db_query("INSERT INTO products (category_id, name, description, price, image_file_id) VALUES (?, ?, ?, ?, ?)",
-                 (category_id, name, description, price, image_file_id))
+        repos.products.add(category_id, name, description, price, image_file_id)
         await update.message.reply_text(f"✅ '{name}' mahsuloti qo'shildi.")
     except Exception as e:
         await update.message.reply_text(f"Mahsulotni saqlashda xatolik: {e}")
@@ -913,7 +2972,7 @@ async def admin_save_product(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_edit_product_field_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    field_action = query.data
+    field_action = get_callback_args(query)[0]
     product_id = context.user_data.get('current_editing_product_id')
     if not product_id:
         await send_or_edit_message(context, query.message.chat_id, "Tahrirlanadigan mahsulot ID si topilmadi.",
@@ -921,36 +2980,41 @@ async def admin_edit_product_field_router(update: Update, context: ContextTypes.
         await admin_panel_after_callback_action(query, context)
         return ConversationHandler.END
 
-    product_name_tuple = db_fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
-    product_name = product_name_tuple[0] if product_name_tuple else "Noma'lum"
+    product_name = repos.products.get_name(product_id) or "Noma'lum"
     context.user_data['editing_product_id_for_field'] = product_id  # Bu ID ni keyingi stepda ishlatamiz
 
-    if field_action == "admin_edit_prod_field_name":
+    if field_action == "name":
         await send_or_edit_message(context, query.message.chat_id,
                                    f"'{product_name}' uchun yangi nomni kiriting (/cancel):",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return ASK_EDIT_PRODUCT_NEW_NAME
-    elif field_action == "admin_edit_prod_field_desc":
+    elif field_action == "desc":
         await send_or_edit_message(context, query.message.chat_id,
                                    f"'{product_name}' uchun yangi tavsifni kiriting (/skip, /cancel):",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return ASK_EDIT_PRODUCT_NEW_DESC
-    elif field_action == "admin_edit_prod_field_image":
+    elif field_action == "image":
         await send_or_edit_message(context, query.message.chat_id,
                                    f"'{product_name}' uchun yangi rasmni yuboring (/skip, /cancel):",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return ASK_EDIT_PRODUCT_NEW_IMAGE
-    elif field_action == "admin_edit_prod_field_category":
-        categories = db_fetch_all("SELECT id, name FROM categories ORDER BY name")
-        cat_keyboard_buttons = [[InlineKeyboardButton(name, callback_data=f"prod_setcat_{cat_id}")] for cat_id, name in
+    elif field_action == "category":
+        categories = repos.categories.list()
+        cat_keyboard_buttons = [[InlineKeyboardButton(name, callback_data=pack_callback("prod_setcat", cat_id))] for cat_id, name in
                                 categories]
-        cat_keyboard_buttons.append([InlineKeyboardButton("Kategoriyasiz qoldirish", callback_data="prod_setcat_None")])
-        cat_keyboard_buttons.append([InlineKeyboardButton("❌ Bekor qilish", callback_data="admin_cancel_conv")])
+        cat_keyboard_buttons.append([InlineKeyboardButton("Kategoriyasiz qoldirish", callback_data=pack_callback("prod_setcat", None))])
+        cat_keyboard_buttons.append([InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))])
         await send_or_edit_message(context, query.message.chat_id,
                                    f"'{product_name}' uchun yangi kategoriyani tanlang:",
                                    InlineKeyboardMarkup(cat_keyboard_buttons), query.message.message_id,
                                    delete_previous=True)
         return ASK_EDIT_PRODUCT_NEW_CATEGORY
+    elif field_action == "stock":
+        await send_or_edit_message(context, query.message.chat_id,
+                                   f"'{product_name}' uchun mavjud (band qilinmagan) donalar sonini kiriting.\n"
+                                   f"Hisob yuritilmasligi uchun /skip (/cancel):",
+                                   message_id_to_edit=query.message.message_id, delete_previous=True)
+        return ASK_EDIT_PRODUCT_NEW_STOCK
     # Narx uchun alohida handler chaqiriladi, bu routerga kirmaydi.
     return ConversationHandler.END
 
@@ -961,7 +3025,7 @@ async def admin_save_edited_product_name(update: Update, context: ContextTypes.D
     if not product_id: await update.message.reply_text("Mahsulot ID topilmadi."); await admin_panel_after_conv_end(
         update, context); return ConversationHandler.END
     if not new_name: await update.message.reply_text("Nom bo'sh bo'lmasligi kerak."); return ASK_EDIT_PRODUCT_NEW_NAME
-    db_query("UPDATE products SET name = ? WHERE id = ?", (new_name, product_id))
+    repos.products.update(product_id, name=new_name)
     await update.message.reply_text("✅ Mahsulot nomi yangilandi.")
     if 'editing_product_id_for_field' in context.user_data: del context.user_data['editing_product_id_for_field']
     # current_editing_product_id qoladi
@@ -976,7 +3040,7 @@ async def admin_save_edited_product_desc(update: Update, context: ContextTypes.D
     product_id = context.user_data.get('editing_product_id_for_field')
     if not product_id: await update.message.reply_text("Mahsulot ID topilmadi."); await admin_panel_after_conv_end(
         update, context); return ConversationHandler.END
-    db_query("UPDATE products SET description = ? WHERE id = ?", (new_desc, product_id))
+    repos.products.update(product_id, description=new_desc)
     await update.message.reply_text("✅ Mahsulot tavsifi yangilandi.")
     if 'editing_product_id_for_field' in context.user_data: del context.user_data['editing_product_id_for_field']
     await admin_panel_after_conv_end(update, context);
@@ -996,19 +3060,38 @@ async def admin_save_edited_product_image(update: Update, context: ContextTypes.
     product_id = context.user_data.get('editing_product_id_for_field')
     if not product_id: await update.message.reply_text("Mahsulot ID topilmadi."); await admin_panel_after_conv_end(
         update, context); return ConversationHandler.END
-    db_query("UPDATE products SET image_file_id = ? WHERE id = ?", (new_image_id, product_id))
+    repos.products.update(product_id, image_file_id=new_image_id)
     await update.message.reply_text("✅ Mahsulot rasmi yangilandi.")
     if 'editing_product_id_for_field' in context.user_data: del context.user_data['editing_product_id_for_field']
     await admin_panel_after_conv_end(update, context);
     return ConversationHandler.END
 
 
+async def admin_save_edited_product_stock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    new_stock = None
+    if update.message.text.lower() != "/skip":
+        try:
+            new_stock = int(update.message.text.strip())
+            if new_stock < 0: raise ValueError
+        except ValueError:
+            await update.message.reply_text("Son noto'g'ri. 0 yoki musbat butun son kiriting (/skip, /cancel):")
+            return ASK_EDIT_PRODUCT_NEW_STOCK
+    product_id = context.user_data.get('editing_product_id_for_field')
+    if not product_id: await update.message.reply_text("Mahsulot ID topilmadi."); await admin_panel_after_conv_end(
+        update, context); return ConversationHandler.END
+    repos.products.update(product_id, stock=new_stock)
+    await update.message.reply_text(
+        f"✅ Mahsulot zaxirasi yangilandi: {new_stock} dona." if new_stock is not None else "✅ Zaxira hisobi o'chirildi.")
+    if 'editing_product_id_for_field' in context.user_data: del context.user_data['editing_product_id_for_field']
+    await admin_panel_after_conv_end(update, context);
+    return ConversationHandler.END
+
+
 async def admin_save_edited_product_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query;
     await query.answer()
     product_id = context.user_data.get('editing_product_id_for_field')
-    new_cat_id_str = query.data.split("_")[-1]
-    new_cat_id = None if new_cat_id_str == "None" else int(new_cat_id_str)
+    new_cat_id = get_callback_args(query)[0]
     if not product_id:
         text_error = "Xatolik: Mahsulot ID topilmadi (kategoriyani saqlash)."
         logger.error(text_error)
@@ -1017,15 +3100,14 @@ async def admin_save_edited_product_category_callback(update: Update, context: C
         await admin_panel_after_callback_action(query, context, message_text_prefix="Xatolik yuz berdi.")
         return ConversationHandler.END
 
-    db_query("UPDATE products SET category_id = ? WHERE id = ?", (new_cat_id, product_id))
-    cat_name_tuple = db_fetch_one("SELECT name FROM categories WHERE id = ?", (new_cat_id,)) if new_cat_id else None
-    cat_name = cat_name_tuple[0] if cat_name_tuple else "Kategoriyasiz"
+    repos.products.update(product_id, category_id=new_cat_id)
+    cat_name = (repos.categories.get_name(new_cat_id) if new_cat_id else None) or "Kategoriyasiz"
     text_to_show = f"✅ Mahsulot kategoriyasi '{cat_name}' ga o'zgartirildi."
 
     if 'editing_product_id_for_field' in context.user_data: del context.user_data['editing_product_id_for_field']
 
     # Endi mahsulotni ko'rish ekraniga qaytamiz
-    fake_callback_query_data = f"admin_view_prod_{product_id}"
+    fake_callback_query_data = pack_callback("admin_view_prod", product_id)
     # `update` obyektini qayta ishlatishda ehtiyot bo'lish kerak, yangi Update yaratish yaxshiroq
     # Lekin bu yerda query.message ni ishlatsak bo'ladi
     new_update_for_view = Update(update_id=query.update_id,
@@ -1050,9 +3132,8 @@ async def admin_cancel_conv(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text_to_send = "Amal bekor qilindi."
     product_id_to_return_to = context.user_data.get('current_editing_product_id')
 
-    keys_to_clear = [k for k in context.user_data if
-                     k.startswith('new_product_') or k.startswith('edit_') or k.startswith('editing_') or k.startswith(
-                         'current_editing_')]
+    keys_to_clear = [k for k in context.user_data if isinstance(k, str) and k.startswith(
+        ('new_product_', 'edit_', 'editing_', 'current_editing_', 'import_', 'bulk_', 'broadcast_'))]
     for key in keys_to_clear:
         if key in context.user_data: del context.user_data[key]
 
@@ -1084,15 +3165,15 @@ async def admin_cancel_conv(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def admin_edit_price_entry_point(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query;
     await query.answer()
-    product_id = int(query.data.split("_")[-1])
-    product = db_fetch_one("SELECT name, price FROM products WHERE id = ?", (product_id,))
+    product_id = get_callback_args(query)[0]
+    product = repos.products.get_name_and_price(product_id)
     if not product:
         await send_or_edit_message(context, query.message.chat_id, "Mahsulot topilmadi.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return ConversationHandler.END
     context.user_data[EDIT_PRICE_ENTRY_PRODUCT_ID] = product_id
     await send_or_edit_message(context, query.message.chat_id,
-                               f"'{product[0]}' uchun yangi narxni kiriting (hozirgi: {product[1]:,.0f} so'm, /cancel):",
+                               f"'{product[0]}' uchun yangi narxni kiriting (hozirgi: {format_money(product[1])} so'm, /cancel):",
                                message_id_to_edit=query.message.message_id, delete_previous=True)
     return EDIT_PRICE_ASK_NEW_PRICE
 
@@ -1102,12 +3183,12 @@ async def admin_save_edited_price(update: Update, context: ContextTypes.DEFAULT_
     if not product_id: await update.message.reply_text("Mahsulot ID topilmadi."); await admin_panel_after_conv_end(
         update, context); return ConversationHandler.END
     try:
-        new_price = float(update.message.text.replace(",", "."))
+        new_price = parse_money(update.message.text)
+        if new_price is None: raise ValueError
         if new_price <= 0: await update.message.reply_text("Narx > 0 bo'lishi kerak."); return EDIT_PRICE_ASK_NEW_PRICE
-        db_query("UPDATE products SET price = ? WHERE id = ?", (new_price, product_id))
-        product_name_tuple = db_fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
-        product_name = product_name_tuple[0] if product_name_tuple else "Noma'lum"
-        await update.message.reply_text(f"✅ '{product_name}' narxi {new_price:,.0f} so'mga o'zgartirildi.")
+        repos.products.update(product_id, price=new_price)
+        product_name = repos.products.get_name(product_id) or "Noma'lum"
+        await update.message.reply_text(f"✅ '{product_name}' narxi {format_money(new_price)} so'mga o'zgartirildi.")
     except ValueError:
         await update.message.reply_text("Narx noto'g'ri."); return EDIT_PRICE_ASK_NEW_PRICE
     except Exception as e:
@@ -1124,20 +3205,20 @@ async def admin_delete_prod_confirm(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query;
     await query.answer()
     try:
-        product_id = int(query.data.split("_")[-1])
+        product_id = get_callback_args(query)[0]
     except:
         await send_or_edit_message(context, query.message.chat_id, "Xato ID.",
                                    message_id_to_edit=query.message.message_id, delete_previous=True); return
-    product = db_fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
-    if not product: await send_or_edit_message(context, query.message.chat_id, "Mahsulot topilmadi.",
+    product_name = repos.products.get_name(product_id)
+    if product_name is None: await send_or_edit_message(context, query.message.chat_id, "Mahsulot topilmadi.",
                                                message_id_to_edit=query.message.message_id,
                                                delete_previous=True); return
     keyboard = [
-        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=f"admin_delete_prod_execute_{product_id}")],
-        [InlineKeyboardButton("❌ Yo'q, bekor qilish", callback_data=f"admin_view_prod_{product_id}")]
+        [InlineKeyboardButton("✅ Ha, o'chirish", callback_data=pack_callback("admin_delete_prod_execute", product_id))],
+        [InlineKeyboardButton("❌ Yo'q, bekor qilish", callback_data=pack_callback("admin_view_prod", product_id))]
     ]
     await send_or_edit_message(context, query.message.chat_id,
-                               f"Haqiqatan ham '{product[0]}' mahsulotini o'chirmoqchimisiz?",
+                               f"Haqiqatan ham '{product_name}' mahsulotini o'chirmoqchimisiz?",
                                InlineKeyboardMarkup(keyboard), query.message.message_id, delete_previous=True)
 
 
@@ -1145,15 +3226,14 @@ async def admin_delete_prod_execute(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query;
     await query.answer()
     try:
-        product_id = int(query.data.split("_")[-1])
+        product_id = get_callback_args(query)[0]
     except:
         await send_or_edit_message(context, query.message.chat_id, "Xato ID (exec).",
                                    message_id_to_edit=query.message.message_id, delete_previous=True); return
-    product_name_tuple = db_fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
-    product_name = product_name_tuple[0] if product_name_tuple else "Noma'lum"
+    product_name = repos.products.get_name(product_id) or "Noma'lum"
     text_to_show = ""
     try:
-        db_query("DELETE FROM products WHERE id = ?", (product_id,))
+        repos.products.delete(product_id)
         text_to_show = f"🗑️ '{product_name}' mahsuloti o'chirildi."
     except Exception as e:
         text_to_show = f"Mahsulotni o'chirishda xatolik: {e}"
@@ -1161,34 +3241,536 @@ async def admin_delete_prod_execute(update: Update, context: ContextTypes.DEFAUL
     await admin_panel_after_callback_action(query, context, message_text_prefix=text_to_show)
 
 
+# --- Catalog Import (Admin) ---
+JSON_WHITESPACE_RE = re.compile(r"\s*")
+
+
+def iter_json_array_items(text):
+    # Massivni butunlay ro'yxatga yuklamasdan, elementma-element o'qiydi
+    decoder = json.JSONDecoder()
+    pos = JSON_WHITESPACE_RE.match(text, text.index("[") + 1).end()
+    if text.startswith("]", pos):
+        return
+    while True:
+        item, pos = decoder.raw_decode(text, pos)
+        yield item
+        pos = JSON_WHITESPACE_RE.match(text, pos).end()
+        if text.startswith("]", pos):
+            return
+        if not text.startswith(",", pos):
+            raise json.JSONDecodeError("',' yoki ']' kutilgan", text, pos)
+        pos = JSON_WHITESPACE_RE.match(text, pos + 1).end()
+
+
+def iter_catalog_import_rows(raw_bytes, file_name):
+    # (qator raqami, qator, xato) ko'rinishida birma-bir qaytaradi
+    lower_name = (file_name or "").lower()
+    if lower_name.endswith(".json") or lower_name.endswith(".jsonl"):
+        text = raw_bytes.decode("utf-8-sig")
+        if text.lstrip().startswith("["):
+            for row_no, item in enumerate(iter_json_array_items(text), start=1):
+                yield row_no, item, None
+            return
+        # JSON Lines: har bir qatorda bitta obyekt
+        for row_no, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                yield row_no, json.loads(line), None
+            except json.JSONDecodeError as e:
+                yield row_no, None, f"JSON xato: {e.msg}"
+        return
+
+    text_stream = io.TextIOWrapper(io.BytesIO(raw_bytes), encoding="utf-8-sig", newline="")
+    sample = text_stream.read(4096)
+    text_stream.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(text_stream, dialect=dialect)
+    for row_no, row in enumerate(reader, start=2):  # 1-qator sarlavha
+        yield row_no, row, None
+
+
+def validate_catalog_import_row(row):
+    if not isinstance(row, dict):
+        return None, "qator obyekt emas"
+    fields = {str(k).strip().lower(): v for k, v in row.items() if k is not None}
+    name = str(fields.get("name") or "").strip()
+    if not name:
+        return None, "'name' bo'sh"
+    category = str(fields.get("category") or "").strip() or None
+    price_raw = fields.get("price")
+    price = parse_money(price_raw) if price_raw is not None else None
+    if price is None:
+        return None, f"narx noto'g'ri: {price_raw!r}"
+    if price <= 0:
+        return None, "narx > 0 bo'lishi kerak"
+    description = str(fields.get("description") or "").strip() or None
+    image_file_id = str(fields.get("image_file_id") or "").strip() or None
+    return (category, name, description, price, image_file_id), None
+
+
+def _import_catalog_chunk(conn, chunk, category_ids, report):
+    # Bir xil (kategoriya, nom) bo'lsa, fayldagi oxirgi qator ustun
+    latest = {}
+    for row_no, parsed in chunk:
+        latest[(parsed[0], parsed[1])] = (row_no, parsed)
+    missing_categories = {cat for cat, _ in latest if cat and cat not in category_ids}
+    try:
+        with conn:
+            if missing_categories:
+                conn.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)",
+                                 [(name,) for name in missing_categories])
+                placeholders = ",".join("?" * len(missing_categories))
+                for cat_id, cat_name in conn.execute(
+                        f"SELECT id, name FROM categories WHERE name IN ({placeholders})",
+                        tuple(missing_categories)):
+                    category_ids[cat_name] = cat_id
+            rows = [(category_ids.get(cat) if cat else None, name, desc, price, img)
+                    for _, (cat, name, desc, price, img) in latest.values()]
+            updated = conn.executemany(
+                "UPDATE products SET description = ?, price = ?, image_file_id = COALESCE(?, image_file_id) "
+                "WHERE category_id IS ? AND name = ?",
+                [(desc, price, img, cat_id, name) for cat_id, name, desc, price, img in rows]).rowcount
+            inserted = conn.executemany(
+                "INSERT INTO products (category_id, name, description, price, image_file_id) "
+                "SELECT ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM products WHERE category_id IS ? AND name = ?)",
+                [(cat_id, name, desc, price, img, cat_id, name) for cat_id, name, desc, price, img in rows]).rowcount
+            # Faqat shu blokdagi mahsulotlar: butun katalog bo'yicha solishtirish har blokda takrorlanmasin
+            touched_ids = [row[0] for row in conn.execute(
+                f"SELECT p.id FROM products p JOIN (VALUES {','.join(['(?, ?)'] * len(rows))}) v "
+                f"ON p.category_id IS v.column1 AND p.name = v.column2",
+                [value for cat_id, name, _, _, _ in rows for value in (cat_id, name)])]
+            record_price_history(conn, touched_ids)
+    except sqlite3.Error as e:
+        logger.error("Katalog importida blokni yozishda xatolik: %s", e)
+        for row_no, _ in chunk:
+            report["errors"].append((row_no, f"bazaga yozilmadi: {e}"))
+        report["valid"] -= len(chunk)
+        return
+    report["new_categories"] += len(missing_categories)
+    report["updated"] += updated
+    report["inserted"] += inserted
+
+
+def refresh_catalog_after_bulk_change(conn):
+    # Ommaviy o'zgarishlardan keyin bir marta chaqiriladi (har bir qator uchun emas)
+    conn.execute("PRAGMA optimize")
+
+
+def import_catalog_rows(rows, dry_run=False):
+    # Fayl o'rtada buzilgan bo'lsa (CSV/JSON/kodlash xatosi), undan oldingi qatorlar yoziladi va
+    # report["aborted"] = (oxirgi o'qilgan qator, xato) bo'ladi: admin qisman import haqida aniq xabar oladi
+    report = {"total": 0, "valid": 0, "inserted": 0, "updated": 0, "new_categories": 0, "errors": [],
+              "aborted": None}
+    conn = db_connect()
+    try:
+        category_ids = {name: cat_id for cat_id, name in conn.execute("SELECT id, name FROM categories")}
+        new_category_names = set()
+        chunk = []
+        last_row_no = 0
+        try:
+            for row_no, row, error in rows:
+                last_row_no = row_no
+                report["total"] += 1
+                parsed = None
+                if error is None:
+                    parsed, error = validate_catalog_import_row(row)
+                if error:
+                    report["errors"].append((row_no, error))
+                    continue
+                report["valid"] += 1
+                if dry_run:
+                    if parsed[0] and parsed[0] not in category_ids:
+                        new_category_names.add(parsed[0])
+                    continue
+                chunk.append((row_no, parsed))
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    _import_catalog_chunk(conn, chunk, category_ids, report)
+                    chunk = []
+        except (UnicodeDecodeError, json.JSONDecodeError, csv.Error) as e:
+            report["aborted"] = (last_row_no, str(e))
+        if chunk:
+            _import_catalog_chunk(conn, chunk, category_ids, report)
+        if dry_run:
+            report["new_categories"] = len(new_category_names)
+        elif report["inserted"] or report["updated"]:
+            refresh_catalog_after_bulk_change(conn)
+    finally:
+        conn.close()
+    return report
+
+
+def format_catalog_import_report(report, dry_run):
+    title = "🔎 Import tekshiruvi (bazaga yozilmadi)" if dry_run else "📥 Import natijasi"
+    lines = [f"<b>{title}</b>",
+             f"Jami qatorlar: {report['total']}",
+             f"Yaroqli: {report['valid']}",
+             f"Xatolar: {len(report['errors'])}"]
+    if report["aborted"]:
+        last_row_no, error = report["aborted"]
+        error = html.escape(error, quote=False)
+        if last_row_no:
+            lines.insert(1, f"❗️ Fayl {last_row_no}-qatordan keyin o'qilmadi: {error}\n"
+                            + ("Shu joygacha tekshirildi." if dry_run else "Shu joygacha bo'lgan qatorlar yozildi."))
+        else:
+            lines.insert(1, f"❗️ Faylni o'qib bo'lmadi: {error}")
+    if dry_run:
+        lines.append(f"Yaratiladigan kategoriyalar: {report['new_categories']}")
+    else:
+        lines.append(f"Qo'shildi: {report['inserted']}")
+        lines.append(f"Yangilandi: {report['updated']}")
+        lines.append(f"Yangi kategoriyalar: {report['new_categories']}")
+    if report["errors"]:
+        lines.append("")
+        for row_no, error in report["errors"][:IMPORT_MAX_REPORTED_ERRORS]:
+            lines.append(f"• {row_no}-qator: {html.escape(error, quote=False)}")
+        if len(report["errors"]) > IMPORT_MAX_REPORTED_ERRORS:
+            lines.append(f"... va yana {len(report['errors']) - IMPORT_MAX_REPORTED_ERRORS} ta (to'liq ro'yxat faylda)")
+    return "\n".join(lines)
+
+
+async def admin_import_catalog_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    text = ("CSV yoki JSON fayl orqali mahsulotlarni import qilish.\n"
+            "Ustunlar: <code>category, name, description, price, image_file_id</code>\n"
+            "Mavjud mahsulot (bir xil kategoriya va nom) yangilanadi, qolganlari qo'shiladi.\n\n"
+            "Rejimni tanlang:")
+    keyboard = [
+        [InlineKeyboardButton("🔎 Faqat tekshirish", callback_data=pack_callback("admin_import_mode", "dry"))],
+        [InlineKeyboardButton("📥 Import qilish", callback_data=pack_callback("admin_import_mode", "apply"))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))]
+    ]
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               query.message.message_id, delete_previous=True)
+    return IMPORT_SELECT_MODE
+
+
+async def admin_import_catalog_select_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data['import_dry_run'] = get_callback_args(query)[0] == "dry"
+    await send_or_edit_message(context, query.message.chat_id,
+                               "CSV (.csv) yoki JSON (.json, .jsonl) faylni yuboring (/cancel):",
+                               message_id_to_edit=query.message.message_id, delete_previous=True)
+    return IMPORT_ASK_DOCUMENT
+
+
+async def admin_import_catalog_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    document = update.message.document
+    if not document:
+        await update.message.reply_text("CSV yoki JSON fayl yuboring (/cancel):")
+        return IMPORT_ASK_DOCUMENT
+    if not (document.file_name or "").lower().endswith(IMPORT_ALLOWED_EXTENSIONS):
+        await update.message.reply_text("Faqat .csv, .json yoki .jsonl fayllar qabul qilinadi.")
+        return IMPORT_ASK_DOCUMENT
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text("Fayl juda katta (maksimum 20 MB).")
+        return IMPORT_ASK_DOCUMENT
+
+    dry_run = context.user_data.pop('import_dry_run', False)
+    tg_file = await document.get_file()
+    raw_bytes = bytes(await tg_file.download_as_bytearray())
+    report = import_catalog_rows(iter_catalog_import_rows(raw_bytes, document.file_name), dry_run=dry_run)
+    if report["aborted"]:
+        logger.warning("Katalog importi: fayl %s-qatordan keyin o'qilmadi (%s): %s", report["aborted"][0],
+                       document.file_name, report["aborted"][1])
+    logger.info("Katalog importi (dry_run=%s): %s qator, %s qo'shildi, %s yangilandi, %s xato", dry_run,
+                report["total"], report["inserted"], report["updated"], len(report["errors"]))
+
+    await update.message.reply_text(format_catalog_import_report(report, dry_run), parse_mode='HTML')
+    if len(report["errors"]) > IMPORT_MAX_REPORTED_ERRORS:
+        error_lines = "\n".join(f"{row_no}: {error}" for row_no, error in report["errors"])
+        await update.message.reply_document(document=io.BytesIO(error_lines.encode("utf-8")),
+                                            filename="import_xatolar.txt")
+    await admin_panel_after_conv_end(update, context)
+    return ConversationHandler.END
+
+
+# --- Bulk Product Operations (Admin) ---
+def parse_bulk_price_change(text):
+    match = BULK_PRICE_CHANGE_RE.match(text or "")
+    if not match:
+        return None
+    sign, amount_str, percent, round_to_str, round_mode = match.groups()
+    # Foiz - son; summa va yaxlitlash qadami - tiyinda
+    amount = float(amount_str.replace(",", ".")) if percent else parse_money(amount_str)
+    if sign == "=":
+        if percent or amount <= 0:
+            return None
+        kind = "set"
+    else:
+        kind = "percent" if percent else "delta"
+        if sign == "-":
+            amount = -amount
+    round_to = int(round_to_str) * MONEY_MINOR_PER_UNIT if round_to_str else 0
+    mode = BULK_ROUND_MODES.get((round_mode or "").lower(), "nearest")
+    return {"kind": kind, "amount": amount, "round_to": round_to, "round_mode": mode}
+
+
+def describe_bulk_price_change(change):
+    if change["kind"] == "set":
+        text = f"narx = {format_money(change['amount'])} so'm"
+    elif change["kind"] == "percent":
+        text = f"narx {change['amount']:+g}%"
+    else:
+        text = f"narx {format_money(change['amount'], sign=True)} so'm"
+    if change["round_to"]:
+        mode_names = {"nearest": "yaqinroq", "up": "yuqoriga", "down": "pastga"}
+        text += f", {format_money(change['round_to'])} gacha {mode_names[change['round_mode']]} yaxlitlanadi"
+    return text
+
+
+def build_bulk_price_expression(change):
+    if change["kind"] == "percent":
+        # Avval butun tiyingacha: 1.1 kabi ko'paytmalardagi float xatosi yaxlitlashni bir qadam surib yubormasin
+        expr, params = "ROUND(price * (1 + ? / 100.0))", [change["amount"]]
+    elif change["kind"] == "delta":
+        expr, params = "price + ?", [change["amount"]]
+    else:
+        expr, params = "?", [change["amount"]]
+    step = float(change["round_to"])  # REAL: butun sonli bo'lish kasrni tashlab yubormasin
+    if step:
+        if change["round_mode"] == "up":
+            expr = (f"((CAST(({expr}) / ? AS INTEGER) + (({expr}) / ? > CAST(({expr}) / ? AS INTEGER))) * ?)")
+            params = params + [step] + params + [step] + params + [step, step]
+        elif change["round_mode"] == "down":
+            expr, params = f"(CAST(({expr}) / ? AS INTEGER) * ?)", params + [step, step]
+        else:
+            expr, params = f"(ROUND(({expr}) / ?) * ?)", params + [step, step]
+    # Narx hech qachon 0 yoki manfiy bo'lib qolmasligi kerak; natija tiyinda butun son
+    return f"CAST(ROUND(MAX({expr}, ?)) AS INTEGER)", params + [step or MONEY_MINOR_PER_UNIT]
+
+
+def build_bulk_product_filter(source, name_filter):
+    clauses, params = [], []
+    if source == "none":
+        clauses.append("category_id IS NULL")
+    elif source != "all":
+        clauses.append("category_id = ?")
+        params.append(int(source))
+    if name_filter:
+        escaped = name_filter.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        clauses.append("name LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped}%")
+    return (" AND ".join(clauses) or "1 = 1"), params
+
+
+def preview_bulk_product_operation(operation, source, name_filter, price_change=None):
+    where_sql, where_params = build_bulk_product_filter(source, name_filter)
+    if operation == "price":
+        price_expr, price_params = build_bulk_price_expression(price_change)
+        return db_fetch_one(
+            f"SELECT COUNT(*), MIN(price), MAX(price), MIN({price_expr}), MAX({price_expr}) "
+            f"FROM products WHERE {where_sql}",
+            tuple(price_params + price_params + where_params))
+    return db_fetch_one(f"SELECT COUNT(*), MIN(price), MAX(price), NULL, NULL FROM products WHERE {where_sql}",
+                        tuple(where_params))
+
+
+def run_bulk_product_operation(operation, source, name_filter, price_change=None, target_category_id=None):
+    where_sql, where_params = build_bulk_product_filter(source, name_filter)
+    if operation == "price":
+        price_expr, price_params = build_bulk_price_expression(price_change)
+        sql = f"UPDATE products SET price = {price_expr} WHERE {where_sql} RETURNING id"
+        params = price_params + where_params
+    elif operation == "move":
+        sql, params = f"UPDATE products SET category_id = ? WHERE {where_sql}", [target_category_id] + where_params
+    else:
+        sql, params = f"DELETE FROM products WHERE {where_sql}", where_params
+    conn = db_connect()
+    try:
+        with conn:
+            cursor = conn.execute(sql, tuple(params))
+            if operation == "price":
+                product_ids = [row[0] for row in cursor]
+                record_price_history(conn, product_ids)
+                affected = len(product_ids)
+            else:
+                affected = cursor.rowcount
+        refresh_catalog_after_bulk_change(conn)
+    finally:
+        conn.close()
+    return affected
+
+
+def _bulk_category_keyboard(prefix, categories, include_all):
+    keyboard = [[InlineKeyboardButton(name, callback_data=pack_callback(prefix, cat_id))] for cat_id, name in categories]
+    if include_all:
+        keyboard.append([InlineKeyboardButton("Barcha mahsulotlar", callback_data=pack_callback(prefix, "all"))])
+    keyboard.append([InlineKeyboardButton("Kategoriyasiz", callback_data=pack_callback(prefix, "none"))])
+    keyboard.append([InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def admin_bulk_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    keyboard = [
+        [InlineKeyboardButton("💹 Narxlarni o'zgartirish", callback_data=pack_callback("bulk_op", "price"))],
+        [InlineKeyboardButton("🔀 Boshqa kategoriyaga ko'chirish", callback_data=pack_callback("bulk_op", "move"))],
+        [InlineKeyboardButton("🗑️ O'chirish", callback_data=pack_callback("bulk_op", "delete"))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))]
+    ]
+    await send_or_edit_message(context, query.message.chat_id, "Ommaviy amalni tanlang:",
+                               InlineKeyboardMarkup(keyboard), query.message.message_id, delete_previous=True)
+    return BULK_SELECT_OPERATION
+
+
+async def admin_bulk_select_operation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data['bulk_operation'] = get_callback_args(query)[0]
+    categories = repos.categories.list()
+    await send_or_edit_message(context, query.message.chat_id, "Qaysi mahsulotlarga qo'llansin?",
+                               _bulk_category_keyboard("bulk_src", categories, include_all=True),
+                               query.message.message_id, delete_previous=True)
+    return BULK_SELECT_SOURCE
+
+
+async def admin_bulk_select_source(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data['bulk_source'] = get_callback_args(query)[0]
+    await send_or_edit_message(context, query.message.chat_id,
+                               "Nomi bo'yicha filtr kiriting (nomida shu matn bo'lgan mahsulotlar tanlanadi) "
+                               "yoki /skip (/cancel):",
+                               message_id_to_edit=query.message.message_id, delete_previous=True)
+    return BULK_ASK_NAME_FILTER
+
+
+async def admin_bulk_name_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    name_filter = None
+    if update.message.text and update.message.text.lower() != "/skip":
+        name_filter = update.message.text.strip() or None
+    context.user_data['bulk_name_filter'] = name_filter
+    operation = context.user_data.get('bulk_operation')
+    if operation == "price":
+        await update.message.reply_text(
+            "Narx o'zgarishini kiriting (/cancel):\n"
+            "<code>+10%</code>, <code>-15%</code> — foiz bo'yicha\n"
+            "<code>+20000</code>, <code>-5000</code> — summa bo'yicha\n"
+            "<code>=150000</code> — aniq narx\n"
+            "Yaxlitlash uchun qadamni qo'shing: <code>+10% 1000</code>, "
+            "<code>+10% 1000 up</code> yoki <code>+10% 1000 down</code>",
+            parse_mode='HTML')
+        return BULK_ASK_PRICE_CHANGE
+    if operation == "move":
+        categories = repos.categories.list()
+        await update.message.reply_text("Mahsulotlar qaysi kategoriyaga ko'chirilsin?",
+                                        reply_markup=_bulk_category_keyboard("bulk_dst", categories,
+                                                                             include_all=False))
+        return BULK_SELECT_TARGET
+    return await admin_bulk_show_preview(update, context)
+
+
+async def admin_bulk_price_change(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    price_change = parse_bulk_price_change(update.message.text)
+    if not price_change:
+        await update.message.reply_text("Format noto'g'ri. Masalan: +10% 1000 (/cancel)")
+        return BULK_ASK_PRICE_CHANGE
+    context.user_data['bulk_price_change'] = price_change
+    return await admin_bulk_show_preview(update, context)
+
+
+async def admin_bulk_select_target(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    target = get_callback_args(query)[0]
+    context.user_data['bulk_target_category_id'] = None if target == "none" else target
+    return await admin_bulk_show_preview(update, context)
+
+
+async def admin_bulk_show_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    operation = context.user_data.get('bulk_operation')
+    price_change = context.user_data.get('bulk_price_change')
+    count, min_price, max_price, new_min_price, new_max_price = preview_bulk_product_operation(
+        operation, context.user_data.get('bulk_source', "all"), context.user_data.get('bulk_name_filter'),
+        price_change)
+    chat_id = update.effective_chat.id
+    if not count:
+        await context.bot.send_message(chat_id, "Filtrga mos mahsulot topilmadi.")
+        for key in [k for k in context.user_data if isinstance(k, str) and k.startswith('bulk_')]:
+            del context.user_data[key]
+        await context.bot.send_message(chat_id, "Admin Panel:",
+                                       reply_markup=InlineKeyboardMarkup(build_admin_panel_keyboard()))
+        return ConversationHandler.END
+
+    text = f"Filtrga mos mahsulotlar: <b>{count}</b> ta\n"
+    if operation == "price":
+        text += (f"Amal: {describe_bulk_price_change(price_change)}\n"
+                 f"Narxlar: {format_money(min_price)} – {format_money(max_price)} so'm → "
+                 f"{format_money(new_min_price)} – {format_money(new_max_price)} so'm")
+    elif operation == "move":
+        target_id = context.user_data.get('bulk_target_category_id')
+        target_name = repos.categories.get_name(target_id) if target_id else None
+        text += f"Amal: '{target_name or 'Kategoriyasiz'}' ga ko'chirish"
+    else:
+        text += "Amal: ⚠️ <b>o'chirish</b> (qaytarib bo'lmaydi)"
+    keyboard = [
+        [InlineKeyboardButton("✅ Tasdiqlash", callback_data=pack_callback("bulk_confirm"))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))]
+    ]
+    await context.bot.send_message(chat_id, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    return BULK_CONFIRM
+
+
+async def admin_bulk_execute(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    operation = context.user_data.get('bulk_operation')
+    try:
+        affected = run_bulk_product_operation(operation, context.user_data.get('bulk_source', "all"),
+                                              context.user_data.get('bulk_name_filter'),
+                                              price_change=context.user_data.get('bulk_price_change'),
+                                              target_category_id=context.user_data.get('bulk_target_category_id'))
+        logger.info("Ommaviy amal '%s' bajarildi: %s ta mahsulot", operation, affected)
+        text_to_show = f"✅ Ommaviy amal bajarildi: {affected} ta mahsulot."
+    except sqlite3.Error as e:
+        logger.error("Ommaviy amal '%s' da xatolik: %s", operation, e)
+        text_to_show = f"❗️ Ommaviy amal bajarilmadi (hech narsa o'zgarmadi): {e}"
+    for key in [k for k in context.user_data if isinstance(k, str) and k.startswith('bulk_')]:
+        del context.user_data[key]
+    await admin_panel_after_callback_action(query, context, message_text_prefix=text_to_show)
+    return ConversationHandler.END
+
+
+def format_order_customer(user_id, first_name, last_name, username):
+    display_name = (f"{first_name} {last_name}").strip()
+    if not display_name:
+        if username and username.lower() != 'n/a':
+            display_name = f"@{username}"
+        else:
+            display_name = f"Mijoz ID: <code>{user_id}</code>"
+    elif username and username.lower() != 'n/a' and f"@{username}" not in display_name:
+        display_name += f" (@{username})"
+    return display_name
+
+
+def format_order_timestamp(timestamp_str):
+    try:
+        return datetime.fromisoformat(timestamp_str.split('.')[0]).strftime("%Y-%m-%d %H:%M:%S")
+    except:
+        return timestamp_str.split('.')[0] if '.' in timestamp_str else timestamp_str
+
+
 async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     await save_user_info(query.from_user)
-    logger.info(f"admin_view_orders: Admin {query.from_user.id} buyurtmalarni ko'rmoqda.")
-
-    orders_data = db_fetch_all("""
-                               SELECT o.id,
-                                      o.user_id,
-                                      COALESCE(u.first_name, '')                                      AS u_fname,
-                                      COALESCE(u.last_name, '')                                       AS u_lname,
-                                      o.user_username,
-                                      o.phone_number,
-                                      COALESCE(o.product_name_at_order, p.name, 'Noma''lum mahsulot') as product_display_name, -- TIRNOQ TO'G'RILANDI
-                                      COALESCE(o.product_price_at_order, p.price, 0)                  as product_display_price,
-                                      o.timestamp
-                               FROM orders o
-                                        LEFT JOIN products p ON o.product_id = p.id
-                                        LEFT JOIN users u ON o.user_id = u.id
-                               ORDER BY o.timestamp DESC LIMIT 30
-                               """)
-    logger.info(f"admin_view_orders: Bazadan {len(orders_data)} ta buyurtma olindi.")
+    orders_logger.info("admin_view_orders: Admin %s buyurtmalarni ko'rmoqda.", query.from_user.id)
+
+    orders_data = repos.orders.recent(30)
+    orders_logger.info("admin_view_orders: Bazadan %s ta buyurtma olindi.", len(orders_data))
     if not orders_data:
-        logger.info("admin_view_orders: Bazada buyurtmalar topilmadi.")
+        orders_logger.info("admin_view_orders: Bazada buyurtmalar topilmadi.")
         await send_or_edit_message(context, query.message.chat_id,
                                    "Hozircha buyurtmalar mavjud emas.",
                                    reply_markup=InlineKeyboardMarkup(
-                                       [[InlineKeyboardButton("⬅️ Admin Panelga", callback_data="admin_panel")]]),
+                                       [[InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]]),
                                    message_id_to_edit=query.message.message_id, delete_previous=True)
         return
 
@@ -1196,26 +3778,12 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
     current_message_id_for_parts = query.message.message_id
 
     for i, order_tuple in enumerate(orders_data):
-        logger.debug(f"admin_view_orders: Formatlanayotgan buyurtma: {order_tuple}")
+        orders_logger.debug("admin_view_orders: Formatlanayotgan buyurtma: %s", order_tuple)
         (order_id, user_id_db, u_fname, u_lname, user_username_from_orders,
          phone, prod_name, prod_price, timestamp_str) = order_tuple
 
-        user_full_name_from_users = (f"{u_fname} {u_lname}").strip()
-        display_name = user_full_name_from_users
-        if not display_name:
-            if user_username_from_orders and user_username_from_orders.lower() != 'n/a':
-                display_name = f"@{user_username_from_orders}"
-            else:
-                display_name = f"Mijoz ID: <code>{user_id_db}</code>"
-        elif user_username_from_orders and user_username_from_orders.lower() != 'n/a' and f"@{user_username_from_orders}" not in display_name:
-            display_name += f" (@{user_username_from_orders})"
-
-        formatted_timestamp = ""
-        try:
-            dt_object = datetime.fromisoformat(timestamp_str.split('.')[0])
-            formatted_timestamp = dt_object.strftime("%Y-%m-%d %H:%M:%S")
-        except:
-            formatted_timestamp = timestamp_str.split('.')[0] if '.' in timestamp_str else timestamp_str
+        display_name = format_order_customer(user_id_db, u_fname, u_lname, user_username_from_orders)
+        formatted_timestamp = format_order_timestamp(timestamp_str)
 
         order_info = (
             f"\n➖➖➖➖➖➖➖➖➖➖➖\n"
@@ -1223,12 +3791,12 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"👤 Mijoz: {display_name}\n"
             f"📞 Telefon: <code>{phone}</code>\n"
             f"🛍️ Mahsulot: {prod_name}\n"
-            f"💰 Narxi: {prod_price or 0:,.0f} so'm\n"
+            f"💰 Narxi: {format_money(prod_price)} so'm\n"
             f"🕒 Vaqti: {formatted_timestamp}"
         )
 
         if len(message_text + order_info) > 4050:
-            logger.info("admin_view_orders: Xabar uzunligi chegaraga yetdi, qisman yuborilmoqda.")
+            orders_logger.info("admin_view_orders: Xabar uzunligi chegaraga yetdi, qisman yuborilmoqda.")
             delete_flag_for_part = (i == 0 and current_message_id_for_parts == query.message.message_id)
             await send_or_edit_message(context, query.message.chat_id, message_text, parse_mode='HTML',
                                        message_id_to_edit=current_message_id_for_parts,
@@ -1238,15 +3806,15 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
         message_text += order_info
 
     message_text += "\n➖➖➖➖➖➖➖➖➖➖➖"
-    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Panelga", callback_data="admin_panel")]])
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]])
 
-    logger.info("admin_view_orders: Buyurtmalar ro'yxati adminga yuborilmoqda (oxirgi qism).")
+    orders_logger.info("admin_view_orders: Buyurtmalar ro'yxati adminga yuborilmoqda (oxirgi qism).")
     delete_flag_for_final = False
     if query.message and current_message_id_for_parts == query.message.message_id and query.message.text != message_text:
         delete_flag_for_final = True  # Faqat agar xabar o'zgargan bo'lsa va birinchi xabar bo'lsa o'chiramiz
 
     if query.message and current_message_id_for_parts == query.message.message_id and query.message.text == message_text and query.message.reply_markup == reply_markup:
-        logger.debug("admin_view_orders: Xabar va tugmalar o'zgarmagan, yuborilmaydi yoki tahrirlanmaydi.")
+        orders_logger.debug("admin_view_orders: Xabar va tugmalar o'zgarmagan, yuborilmaydi yoki tahrirlanmaydi.")
     else:
         await send_or_edit_message(context, query.message.chat_id, message_text, reply_markup,
                                    message_id_to_edit=current_message_id_for_parts,
@@ -1254,35 +3822,720 @@ async def admin_view_orders(update: Update, context: ContextTypes.DEFAULT_TYPE)
                                    delete_previous=delete_flag_for_final)
 
 
+def build_order_status_keyboard(order_id, current_status):
+    buttons = [InlineKeyboardButton(ORDER_STATUS_LABELS[status], callback_data=pack_callback("admin_order_status", order_id, status))
+               for status in ORDER_STATUSES if status != current_status]
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton(f"⬅️ {ORDER_STATUS_LABELS[current_status]} navbati",
+                                          callback_data=pack_callback("admin_order_queue", current_status)),
+                     InlineKeyboardButton("🏠 Admin Panelga", callback_data=pack_callback("admin_panel"))])
+    return InlineKeyboardMarkup(keyboard)
+
+
+async def show_admin_order_card(query, context, order_id, notice=""):
+    order = repos.orders.get(order_id)
+    if order is None:
+        await send_or_edit_message(context, query.message.chat_id,
+                                   f"Buyurtma #{order_id} topilmadi (arxivlangan bo'lishi mumkin).",
+                                   InlineKeyboardMarkup([[InlineKeyboardButton(
+                                       "⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]]),
+                                   message_id_to_edit=query.message.message_id)
+        return
+    _, user_id, first_name, last_name, username, phone, product_name, price, timestamp_str, status = order
+    text = (
+        f"{notice}🆔 Buyurtma Raqami: <b>{order_id}</b>\n"
+        f"📌 Holati: <b>{ORDER_STATUS_LABELS.get(status, status)}</b>\n"
+        f"👤 Mijoz: {format_order_customer(user_id, first_name, last_name, username)}\n"
+        f"📞 Telefon: <code>{phone}</code>\n"
+        f"🛍️ Mahsulot: {product_name}\n"
+        f"💰 Narxi: {format_money(price)} so'm\n"
+        f"🕒 Vaqti: {format_order_timestamp(timestamp_str)}"
+    )
+    await send_or_edit_message(context, query.message.chat_id, text, build_order_status_keyboard(order_id, status),
+                               message_id_to_edit=query.message.message_id)
+
+
+async def admin_view_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    await show_admin_order_card(query, context, get_callback_args(query)[0])
+
+
+async def admin_set_order_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    order_id, status = get_callback_args(query)[:2]
+    if status not in ORDER_STATUSES:
+        await query.answer("Noma'lum holat.")
+        return
+    previous = repos.orders.set_status(order_id, status)
+    if previous is None:
+        await query.answer("Buyurtma topilmadi.")
+    else:
+        await query.answer(f"Holat: {ORDER_STATUS_LABELS[status]}")
+        order = repos.orders.get(order_id)
+        if order:
+            order_history_cache.invalidate(order[1])
+        orders_logger.info("Admin %s buyurtma #%s holatini o'zgartirdi: %s -> %s",
+                           query.from_user.id, order_id, previous, status)
+    await show_admin_order_card(query, context, order_id)
+
+
+async def admin_order_queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Keyset sahifalash: "Keyingilar" tugmasida sahifadagi oxirgi buyurtmaning (timestamp, id) si, OFFSET ishlatilmaydi
+    query = update.callback_query
+    await query.answer()
+    args = get_callback_args(query)
+    status, before = args[0], tuple(args[1:3]) if len(args) >= 3 else None
+    if status not in ORDER_STATUSES:
+        return
+    orders = repos.orders.list_by_status(status, ORDER_QUEUE_PAGE_SIZE + 1, before)
+    has_more = len(orders) > ORDER_QUEUE_PAGE_SIZE
+    orders = orders[:ORDER_QUEUE_PAGE_SIZE]
+    total = repos.orders.status_counts().get(status, 0)
+    text = f"<b>{ORDER_STATUS_LABELS[status]}</b> buyurtmalar: {total} ta\n"
+    keyboard = []
+    if not orders:
+        text += "\nBu holatda buyurtmalar yo'q."
+    for order_id, user_id, first_name, last_name, username, phone, product_name, price, timestamp_str in orders:
+        text += (f"\n<b>#{order_id}</b> · {format_order_timestamp(timestamp_str)}\n"
+                 f"{format_order_customer(user_id, first_name, last_name, username)} · <code>{phone}</code>\n"
+                 f"{product_name} — {format_money(price)} so'm\n")
+        keyboard.append([InlineKeyboardButton(f"#{order_id} · {product_name[:30]}",
+                                              callback_data=pack_callback("admin_order", order_id))])
+    navigation = []
+    if before is not None:
+        navigation.append(InlineKeyboardButton("⏮ Boshiga", callback_data=pack_callback("admin_order_queue", status)))
+    if has_more:
+        navigation.append(InlineKeyboardButton("Keyingilar ➡️", callback_data=pack_callback(
+            "admin_order_queue", status, orders[-1][-1], orders[-1][0])))
+    if navigation:
+        keyboard.append(navigation)
+    keyboard.append([InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))])
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               message_id_to_edit=query.message.message_id)
+
+
+# --- Broadcast (Admin) ---
+async def admin_broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    action, args = unpack_callback(query.data)
+    if action == "admin_broadcast_product":
+        context.user_data['broadcast_kind'] = "product"
+        context.user_data['broadcast_product_id'] = args[0]
+    else:
+        context.user_data['broadcast_kind'] = "text"
+        context.user_data.pop('broadcast_product_id', None)
+    keyboard = [
+        [InlineKeyboardButton("👥 Barcha foydalanuvchilar", callback_data=pack_callback("bc_seg", "all"))],
+        [InlineKeyboardButton("🛍️ Xarid qilganlar", callback_data=pack_callback("bc_seg", "buyers"))],
+        [InlineKeyboardButton("👀 Hali xarid qilmaganlar", callback_data=pack_callback("bc_seg", "nonbuyers"))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))]
+    ]
+    await send_or_edit_message(context, query.message.chat_id, "Xabar kimlarga yuborilsin?",
+                               InlineKeyboardMarkup(keyboard), query.message.message_id, delete_previous=True)
+    return BROADCAST_SELECT_SEGMENT
+
+
+async def admin_broadcast_select_segment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    context.user_data['broadcast_segment'] = get_callback_args(query)[0]
+    if context.user_data.get('broadcast_kind') == "product":
+        return await admin_broadcast_show_preview(update, context)
+    await send_or_edit_message(context, query.message.chat_id, "Yuboriladigan xabar matnini kiriting (/cancel):",
+                               message_id_to_edit=query.message.message_id, delete_previous=True)
+    return BROADCAST_ASK_TEXT
+
+
+async def admin_broadcast_receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['broadcast_text'] = update.message.text_html
+    return await admin_broadcast_show_preview(update, context)
+
+
+async def admin_broadcast_show_preview(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    segment = context.user_data.get('broadcast_segment', "all")
+    recipients = count_broadcast_recipients(segment)
+    kind = context.user_data.get('broadcast_kind')
+    content = build_broadcast_content(kind, context.user_data.get('broadcast_text'),
+                                      context.user_data.get('broadcast_product_id'))
+    chat_id = update.effective_chat.id
+    if content is None:
+        await context.bot.send_message(chat_id, "Mahsulot topilmadi.")
+        return await admin_broadcast_finish_conv(update, context)
+    segment_names = {"all": "barcha foydalanuvchilar", "buyers": "xarid qilganlar",
+                     "nonbuyers": "hali xarid qilmaganlar"}
+    await context.bot.send_message(chat_id, "Xabar ko'rinishi:")
+    if content["photo"]:
+        await context.bot.send_photo(chat_id, content["photo"], caption=content["text"],
+                                     reply_markup=content["reply_markup"], parse_mode='HTML')
+    else:
+        await context.bot.send_message(chat_id, content["text"], reply_markup=content["reply_markup"],
+                                       parse_mode='HTML')
+    keyboard = [
+        [InlineKeyboardButton(f"✅ Yuborish ({recipients} ta)", callback_data=pack_callback("bc_confirm"))],
+        [InlineKeyboardButton("❌ Bekor qilish", callback_data=pack_callback("admin_cancel_conv"))]
+    ]
+    await context.bot.send_message(chat_id, f"Qabul qiluvchilar: {segment_names[segment]} — {recipients} ta.",
+                                   reply_markup=InlineKeyboardMarkup(keyboard))
+    return BROADCAST_CONFIRM
+
+
+async def admin_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    broadcast_id = db_query(
+        "INSERT INTO broadcasts (kind, text, product_id, segment, admin_chat_id, progress_message_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (context.user_data.get('broadcast_kind'), context.user_data.get('broadcast_text'),
+         context.user_data.get('broadcast_product_id'), context.user_data.get('broadcast_segment', "all"),
+         query.message.chat_id, query.message.message_id))
+    await report_broadcast_progress(context.bot, broadcast_id, query.message.chat_id, query.message.message_id,
+                                    "📣 Xabar yuborish boshlandi...", running=True)
+    start_broadcast_task(context.application, broadcast_id)
+    for key in [k for k in context.user_data if isinstance(k, str) and k.startswith('broadcast_')]:
+        del context.user_data[key]
+    return ConversationHandler.END
+
+
+async def admin_broadcast_finish_conv(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    for key in [k for k in context.user_data if isinstance(k, str) and k.startswith('broadcast_')]:
+        del context.user_data[key]
+    await context.bot.send_message(update.effective_chat.id, "Admin Panel:",
+                                   reply_markup=InlineKeyboardMarkup(build_admin_panel_keyboard()))
+    return ConversationHandler.END
+
+
+async def admin_broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    broadcast_id = get_callback_args(query)[0]
+    db_query("UPDATE broadcasts SET status = 'cancelled' WHERE id = ? AND status = 'running'", (broadcast_id,))
+    await query.answer("Joriy partiya tugagach to'xtatiladi.")
+
+
+# --- Sales Analytics (Admin) ---
+def fetch_sales_dashboard(period, buckets_count=ANALYTICS_BUCKETS_SHOWN, top_count=ANALYTICS_TOP_SHOWN):
+    # Faqat yig'ma jadvallardan o'qiladi, orders jadvaliga tegmaydi
+    now = datetime.now(timezone.utc)
+    current = {}
+    for name, fmt in SALES_PERIOD_FORMATS.items():
+        current[name] = db_fetch_one("SELECT revenue, order_count FROM sales_rollup WHERE period = ? AND bucket = ?",
+                                     (name, now.strftime(fmt))) or (0, 0)
+    history = db_fetch_all(
+        "SELECT bucket, revenue, order_count FROM sales_rollup WHERE period = ? ORDER BY bucket DESC LIMIT ?",
+        (period, buckets_count))
+    top_products = db_fetch_all(
+        "SELECT product_name, revenue, order_count FROM sales_product_totals WHERE order_count > 0 "
+        "ORDER BY revenue DESC LIMIT ?",
+        (top_count,))
+    top_categories = db_fetch_all(
+        "SELECT c.name, t.category_id, t.revenue, t.order_count FROM sales_category_totals t "
+        "LEFT JOIN categories c ON c.id = t.category_id WHERE t.order_count > 0 ORDER BY t.revenue DESC LIMIT ?", (top_count,))
+    counters = dict(db_fetch_all("SELECT name, value FROM sales_counters"))
+    return {"current": current, "history": history, "top_products": top_products,
+            "top_categories": top_categories, "customers": counters.get("customers", 0),
+            "repeat_customers": counters.get("repeat_customers", 0)}
+
+
+async def admin_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    args = get_callback_args(query)
+    period = args[0] if args else "day"
+    if period not in SALES_PERIOD_FORMATS:
+        period = "day"
+    dashboard = fetch_sales_dashboard(period)
+    period_titles = {"day": "Kunlik", "week": "Haftalik", "month": "Oylik"}
+
+    text = "<b>📊 Savdo statistikasi</b>\n\n"
+    for name, title in (("day", "Bugun"), ("week", "Shu hafta"), ("month", "Shu oy")):
+        revenue, order_count = dashboard["current"][name]
+        text += f"{title}: <b>{format_money(revenue)} so'm</b> ({order_count} ta buyurtma)\n"
+
+    text += f"\n<b>{period_titles[period]} tushum:</b>\n"
+    if dashboard["history"]:
+        for bucket, revenue, order_count in dashboard["history"]:
+            text += f"{bucket}: {format_money(revenue)} so'm ({order_count} ta)\n"
+    else:
+        text += "Ma'lumot yo'q\n"
+
+    text += "\n<b>Top mahsulotlar:</b>\n"
+    for i, (product_name, revenue, order_count) in enumerate(dashboard["top_products"], start=1):
+        display_name = product_name or "Noma'lum mahsulot"
+        text += f"{i}. {html.escape(display_name)} — {format_money(revenue)} so'm ({order_count} ta)\n"
+    text += "\n<b>Top kategoriyalar:</b>\n"
+    for i, (cat_name, cat_id, revenue, order_count) in enumerate(dashboard["top_categories"], start=1):
+        display_name = cat_name or ("Kategoriyasiz" if not cat_id else "O'chirilgan kategoriya")
+        text += f"{i}. {html.escape(display_name)} — {format_money(revenue)} so'm ({order_count} ta)\n"
+
+    customers, repeat_customers = dashboard["customers"], dashboard["repeat_customers"]
+    repeat_share = (repeat_customers / customers * 100) if customers else 0
+    text += (f"\n👥 Xaridorlar: {customers} ta, qayta xarid qilganlar: {repeat_customers} ta "
+             f"({repeat_share:.0f}%)")
+
+    keyboard = [
+        [InlineKeyboardButton(("• " if p == period else "") + period_titles[p], callback_data=pack_callback("admin_analytics", p))
+         for p in SALES_PERIOD_FORMATS],
+        [InlineKeyboardButton("🔻 Xaridlar voronkasi", callback_data=pack_callback("admin_funnel"))],
+        [InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]
+    ]
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               query.message.message_id)
+
+
+async def admin_funnel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Soatlik yig'indilardan: foydalanuvchilar har soat uchun noyob, davr bo'yicha yig'indisi "foydalanuvchi-soat"
+    query = update.callback_query
+    await query.answer()
+    args = get_callback_args(query)
+    days = args[0] if args and args[0] in FUNNEL_REPORT_RANGES_DAYS else FUNNEL_REPORT_RANGES_DAYS[0]
+    report = fetch_funnel_report(days)
+    text = f"<b>🔻 Xaridlar voronkasi</b> (oxirgi {days} kun)\n"
+    first_users, previous_users = report[0][2], None
+    for stage, events, users in report:
+        line = f"\n<b>{FUNNEL_STAGE_TITLES[stage]}</b>: {users} foydalanuvchi ({events} marta)"
+        if previous_users is not None:
+            step = f"{users / previous_users * 100:.0f}%" if previous_users else "—"
+            total = f"{users / first_users * 100:.0f}%" if first_users else "—"
+            line += f"\n   oldingi bosqichdan {step}, boshidan {total}"
+        text += line
+        previous_users = users
+    text += "\n\n<i>Foydalanuvchilar har soat ichida bir marta sanaladi.</i>"
+    keyboard = [
+        [InlineKeyboardButton(f"{'• ' if range_days == days else ''}{range_days} kun",
+                              callback_data=pack_callback("admin_funnel", range_days))
+         for range_days in FUNNEL_REPORT_RANGES_DAYS],
+        [InlineKeyboardButton("📊 Statistika", callback_data=pack_callback("admin_analytics", "day"))],
+        [InlineKeyboardButton("⬅️ Admin Panelga", callback_data=pack_callback("admin_panel"))]
+    ]
+    await send_or_edit_message(context, query.message.chat_id, text, InlineKeyboardMarkup(keyboard),
+                               query.message.message_id)
+
+
 async def admin_noop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query;
     await query.answer()
 
 
+# --- Metrics (Admin) ---
+async def admin_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    metrics.set("log_records_sampled_out_total", sum(sample_filter.dropped for sample_filter in log_sample_filters))
+    snapshot = metrics.snapshot()
+    if not snapshot:
+        await update.message.reply_text("Hozircha metrikalar yo'q.")
+        return
+    lines = [f"{html.escape(name)} = {value}" for name, value in snapshot.items()]
+    await update.message.reply_text("<b>📟 Metrikalar:</b>\n<code>" + "\n".join(lines) + "</code>", parse_mode='HTML')
+
+
+# --- Flood Protection ---
+class UserTokenBuckets:
+    # Har foydalanuvchi uchun (tokenlar, oxirgi yangilanish vaqti). To'liq tiklanish vaqtidan ko'p jim turgan
+    # foydalanuvchining chelagi yangisidan farq qilmaydi, shuning uchun u o'chiriladi (LRU tartibida).
+    def __init__(self, rate_per_second, burst, max_users):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.max_users = max_users
+        self.idle_ttl = burst / rate_per_second
+        self._buckets = collections.OrderedDict()
+
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.pop(user_id, None)
+        tokens = self.burst if bucket is None else min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1
+        self._buckets[user_id] = (tokens - 1 if allowed else tokens, now)
+        self._evict(now)
+        return allowed
+
+    def _evict(self, now):
+        while self._buckets:
+            user_id, (_, updated_at) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_users and now - updated_at <= self.idle_ttl:
+                break
+            del self._buckets[user_id]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+flood_buckets = UserTokenBuckets(FLOOD_RATE_PER_SECOND, FLOOD_BURST, FLOOD_MAX_TRACKED_USERS)
+
+
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # group=-1 da barcha handlerlardan oldin ishlaydi: ortiqcha update baza va API ishidan oldin to'xtatiladi
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return
+    allowed = flood_buckets.allow(user.id)
+    metrics.set("throttle_tracked_users", len(flood_buckets))
+    if allowed:
+        return
+    if update.callback_query:
+        metrics.inc("throttle_dropped_callbacks_total")
+        try:
+            await update.callback_query.answer("⏳ Juda tez! Biroz kuting.")
+        except telegram.error.TelegramError:
+            pass
+    else:
+        metrics.inc("throttle_dropped_updates_total")
+    raise ApplicationHandlerStop
+
+
+# --- Sessions ---
+def estimate_size(obj, _seen=None):
+    # sys.getsizeof ichki obyektlarni hisobga olmaydi: konteynerlarni rekursiv aylanib chiqamiz
+    _seen = set() if _seen is None else _seen
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(key, _seen) + estimate_size(value, _seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, _seen) for item in obj)
+    return size
+
+
+class SessionManager:
+    # user_id -> oxirgi murojaat vaqti, eng eskisi boshida (LRU tartibida).
+    # Sessiyalarning o'zi Application.user_data da turadi; bu yerda faqat ularni qachon tozalash hal qilinadi.
+    # on_discard(session) sessiya qisqartirilishi yoki o'chirilishidan oldin chaqiriladi (masalan, bronlarni qaytarish).
+    def __init__(self, idle_ttl, memory_budget, keep_keys=(), exempt_user_ids=(), on_discard=None):
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+        self.keep_keys = keep_keys
+        self.exempt_user_ids = set(exempt_user_ids)
+        self.on_discard = on_discard
+        self._last_seen = collections.OrderedDict()
+
+    def touch(self, user_id, now=None):
+        self._last_seen[user_id] = time.monotonic() if now is None else now
+        self._last_seen.move_to_end(user_id)
+
+    def compact(self, session):
+        if self.on_discard and any(key not in self.keep_keys for key in session):
+            self.on_discard(session)
+        for key in [key for key in session if key not in self.keep_keys]:
+            del session[key]
+
+    def sweep(self, application, now=None):
+        now = time.monotonic() if now is None else now
+        compacted = evicted = 0
+        for user_id in list(application.user_data):
+            if user_id not in self._last_seen:
+                # Kuzatuv boshlanishidan oldingi sessiya: hozir ko'rilgan deb hisoblaymiz
+                self.touch(user_id, now)
+        for user_id, last_seen in list(self._last_seen.items()):
+            if now - last_seen <= self.idle_ttl:
+                break
+            if user_id in self.exempt_user_ids:
+                continue
+            session = application.user_data.get(user_id)
+            keys_before = len(session) if session else 0
+            if session:
+                self.compact(session)
+            if session:
+                compacted += len(session) < keys_before
+            else:
+                application.drop_user_data(user_id)
+                del self._last_seen[user_id]
+                evicted += 1
+        sizes = collections.OrderedDict(
+            (user_id, estimate_size(application.user_data[user_id]))
+            for user_id in self._last_seen if user_id in application.user_data)
+        total_bytes = sum(sizes.values())
+        for user_id, size in list(sizes.items()):
+            if total_bytes <= self.memory_budget:
+                break
+            if user_id in self.exempt_user_ids:
+                continue
+            if self.on_discard:
+                self.on_discard(application.user_data[user_id])
+            application.drop_user_data(user_id)
+            del self._last_seen[user_id]
+            total_bytes -= size
+            evicted += 1
+        for user_id in [user_id for user_id in self._last_seen if user_id not in application.user_data]:
+            del self._last_seen[user_id]
+        return compacted, evicted, total_bytes
+
+    def __len__(self):
+        return len(self._last_seen)
+
+
+session_manager = SessionManager(SESSION_IDLE_TTL, SESSION_MEMORY_BUDGET, SESSION_KEEP_KEYS, exempt_user_ids=(ADMIN_ID,),
+                                 on_discard=release_session_reservations)
+
+
+async def track_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user:
+        session_manager.touch(update.effective_user.id)
+
+
+async def sweep_sessions_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    compacted, evicted, total_bytes = session_manager.sweep(context.application)
+    metrics.set("sessions_active", len(session_manager))
+    metrics.set("sessions_estimated_bytes", total_bytes)
+    if compacted or evicted:
+        metrics.inc("sessions_compacted_total", compacted)
+        metrics.inc("sessions_evicted_total", evicted)
+        logger.info("Sessiyalar tozalandi: %s ta ixchamlashtirildi, %s ta o'chirildi, qoldi %s ta (~%s KB).",
+                    compacted, evicted, len(session_manager), total_bytes // 1024)
+
+
+# --- Tracing ---
+trace_recorder = tracing.TraceRecorder(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUP_COUNT, TRACE_SLOW_MS,
+                                       TRACE_SAMPLE_RATE) if TRACE_FILE else None
+
+
+def describe_update(update: Update):
+    if update.callback_query:
+        return {"kind": "callback", "action": unpack_callback(update.callback_query.data or "")[0]}
+    if update.message:
+        text = update.message.text or ""
+        return {"kind": "message", "command": text.split()[0] if text.startswith("/") else None}
+    return {"kind": "other"}
+
+
+class TracedApplication(Application):
+    # Har bir Update uchun trace: handler, DB va Bot API spanlari tracing.span() orqali unga ulanadi
+    async def process_update(self, update: object) -> None:
+        if trace_recorder is None or not isinstance(update, Update):
+            return await super().process_update(update)
+        user_id = update.effective_user.id if update.effective_user else None
+        with tracing.start_trace("update", update_id=update.update_id, user_id=user_id,
+                                 **describe_update(update)) as trace:
+            await super().process_update(update)
+        metrics.inc("traces_kept_total" if trace_recorder.record(trace) else "traces_dropped_total")
+
+    async def process_error(self, update, error, job=None, coroutine=None) -> bool:
+        tracing.mark_error(error)
+        return await super().process_error(update, error, job, coroutine)
+
+
+class BotApiRequest(HTTPXRequest):
+    # Profil sozlamalari + o'lchovlar: har bir so'rov uchun tracing spani va pool'dan bo'sh ulanish kutish vaqti.
+    # Pool hajmidagi semafor httpx pool'i oldida turadi, shuning uchun kutish shu yerda o'lchanadi.
+    def __init__(self, pool_size, keepalive_connections, keepalive_expiry, http_version, connect_timeout,
+                 read_timeout, write_timeout, pool_timeout, media_write_timeout=20.0, method_timeouts=None,
+                 metrics_prefix="http"):
+        super().__init__(connection_pool_size=pool_size, connect_timeout=connect_timeout, read_timeout=read_timeout,
+                         write_timeout=write_timeout, pool_timeout=pool_timeout, http_version=http_version,
+                         media_write_timeout=media_write_timeout,
+                         httpx_kwargs={"limits": httpx.Limits(max_connections=pool_size,
+                                                              max_keepalive_connections=keepalive_connections,
+                                                              keepalive_expiry=keepalive_expiry)})
+        self.method_timeouts = method_timeouts or {}
+        self.metrics_prefix = metrics_prefix
+        self._pool_timeout = pool_timeout
+        self._pool_slots = asyncio.Semaphore(pool_size)
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit("/", 1)[-1]  # url oxiri - Bot API metodi (tokenni yozmaymiz)
+        timeouts = self.method_timeouts.get(api_method)
+        if timeouts:
+            if read_timeout is BaseRequest.DEFAULT_NONE:
+                read_timeout = timeouts.get("read", read_timeout)
+            if write_timeout is BaseRequest.DEFAULT_NONE:
+                write_timeout = timeouts.get("write", write_timeout)
+        wait_limit = self._pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else pool_timeout
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._pool_slots.acquire(), wait_limit)
+        except asyncio.TimeoutError:
+            metrics.inc(f"{self.metrics_prefix}_pool_timeouts_total")
+            raise telegram.error.TimedOut(f"Pool timeout: {wait_limit} s ichida bo'sh ulanish topilmadi ({api_method}).")
+        pool_wait_ms = (time.monotonic() - started) * 1000
+        metrics.inc(f"{self.metrics_prefix}_requests_total")
+        metrics.inc(f"{self.metrics_prefix}_pool_wait_ms_total", round(pool_wait_ms, 3))
+        metrics.set_max(f"{self.metrics_prefix}_pool_wait_ms_max", round(pool_wait_ms, 3))
+        try:
+            with tracing.span("telegram", method=api_method, pool_wait_ms=round(pool_wait_ms, 2)) as record:
+                code, payload = await super().do_request(url, method, request_data, read_timeout, write_timeout,
+                                                         connect_timeout, pool_timeout)
+                if record is not None:
+                    record["status"] = code
+                    if code >= 400:
+                        record["error"] = f"HTTP {code}"
+                return code, payload
+        finally:
+            self._pool_slots.release()
+
+
+def build_bot_request(settings, metrics_prefix="http"):
+    settings = {key: value for key, value in settings.items() if key != "get_updates"}
+    return BotApiRequest(**settings, metrics_prefix=metrics_prefix)
+
+
+# --- Callback Router ---
+class CallbackRouter(BaseHandler):
+    # Barcha oddiy (conversation'ga tegishli bo'lmagan) callback'lar uchun bitta handler.
+    # callback_data bir marta dekodlanadi va amal nomi bo'yicha lug'atdan handler topiladi.
+    def __init__(self, routes, fallback=None):
+        # BaseHandler callback talab qiladi. Application uni chaqirmaydi: handle_update check_update topgan
+        # (handler, faqat_admin) juftini ishlatadi va callback_data qayta dekodlanmaydi. dispatch - xuddi shu
+        # yo'l, faqat marshrutni o'zi topadi (Application'siz to'g'ridan-to'g'ri chaqirish uchun)
+        super().__init__(self.dispatch)
+        self.routes = routes
+        self.fallback = fallback
+
+    def resolve(self, data):
+        return self.routes.get(unpack_callback(data)[0]) or self.fallback
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query and update.callback_query.data:
+            return self.resolve(update.callback_query.data)
+        return None
+
+    async def handle_update(self, update, application, check_result, context):
+        handler, admin_only = check_result
+        if admin_only and not is_admin(update):
+            await reject_non_admin_callback(update)
+            return None
+        if handler not in NAVIGATION_HANDLERS and update.effective_chat:
+            navigation_coalescer.discard(update.effective_chat.id)
+        with tracing.span("handler", name=handler.__name__):
+            return await handler(update, context)
+
+    async def dispatch(self, update, context):
+        route = self.check_update(update)
+        if route:
+            return await self.handle_update(update, context.application, route, context)
+        return None
+
+
+async def answer_unknown_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Eskirgan tugmalar (masalan, tugagan conversation'dagi) uchun: spinner to'xtasin
+    logger.debug("Noma'lum callback: %s", update.callback_query.data)
+    await update.callback_query.answer()
+
+
+# amal -> (handler, faqat_admin)
+CALLBACK_ROUTES = {
+    "view_categories": (view_categories, False),
+    "category": (show_products_in_category, False),
+    "next_product": (next_product, False),
+    "prev_product": (prev_product, False),
+    "buy": (buy_product_prompt, False),
+    "related_product": (show_related_product, False),
+    "cart_add": (cart_add, False),
+    "cart_remove": (cart_remove, False),
+    "cart_view": (cart_view, False),
+    "cart_item_remove": (cart_item_remove, False),
+    "cart_clear": (cart_clear, False),
+    "cart_checkout": (cart_checkout, False),
+    "main_menu": (main_menu_callback, False),
+    "my_orders": (my_orders, False),
+    "admin_panel": (admin_panel, True),
+    "admin_manage_categories": (admin_manage_categories, True),
+    "admin_manage_products_list": (admin_manage_products_list, True),
+    "admin_view_orders": (admin_view_orders, True),
+    "admin_order_queue": (admin_order_queue, True),
+    "admin_order": (admin_view_order, True),
+    "admin_order_status": (admin_set_order_status, True),
+    "admin_noop": (admin_noop, True),
+    "admin_delete_cat_confirm": (admin_delete_category_confirm, True),
+    "admin_delete_cat_execute": (admin_delete_category_execute, True),
+    "admin_view_prod": (admin_view_single_product, True),
+    "admin_price_history": (admin_price_history, True),
+    "admin_delete_prod_confirm": (admin_delete_prod_confirm, True),
+    "admin_delete_prod_execute": (admin_delete_prod_execute, True),
+    "admin_broadcast_stop": (admin_broadcast_stop, True),
+    "admin_analytics": (admin_analytics, True),
+    "admin_funnel": (admin_funnel, True),
+    "admin_share_link": (admin_share_link, True),
+}
+
+
+NAVIGATION_HANDLERS = (next_product, prev_product)
+
+
+def build_callback_router():
+    return CallbackRouter(CALLBACK_ROUTES, fallback=(answer_unknown_callback, False))
+
+
+async def on_startup(application: Application) -> None:
+    resume_broadcasts(application)
+
+
+async def on_shutdown(application: Application) -> None:
+    # Buferda qolgan voronka hodisalarini yo'qotmaslik uchun
+    await flush_funnel_events_job(None)
+
+
+def schedule_background_jobs(application: Application) -> None:
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.warning("JobQueue mavjud emas (pip install \"python-telegram-bot[job-queue]\"), "
+                       "rejalashtirilgan vazifalar ishlamaydi.")
+        return
+    job_queue.run_repeating(archive_old_orders_job, interval=ORDER_ARCHIVE_INTERVAL, first=60,
+                            name="archive_old_orders")
+    job_queue.run_repeating(release_expired_reservations_job, interval=STOCK_SWEEP_INTERVAL, first=STOCK_SWEEP_INTERVAL,
+                            name="release_expired_reservations")
+    job_queue.run_repeating(backup_database_job, interval=BACKUP_INTERVAL, first=5 * 60, name="backup_database")
+    job_queue.run_repeating(sweep_sessions_job, interval=SESSION_SWEEP_INTERVAL, first=SESSION_SWEEP_INTERVAL,
+                            name="sweep_sessions")
+    job_queue.run_repeating(refresh_recommendations_job, interval=RECOMMENDATIONS_INTERVAL, first=90,
+                            name="refresh_recommendations")
+    job_queue.run_repeating(flush_funnel_events_job, interval=FUNNEL_FLUSH_INTERVAL, first=FUNNEL_FLUSH_INTERVAL,
+                            name="flush_funnel_events")
+    job_queue.run_repeating(prune_funnel_events_job, interval=6 * 60 * 60, first=10 * 60, name="prune_funnel_events")
+    job_queue.run_repeating(checkpoint_wal_job, interval=WAL_CHECKPOINT_INTERVAL, first=WAL_CHECKPOINT_INTERVAL,
+                            name="checkpoint_wal")
+    job_queue.run_daily(database_maintenance_job, time=dt_time(hour=MAINTENANCE_HOUR_UTC),
+                        name="database_maintenance")
+
+
 def main() -> None:
+    if STORAGE_BACKEND != "sqlite":
+        # Admin amallari (import, ommaviy amallar, e'lonlar) SQLite'ga yozadi: xotiradagi omborda ular
+        # katalog va savatda ko'rinmay qolardi, buyurtmalar statistikaga tushmasdi
+        logger.error("STORAGE_BACKEND=%s bilan bot ishga tushirilmaydi: faqat 'sqlite' qo'llab-quvvatlanadi "
+                     "('memory' test va benchmarklar uchun).", STORAGE_BACKEND)
+        return
     setup_database()
-    application = Application.builder().token(BOT_TOKEN).build()
+    backfill_sales_rollups()
+    backfill_order_status_counts()
+    load_product_recommendations()
+    transport_profile = TRANSPORT_PROFILES[TRANSPORT_PROFILE]
+    logger.info("HTTP transport profili: %s (pool %s, HTTP/%s).", TRANSPORT_PROFILE, transport_profile["pool_size"],
+                transport_profile["http_version"])
+    application = Application.builder().token(BOT_TOKEN).application_class(TracedApplication) \
+        .request(build_bot_request(transport_profile)) \
+        .get_updates_request(build_bot_request(transport_profile["get_updates"], "http_get_updates")) \
+        .post_init(on_startup).post_shutdown(on_shutdown).build()
 
     cancel_command_filter = filters.COMMAND & filters.Regex(r'^/cancel$')
     skip_command_filter = filters.COMMAND & filters.Regex(r'^/skip$')
     conv_fallbacks = [CommandHandler("cancel", admin_cancel_conv),
-                      CallbackQueryHandler(admin_cancel_conv, pattern="^admin_cancel_conv$")]
+                      CallbackQueryHandler(admin_cancel_conv, pattern=callback_action("admin_cancel_conv"))]
 
     add_category_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_add_category_prompt, pattern="^admin_add_category_prompt$")],
+        entry_points=[
+            CallbackQueryHandler(admin_conversation_entry(admin_add_category_prompt),
+                                 pattern=callback_action("admin_add_category_prompt"))],
         states={ASK_CATEGORY_NAME: [MessageHandler(filters.TEXT & ~cancel_command_filter, admin_save_category)]},
         fallbacks=conv_fallbacks, allow_reentry=True
     )
     edit_category_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_edit_category_prompt, pattern="^admin_edit_cat_prompt_")],
+        entry_points=[
+            CallbackQueryHandler(admin_conversation_entry(admin_edit_category_prompt),
+                                 pattern=callback_action("admin_edit_cat_prompt"))],
         states={ASK_CATEGORY_EDIT_NAME: [
             MessageHandler(filters.TEXT & ~cancel_command_filter, admin_save_edited_category)]},
         fallbacks=conv_fallbacks, allow_reentry=True
     )
     add_product_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_add_product_start, pattern="^admin_add_product_start$")],
+        entry_points=[
+            CallbackQueryHandler(admin_conversation_entry(admin_add_product_start),
+                                 pattern=callback_action("admin_add_product_start"))],
         states={
-            SELECT_PRODUCT_CATEGORY: [CallbackQueryHandler(admin_ask_product_name, pattern="^prodcat_")],
+            SELECT_PRODUCT_CATEGORY: [
+                CallbackQueryHandler(admin_ask_product_name, pattern=callback_action("prodcat"))],
             ASK_PRODUCT_NAME: [MessageHandler(filters.TEXT & ~cancel_command_filter, admin_ask_product_description)],
             ASK_PRODUCT_DESCRIPTION: [
                 MessageHandler(filters.TEXT & ~cancel_command_filter & ~skip_command_filter, admin_ask_product_price),
@@ -1296,10 +4549,8 @@ def main() -> None:
     )
     edit_product_field_conv = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(admin_edit_product_field_router, pattern="^admin_edit_prod_field_name$"),
-            CallbackQueryHandler(admin_edit_product_field_router, pattern="^admin_edit_prod_field_desc$"),
-            CallbackQueryHandler(admin_edit_product_field_router, pattern="^admin_edit_prod_field_image$"),
-            CallbackQueryHandler(admin_edit_product_field_router, pattern="^admin_edit_prod_field_category$"),
+            CallbackQueryHandler(admin_conversation_entry(admin_edit_product_field_router),
+                                 pattern=callback_action("admin_edit_prod_field")),
         ],
         states={
             ASK_EDIT_PRODUCT_NEW_NAME: [
@@ -1312,48 +4563,92 @@ def main() -> None:
                                admin_save_edited_product_image),
                 CommandHandler("skip", admin_save_edited_product_image)],
             ASK_EDIT_PRODUCT_NEW_CATEGORY: [
-                CallbackQueryHandler(admin_save_edited_product_category_callback, pattern="^prod_setcat_")],
+                CallbackQueryHandler(admin_save_edited_product_category_callback,
+                                     pattern=callback_action("prod_setcat"))],
+            ASK_EDIT_PRODUCT_NEW_STOCK: [
+                MessageHandler(filters.TEXT & ~cancel_command_filter, admin_save_edited_product_stock)],
         },
         fallbacks=conv_fallbacks, allow_reentry=True
     )
     edit_price_conv = ConversationHandler(
-        entry_points=[CallbackQueryHandler(admin_edit_price_entry_point, pattern="^admin_edit_price_entry_")],
+        entry_points=[
+            CallbackQueryHandler(admin_conversation_entry(admin_edit_price_entry_point),
+                                 pattern=callback_action("admin_edit_price_entry"))],
         states={
             EDIT_PRICE_ASK_NEW_PRICE: [MessageHandler(filters.TEXT & ~cancel_command_filter, admin_save_edited_price)]},
         fallbacks=conv_fallbacks, allow_reentry=True
     )
 
+    import_catalog_conv = ConversationHandler(
+        entry_points=[
+            CallbackQueryHandler(admin_conversation_entry(admin_import_catalog_start),
+                                 pattern=callback_action("admin_import_catalog_start"))],
+        states={
+            IMPORT_SELECT_MODE: [
+                CallbackQueryHandler(admin_import_catalog_select_mode, pattern=callback_action("admin_import_mode"))],
+            IMPORT_ASK_DOCUMENT: [MessageHandler(filters.Document.ALL | (filters.TEXT & ~cancel_command_filter),
+                                                 admin_import_catalog_document)],
+        },
+        fallbacks=conv_fallbacks, allow_reentry=True
+    )
+
+    bulk_products_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_conversation_entry(admin_bulk_start),
+                                           pattern=callback_action("admin_bulk_start"))],
+        states={
+            BULK_SELECT_OPERATION: [
+                CallbackQueryHandler(admin_bulk_select_operation, pattern=callback_action("bulk_op"))],
+            BULK_SELECT_SOURCE: [
+                CallbackQueryHandler(admin_bulk_select_source, pattern=callback_action("bulk_src"))],
+            BULK_ASK_NAME_FILTER: [
+                MessageHandler(filters.TEXT & ~cancel_command_filter & ~skip_command_filter, admin_bulk_name_filter),
+                CommandHandler("skip", admin_bulk_name_filter)],
+            BULK_ASK_PRICE_CHANGE: [MessageHandler(filters.TEXT & ~cancel_command_filter, admin_bulk_price_change)],
+            BULK_SELECT_TARGET: [CallbackQueryHandler(admin_bulk_select_target, pattern=callback_action("bulk_dst"))],
+            BULK_CONFIRM: [CallbackQueryHandler(admin_bulk_execute, pattern=callback_action("bulk_confirm"))],
+        },
+        fallbacks=conv_fallbacks, allow_reentry=True
+    )
+
+    broadcast_conv = ConversationHandler(
+        entry_points=[CallbackQueryHandler(admin_conversation_entry(admin_broadcast_start),
+                                           pattern=callback_action("admin_broadcast_start", "admin_broadcast_product"))],
+        states={
+            BROADCAST_SELECT_SEGMENT: [
+                CallbackQueryHandler(admin_broadcast_select_segment, pattern=callback_action("bc_seg"))],
+            BROADCAST_ASK_TEXT: [MessageHandler(filters.TEXT & ~cancel_command_filter, admin_broadcast_receive_text)],
+            BROADCAST_CONFIRM: [CallbackQueryHandler(admin_broadcast_confirm, pattern=callback_action("bc_confirm"))],
+        },
+        fallbacks=conv_fallbacks, allow_reentry=True
+    )
+
     application.add_handler(add_category_conv)
     application.add_handler(edit_category_conv)
     application.add_handler(add_product_conv)
     application.add_handler(edit_product_field_conv)
     application.add_handler(edit_price_conv)
+    application.add_handler(import_catalog_conv)
+    application.add_handler(bulk_products_conv)
+    application.add_handler(broadcast_conv)
 
+    # Har bir foydalanuvchi uchun token-chelak: ortiqcha update'lar boshqa guruhlarga yetib bormaydi
+    application.add_handler(TypeHandler(Update, track_session), group=-2)
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-1)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("myorders", my_orders))
     application.add_handler(CommandHandler("admin", admin_panel, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("metrics", admin_metrics, filters=filters.User(user_id=ADMIN_ID)))
+    application.add_handler(CommandHandler("priceat", admin_price_at, filters=filters.User(user_id=ADMIN_ID)))
 
-    application.add_handler(CallbackQueryHandler(view_categories, pattern="^view_categories$"))
-    application.add_handler(CallbackQueryHandler(show_products_in_category, pattern="^category_"))
-    application.add_handler(CallbackQueryHandler(next_product, pattern="^next_product$"))
-    application.add_handler(CallbackQueryHandler(prev_product, pattern="^prev_product$"))
-    application.add_handler(CallbackQueryHandler(buy_product_prompt, pattern="^buy_"))
-    application.add_handler(CallbackQueryHandler(main_menu_callback, pattern="^main_menu$"))
-
-    application.add_handler(CallbackQueryHandler(admin_panel, pattern="^admin_panel$"))
-    application.add_handler(CallbackQueryHandler(admin_manage_categories, pattern="^admin_manage_categories$"))
-    application.add_handler(CallbackQueryHandler(admin_delete_category_confirm, pattern="^admin_delete_cat_confirm_"))
-    application.add_handler(CallbackQueryHandler(admin_delete_category_execute, pattern="^admin_delete_cat_execute_"))
-    application.add_handler(CallbackQueryHandler(admin_manage_products_list, pattern="^admin_manage_products_list$"))
-    application.add_handler(CallbackQueryHandler(admin_view_single_product, pattern="^admin_view_prod_"))
-    application.add_handler(CallbackQueryHandler(admin_delete_prod_confirm, pattern="^admin_delete_prod_confirm_"))
-    application.add_handler(CallbackQueryHandler(admin_delete_prod_execute, pattern="^admin_delete_prod_execute_"))
-    application.add_handler(CallbackQueryHandler(admin_view_orders, pattern="^admin_view_orders$"))
-    application.add_handler(CallbackQueryHandler(admin_noop, pattern="^admin_noop$"))
+    # Conversation'larga tegishli bo'lmagan barcha callback'lar bitta router orqali
+    application.add_handler(build_callback_router())
 
     application.add_handler(MessageHandler(
         filters.CONTACT | (filters.TEXT & ~filters.COMMAND & ~cancel_command_filter & ~skip_command_filter),
         process_contact))
 
+    schedule_background_jobs(application)
+
     logger.info("Bot ishga tushdi...")
     application.run_polling()
 
@@ -0,0 +1,819 @@
+import collections
+import contextlib
+import itertools
+import sqlite3
+import threading
+import time
+
+import tracing
+
+# Ombor (repository) qatlami: handlerlar SQL o'rniga shu interfeyslarni chaqiradi.
+# Qatorlar bot.py dagi avvalgi so'rovlar qaytargan tuple ko'rinishida qaytariladi.
+
+PRODUCT_FIELDS = ("category_id", "name", "description", "price", "image_file_id", "stock")
+UNKNOWN_PRODUCT_NAME = "Noma'lum mahsulot"
+# Buyurtma holatlari: yangi buyurtma "new" bilan yoziladi, keyin admin tugmalar orqali o'zgartiradi
+ORDER_STATUSES = ("new", "contacted", "confirmed", "shipped", "cancelled")
+
+Repositories = collections.namedtuple("Repositories", "categories products orders users")
+
+
+class DuplicateNameError(Exception):
+    pass
+
+
+class OutOfStockError(Exception):
+    pass
+
+
+# --- Interfaces ---
+class CategoryRepo:
+    def list(self):
+        # [(id, name)] nom bo'yicha
+        raise NotImplementedError
+
+    def get_name(self, category_id):
+        raise NotImplementedError
+
+    def add(self, name):
+        raise NotImplementedError
+
+    def rename(self, category_id, name):
+        raise NotImplementedError
+
+    def delete(self, category_id):
+        # Kategoriyadagi mahsulotlar kategoriyasiz qoladi (ON DELETE SET NULL)
+        raise NotImplementedError
+
+
+class ProductRepo:
+    def list_by_category(self, category_id):
+        # [(id, name, price, image_file_id, description)] nom bo'yicha
+        raise NotImplementedError
+
+    def list_with_category_names(self):
+        # [(id, name, category_name)] nom bo'yicha
+        raise NotImplementedError
+
+    def get(self, product_id):
+        # (id, name, description, price, image_file_id, category_name, stock) yoki None; stock NULL = hisobsiz
+        raise NotImplementedError
+
+    def get_name(self, product_id):
+        raise NotImplementedError
+
+    def get_name_and_price(self, product_id):
+        raise NotImplementedError
+
+    def count_in_category(self, category_id):
+        raise NotImplementedError
+
+    def add(self, category_id, name, description, price, image_file_id):
+        raise NotImplementedError
+
+    def update(self, product_id, **fields):
+        raise NotImplementedError
+
+    def delete(self, product_id):
+        # Buyurtmalardagi product_id NULL bo'ladi, nom va narx buyurtmada saqlanib qoladi
+        raise NotImplementedError
+
+    def reserve(self, product_id, user_id, ttl):
+        # Bitta donani ttl soniyaga band qiladi: bron ID si, hisobsiz mahsulot uchun None;
+        # qolmagan bo'lsa OutOfStockError
+        raise NotImplementedError
+
+    def reserve_many(self, quantities, user_id, ttl):
+        # quantities: {product_id: soni}. Hamma donalar bitta tranzaksiyada band qilinadi (har dona - bitta bron).
+        # Qaytaradi: (bron ID lari, {product_id: band qilinganlar soni}) - ikkinchisida faqat yetmagan mahsulotlar;
+        # yetmagan mahsulotdan qolgan donalarning hammasi olinadi. Hisobsiz mahsulotlar bronsiz o'tadi
+        raise NotImplementedError
+
+    def release_reservation(self, reservation_id):
+        raise NotImplementedError
+
+    def release_expired_reservations(self):
+        # Muddati o'tgan bronlarni bekor qilib, donalarni qaytaradi; qaytarilganlar sonini beradi
+        raise NotImplementedError
+
+    def price_at(self, product_id, at):
+        # at: "YYYY-MM-DD HH:MM:SS" (UTC). Shu paytda amalda bo'lgan narx; tarix boshlanishidan oldin None
+        raise NotImplementedError
+
+    def price_history(self, product_id, since, until):
+        # [(changed_at, price)] eskidan yangiga: since paytidagi amaldagi narx (bo'lsa) va oraliqdagi o'zgarishlar
+        raise NotImplementedError
+
+
+class OrderRepo:
+    def create(self, user_id, user_username, product_id, product_name, product_price, phone_number,
+               reservation_id=None):
+        return self.create_with_items(user_id, user_username, phone_number,
+                                      [(product_id, product_name, product_price, 1)],
+                                      [reservation_id] if reservation_id is not None else [])
+
+    def create_with_items(self, user_id, user_username, phone_number, items, reservation_ids=()):
+        # items: [(product_id, product_name, product_price, quantity)]. Sarlavha (orders) va qatorlar (order_items)
+        # bitta tranzaksiyada yoziladi. Bronlar shu tranzaksiyada yopiladi; bronsiz (yoki muddati o'tgan) donalar
+        # shu yerda olinadi. Hisobli mahsulot yetmasa OutOfStockError va hech narsa yozilmaydi
+        raise NotImplementedError
+
+    def recent(self, limit):
+        # [(id, user_id, first_name, last_name, user_username, phone_number, product_name, price, timestamp)]
+        raise NotImplementedError
+
+    def get(self, order_id):
+        # recent() qatori + status, yoki None (arxivlangan buyurtmalar ham None)
+        raise NotImplementedError
+
+    def list_by_status(self, status, limit, before=None):
+        # recent() qatorlari, yangidan eskiga; before = oldingi sahifadagi oxirgi (timestamp, id) (keyset sahifalash).
+        # Kursor qiymat sifatida uzatiladi: langar buyurtma orada arxivlansa ham sahifa to'g'ri davom etadi
+        raise NotImplementedError
+
+    def set_status(self, order_id, status):
+        # Oldingi holatni qaytaradi, buyurtma topilmasa None. Holatlar soni shu tranzaksiyada yangilanadi
+        raise NotImplementedError
+
+    def status_counts(self):
+        # {status: soni} faqat "issiq" (arxivlanmagan) buyurtmalar uchun, COUNT(*) siz
+        raise NotImplementedError
+
+    def list_by_user(self, user_id, limit, before=None):
+        # [(id, timestamp, product_name, price, status)] yangidan eskiga, arxiv bilan birga;
+        # before = oldingi sahifadagi oxirgi (timestamp, id) (keyset sahifalash)
+        raise NotImplementedError
+
+
+class UserRepo:
+    def save(self, user_id, first_name, last_name, username):
+        # Yangi foydalanuvchini qo'shadi yoki o'zgargan ism/username'ni yangilaydi
+        raise NotImplementedError
+
+
+def order_header(items):
+    # Sarlavha eski bitta-mahsulotli buyurtmalar bilan mos: birinchi mahsulot, umumiy nom va jami summa
+    first_product_id, first_name = items[0][0], items[0][1]
+    name = first_name if len(items) == 1 else f"{first_name} va yana {len(items) - 1} ta mahsulot"
+    return first_product_id, name, sum(price * quantity for _, _, price, quantity in items)
+
+
+def check_product_fields(fields):
+    unknown = set(fields) - set(PRODUCT_FIELDS)
+    if unknown:
+        raise ValueError(f"Noma'lum mahsulot maydonlari: {', '.join(sorted(unknown))}")
+
+
+def check_order_status(status):
+    if status not in ORDER_STATUSES:
+        raise ValueError(f"Noma'lum buyurtma holati: {status}")
+
+
+# --- SQLite ---
+class SQLiteStorage:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def connection(self):
+        # Har so'rovda ulanish ochish o'rniga bitta doimiy ulanish; sqlite3 tayyor so'rovlarni keshlaydi
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA foreign_keys = ON")
+            # WAL: o'quvchilar yozuvchini to'xtatmaydi, NORMAL bilan har commit'da fsync qilinmaydi
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn = conn
+        return self._conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with tracing.span("db.transaction"), self._lock:
+            conn = self.connection()
+            with conn:
+                yield conn
+
+    def fetch_one(self, query, params=()):
+        with tracing.span("db.fetch_one", sql=query), self._lock:
+            return self.connection().execute(query, params).fetchone()
+
+    def fetch_all(self, query, params=()):
+        with tracing.span("db.fetch_all", sql=query), self._lock:
+            return self.connection().execute(query, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class SQLiteCategoryRepo(CategoryRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def list(self):
+        return self.storage.fetch_all("SELECT id, name FROM categories ORDER BY name")
+
+    def get_name(self, category_id):
+        row = self.storage.fetch_one("SELECT name FROM categories WHERE id = ?", (category_id,))
+        return row[0] if row else None
+
+    def add(self, name):
+        try:
+            with self.storage.transaction() as conn:
+                return conn.execute("INSERT INTO categories (name) VALUES (?)", (name,)).lastrowid
+        except sqlite3.IntegrityError as e:
+            raise DuplicateNameError(name) from e
+
+    def rename(self, category_id, name):
+        try:
+            with self.storage.transaction() as conn:
+                conn.execute("UPDATE categories SET name = ? WHERE id = ?", (name, category_id))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateNameError(name) from e
+
+    def delete(self, category_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+
+
+class SQLiteProductRepo(ProductRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def list_by_category(self, category_id):
+        return self.storage.fetch_all(
+            "SELECT id, name, price, image_file_id, description FROM products WHERE category_id = ? ORDER BY name",
+            (category_id,))
+
+    def list_with_category_names(self):
+        return self.storage.fetch_all(
+            "SELECT p.id, p.name, c.name FROM products p LEFT JOIN categories c ON p.category_id = c.id ORDER BY p.name")
+
+    def get(self, product_id):
+        return self.storage.fetch_one(
+            "SELECT p.id, p.name, p.description, p.price, p.image_file_id, c.name, p.stock "
+            "FROM products p LEFT JOIN categories c ON p.category_id = c.id WHERE p.id = ?", (product_id,))
+
+    def get_name(self, product_id):
+        row = self.storage.fetch_one("SELECT name FROM products WHERE id = ?", (product_id,))
+        return row[0] if row else None
+
+    def get_name_and_price(self, product_id):
+        return self.storage.fetch_one("SELECT name, price FROM products WHERE id = ?", (product_id,))
+
+    def count_in_category(self, category_id):
+        return self.storage.fetch_one("SELECT COUNT(*) FROM products WHERE category_id = ?", (category_id,))[0]
+
+    def add(self, category_id, name, description, price, image_file_id):
+        with self.storage.transaction() as conn:
+            product_id = conn.execute(
+                "INSERT INTO products (category_id, name, description, price, image_file_id) VALUES (?, ?, ?, ?, ?)",
+                (category_id, name, description, price, image_file_id)).lastrowid
+            record_price_history(conn, [product_id])
+            return product_id
+
+    def update(self, product_id, **fields):
+        check_product_fields(fields)
+        if not fields:
+            return
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self.storage.transaction() as conn:
+            conn.execute(f"UPDATE products SET {assignments} WHERE id = ?", (*fields.values(), product_id))
+            if "price" in fields:
+                record_price_history(conn, [product_id])
+
+    def delete(self, product_id):
+        with self.storage.transaction() as conn:
+            conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+
+    def reserve(self, product_id, user_id, ttl):
+        with self.storage.transaction() as conn:
+            # Shartli UPDATE: tekshirish va kamaytirish bitta atomar amal, o'qib-yozish poygasi yo'q
+            if take_stock_unit(conn, product_id):
+                return conn.execute("INSERT INTO stock_reservations (product_id, user_id, expires_at) VALUES (?, ?, ?)",
+                                    (product_id, user_id, time.time() + ttl)).lastrowid
+        return None
+
+    def reserve_many(self, quantities, user_id, ttl):
+        reserved, shortages = [], {}
+        expires_at = time.time() + ttl
+        with self.storage.transaction() as conn:
+            for product_id, quantity in quantities.items():
+                taken = take_stock_units(conn, product_id, quantity)
+                if taken is None:
+                    continue
+                if taken < quantity:
+                    shortages[product_id] = taken
+                for _ in range(taken):
+                    reserved.append(conn.execute(
+                        "INSERT INTO stock_reservations (product_id, user_id, expires_at) VALUES (?, ?, ?)",
+                        (product_id, user_id, expires_at)).lastrowid)
+        return reserved, shortages
+
+    def release_reservation(self, reservation_id):
+        with self.storage.transaction() as conn:
+            row = conn.execute("DELETE FROM stock_reservations WHERE id = ? RETURNING product_id",
+                               (reservation_id,)).fetchone()
+            if row:
+                conn.execute("UPDATE products SET stock = stock + 1 WHERE id = ? AND stock IS NOT NULL", row)
+        return row is not None
+
+    def release_expired_reservations(self):
+        with self.storage.transaction() as conn:
+            rows = conn.execute("DELETE FROM stock_reservations WHERE expires_at < ? RETURNING product_id",
+                                (time.time(),)).fetchall()
+            conn.executemany("UPDATE products SET stock = stock + 1 WHERE id = ? AND stock IS NOT NULL", rows)
+        return len(rows)
+
+    def price_at(self, product_id, at):
+        # idx_price_history_product_changed bo'ylab bitta qidiruv
+        row = self.storage.fetch_one(
+            "SELECT price FROM price_history WHERE product_id = ? AND changed_at <= ? "
+            "ORDER BY changed_at DESC, id DESC LIMIT 1", (product_id, at))
+        return row[0] if row else None
+
+    def price_history(self, product_id, since, until):
+        start = self.storage.fetch_all(
+            "SELECT changed_at, price FROM price_history WHERE product_id = ? AND changed_at <= ? "
+            "ORDER BY changed_at DESC, id DESC LIMIT 1", (product_id, since))
+        return start + self.storage.fetch_all(
+            "SELECT changed_at, price FROM price_history WHERE product_id = ? AND changed_at > ? AND changed_at <= ? "
+            "ORDER BY changed_at, id", (product_id, since, until))
+
+
+def add_order_status_count(conn, status, delta):
+    conn.execute("INSERT INTO order_status_counts (status, order_count) VALUES (?, ?) "
+                 "ON CONFLICT (status) DO UPDATE SET order_count = order_count + excluded.order_count", (status, delta))
+
+
+def record_price_history(conn, product_ids=None):
+    # Narxi oxirgi yozuvdan farq qiladigan mahsulotlar uchun price_history ga qator qo'shadi.
+    # Narxni o'zgartirgan tranzaksiya ichida chaqiriladi; product_ids=None - butun katalog
+    query = ("INSERT INTO price_history (product_id, price) SELECT p.id, p.price FROM products p "
+             "WHERE p.price IS NOT (SELECT h.price FROM price_history h WHERE h.product_id = p.id "
+             "ORDER BY h.changed_at DESC, h.id DESC LIMIT 1)")
+    if product_ids is None:
+        conn.execute(query)
+    else:
+        conn.executemany(query + " AND p.id = ?", [(product_id,) for product_id in product_ids])
+
+
+def take_stock_units(conn, product_id, quantity):
+    # Bitta shartli UPDATE bilan quantity tagacha dona oladi va olinganlar sonini qaytaradi;
+    # hisobsiz mahsulot uchun None, topilmagan mahsulot uchun 0
+    if conn.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                    (quantity, product_id, quantity)).rowcount:
+        return quantity
+    # UPDATE yozish qulfini oldi: qolgan zaxira shu tranzaksiya tugaguncha o'zgarmaydi
+    row = conn.execute("SELECT stock FROM products WHERE id = ?", (product_id,)).fetchone()
+    if row is None:
+        return 0
+    if row[0] is None:
+        return None
+    conn.execute("UPDATE products SET stock = 0 WHERE id = ?", (product_id,))
+    return row[0]
+
+
+def take_stock_unit(conn, product_id):
+    # True: dona olindi; False: mahsulot hisobsiz (stock NULL) yoki topilmadi; qolmagan bo'lsa OutOfStockError
+    if conn.execute("UPDATE products SET stock = stock - 1 WHERE id = ? AND stock > 0", (product_id,)).rowcount:
+        return True
+    row = conn.execute("SELECT stock FROM products WHERE id = ?", (product_id,)).fetchone()
+    if row and row[0] is not None:
+        raise OutOfStockError(product_id)
+    return False
+
+
+class SQLiteOrderRepo(OrderRepo):
+    def __init__(self, storage, on_create=None, recent_source=None, on_status_change=None):
+        # on_create(conn, order_id) buyurtma bilan bitta tranzaksiyada chaqiriladi (masalan, statistika)
+        # on_status_change(conn, order_id, previous, status) holat o'zgargan tranzaksiyada chaqiriladi
+        # recent_source(limit) oxirgi buyurtmalar o'qiladigan jadval/so'rovni qaytaradi (masalan, arxiv bilan)
+        self.storage = storage
+        self.on_create = on_create
+        self.recent_source = recent_source
+        self.on_status_change = on_status_change
+
+    def create_with_items(self, user_id, user_username, phone_number, items, reservation_ids=()):
+        product_id, product_name, total = order_header(items)
+        needed = collections.Counter()
+        for item_product_id, _, _, quantity in items:
+            needed[item_product_id] += quantity
+        with self.storage.transaction() as conn:
+            reserved = collections.Counter()
+            if reservation_ids:
+                placeholders = ",".join("?" * len(reservation_ids))
+                reserved.update(row[0] for row in conn.execute(
+                    f"DELETE FROM stock_reservations WHERE id IN ({placeholders}) RETURNING product_id",
+                    list(reservation_ids)))
+            for item_product_id in needed.keys() | reserved.keys():
+                for _ in range(needed[item_product_id] - reserved[item_product_id]):
+                    take_stock_unit(conn, item_product_id)
+                # Savatdan olib tashlangan mahsulotning ortiqcha broni zaxiraga qaytadi
+                surplus = reserved[item_product_id] - needed[item_product_id]
+                if surplus > 0:
+                    conn.execute("UPDATE products SET stock = stock + ? WHERE id = ? AND stock IS NOT NULL",
+                                 (surplus, item_product_id))
+            order_id = conn.execute(
+                "INSERT INTO orders (user_id, user_username, product_id, product_name_at_order, "
+                "product_price_at_order, phone_number) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, user_username, product_id, product_name, total, phone_number)).lastrowid
+            conn.executemany(
+                "INSERT INTO order_items (order_id, product_id, product_name_at_order, product_price_at_order, quantity) "
+                "VALUES (?, ?, ?, ?, ?)", [(order_id, *item) for item in items])
+            add_order_status_count(conn, ORDER_STATUSES[0], 1)
+            if self.on_create:
+                self.on_create(conn, order_id)
+        return order_id
+
+    ROW_SQL = ("SELECT o.id, o.user_id, COALESCE(u.first_name, ''), COALESCE(u.last_name, ''), o.user_username, "
+               "o.phone_number, COALESCE(o.product_name_at_order, p.name, ?), "
+               "COALESCE(o.product_price_at_order, p.price, 0), o.timestamp{extra} "
+               "FROM {source} o LEFT JOIN products p ON o.product_id = p.id LEFT JOIN users u ON o.user_id = u.id ")
+
+    def recent(self, limit):
+        source = self.recent_source(limit) if self.recent_source else "orders"
+        return self.storage.fetch_all(self.ROW_SQL.format(extra="", source=source) +
+                                      "ORDER BY o.timestamp DESC LIMIT ?", (UNKNOWN_PRODUCT_NAME, limit))
+
+    def get(self, order_id):
+        return self.storage.fetch_one(self.ROW_SQL.format(extra=", o.status", source="orders") + "WHERE o.id = ?",
+                                      (UNKNOWN_PRODUCT_NAME, order_id))
+
+    def list_by_status(self, status, limit, before=None):
+        # idx_orders_status_timestamp (status, timestamp, rowid) tartibida: saralashsiz, faqat sahifa o'qiladi
+        query = self.ROW_SQL.format(extra="", source="orders") + "WHERE o.status = ? "
+        params = [UNKNOWN_PRODUCT_NAME, status]
+        if before is not None:
+            query += "AND (o.timestamp, o.id) < (?, ?) "
+            params += before
+        return self.storage.fetch_all(query + "ORDER BY o.timestamp DESC, o.id DESC LIMIT ?", (*params, limit))
+
+    def set_status(self, order_id, status):
+        check_order_status(status)
+        with self.storage.transaction() as conn:
+            row = conn.execute("SELECT status FROM orders WHERE id = ?", (order_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] != status:
+                conn.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
+                add_order_status_count(conn, row[0], -1)
+                add_order_status_count(conn, status, 1)
+                if self.on_status_change:
+                    self.on_status_change(conn, order_id, row[0], status)
+            return row[0]
+
+    def status_counts(self):
+        return dict(self.storage.fetch_all("SELECT status, order_count FROM order_status_counts"))
+
+    def list_by_user(self, user_id, limit, before=None):
+        # Arxivga timestamp bo'yicha eng eskilari ko'chiriladi: avval "issiq" jadval, sahifa to'lmasa arxiv.
+        # Ikkalasi ham (user_id, timestamp, rowid) indeksidan saralashsiz o'qiladi
+        rows = []
+        for table in ("orders", "orders_archive"):
+            query = (f"SELECT o.id, o.timestamp, COALESCE(o.product_name_at_order, p.name, ?), "
+                     f"COALESCE(o.product_price_at_order, p.price, 0), o.status "
+                     f"FROM {table} o LEFT JOIN products p ON o.product_id = p.id WHERE o.user_id = ? ")
+            params = [UNKNOWN_PRODUCT_NAME, user_id]
+            if before is not None:
+                query += "AND (o.timestamp, o.id) < (?, ?) "
+                params += before
+            rows += self.storage.fetch_all(query + "ORDER BY o.timestamp DESC, o.id DESC LIMIT ?",
+                                           (*params, limit - len(rows)))
+            if len(rows) >= limit:
+                break
+        return rows
+
+
+class SQLiteUserRepo(UserRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def save(self, user_id, first_name, last_name, username):
+        # Avvalgi INSERT OR IGNORE + SELECT + UPDATE o'rniga bitta UPSERT; o'zgarmagan qator qayta yozilmaydi
+        with self.storage.transaction() as conn:
+            conn.execute(
+                "INSERT INTO users (id, first_name, last_name, username) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name, "
+                "username = excluded.username "
+                "WHERE first_name IS NOT excluded.first_name OR last_name IS NOT excluded.last_name "
+                "OR (username IS NOT excluded.username AND excluded.username IS NOT NULL)",
+                (user_id, first_name, last_name, username))
+
+
+# --- In-memory ---
+class MemoryStorage:
+    # SQLite sxemasining xotiradagi nusxasi: test va benchmarklar uchun, qayta ishga tushganda yo'qoladi
+    def __init__(self):
+        self.categories = {}
+        self.products = {}
+        self.orders = {}
+        self.users = {}
+        self.reservations = {}
+        self.order_status_counts = collections.Counter()
+        self.price_history = collections.defaultdict(list)  # product_id -> [(changed_at, price)]
+        # AUTOINCREMENT kabi: o'chirilgan ID qayta ishlatilmaydi
+        self.id_counters = collections.defaultdict(lambda: itertools.count(1))
+        self._lock = threading.RLock()
+
+    def next_id(self, table):
+        return next(self.id_counters[table])
+
+    def take_stock_unit(self, product_id):
+        # SQLite'dagi take_stock_unit bilan bir xil; chaqiruvchi _lock ni ushlab turadi
+        product = self.products.get(product_id)
+        if product is None or product["stock"] is None:
+            return False
+        if product["stock"] <= 0:
+            raise OutOfStockError(product_id)
+        product["stock"] -= 1
+        return True
+
+    def return_stock_unit(self, product_id):
+        product = self.products.get(product_id)
+        if product is not None and product["stock"] is not None:
+            product["stock"] += 1
+
+    def record_price(self, product_id, price):
+        history = self.price_history[product_id]
+        if not history or history[-1][1] != price:
+            history.append((time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()), price))
+
+
+class MemoryCategoryRepo(CategoryRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def list(self):
+        return sorted(self.storage.categories.items(), key=lambda item: (item[1], item[0]))
+
+    def get_name(self, category_id):
+        return self.storage.categories.get(category_id)
+
+    def _check_unique(self, name, category_id=None):
+        for existing_id, existing_name in self.storage.categories.items():
+            if existing_name == name and existing_id != category_id:
+                raise DuplicateNameError(name)
+
+    def add(self, name):
+        with self.storage._lock:
+            self._check_unique(name)
+            category_id = self.storage.next_id("categories")
+            self.storage.categories[category_id] = name
+            return category_id
+
+    def rename(self, category_id, name):
+        with self.storage._lock:
+            if category_id in self.storage.categories:
+                self._check_unique(name, category_id)
+                self.storage.categories[category_id] = name
+
+    def delete(self, category_id):
+        with self.storage._lock:
+            if self.storage.categories.pop(category_id, None) is None:
+                return
+            for product in self.storage.products.values():
+                if product["category_id"] == category_id:
+                    product["category_id"] = None
+
+
+class MemoryProductRepo(ProductRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def _sorted(self, products):
+        return sorted(products, key=lambda product: (product["name"], product["id"]))
+
+    def list_by_category(self, category_id):
+        return [(p["id"], p["name"], p["price"], p["image_file_id"], p["description"])
+                for p in self._sorted(p for p in self.storage.products.values() if p["category_id"] == category_id)]
+
+    def list_with_category_names(self):
+        categories = self.storage.categories
+        return [(p["id"], p["name"], categories.get(p["category_id"]))
+                for p in self._sorted(self.storage.products.values())]
+
+    def get(self, product_id):
+        p = self.storage.products.get(product_id)
+        if p is None:
+            return None
+        return (p["id"], p["name"], p["description"], p["price"], p["image_file_id"],
+                self.storage.categories.get(p["category_id"]), p["stock"])
+
+    def get_name(self, product_id):
+        p = self.storage.products.get(product_id)
+        return p["name"] if p else None
+
+    def get_name_and_price(self, product_id):
+        p = self.storage.products.get(product_id)
+        return (p["name"], p["price"]) if p else None
+
+    def count_in_category(self, category_id):
+        return sum(1 for p in self.storage.products.values() if p["category_id"] == category_id)
+
+    def add(self, category_id, name, description, price, image_file_id):
+        with self.storage._lock:
+            if category_id is not None and category_id not in self.storage.categories:
+                raise sqlite3.IntegrityError("FOREIGN KEY constraint failed")
+            product_id = self.storage.next_id("products")
+            self.storage.products[product_id] = {"id": product_id, "category_id": category_id, "name": name,
+                                                 "description": description, "price": price,
+                                                 "image_file_id": image_file_id, "stock": None}
+            self.storage.record_price(product_id, price)
+            return product_id
+
+    def update(self, product_id, **fields):
+        check_product_fields(fields)
+        with self.storage._lock:
+            category_id = fields.get("category_id")
+            if category_id is not None and category_id not in self.storage.categories:
+                raise sqlite3.IntegrityError("FOREIGN KEY constraint failed")
+            product = self.storage.products.get(product_id)
+            if product is not None:
+                product.update(fields)
+                if "price" in fields:
+                    self.storage.record_price(product_id, fields["price"])
+
+    def delete(self, product_id):
+        with self.storage._lock:
+            if self.storage.products.pop(product_id, None) is None:
+                return
+            for order in self.storage.orders.values():
+                if order["product_id"] == product_id:
+                    order["product_id"] = None
+
+    def reserve(self, product_id, user_id, ttl):
+        with self.storage._lock:
+            if not self.storage.take_stock_unit(product_id):
+                return None
+            reservation_id = self.storage.next_id("stock_reservations")
+            self.storage.reservations[reservation_id] = (product_id, user_id, time.time() + ttl)
+            return reservation_id
+
+    def reserve_many(self, quantities, user_id, ttl):
+        reserved, shortages = [], {}
+        expires_at = time.time() + ttl
+        with self.storage._lock:
+            for product_id, quantity in quantities.items():
+                product = self.storage.products.get(product_id)
+                if product is not None and product["stock"] is None:
+                    continue
+                taken = min(quantity, product["stock"]) if product is not None else 0
+                if taken < quantity:
+                    shortages[product_id] = taken
+                if taken:
+                    product["stock"] -= taken
+                for _ in range(taken):
+                    reservation_id = self.storage.next_id("stock_reservations")
+                    self.storage.reservations[reservation_id] = (product_id, user_id, expires_at)
+                    reserved.append(reservation_id)
+        return reserved, shortages
+
+    def release_reservation(self, reservation_id):
+        with self.storage._lock:
+            reservation = self.storage.reservations.pop(reservation_id, None)
+            if reservation:
+                self.storage.return_stock_unit(reservation[0])
+            return reservation is not None
+
+    def release_expired_reservations(self):
+        with self.storage._lock:
+            now = time.time()
+            expired = [reservation_id for reservation_id, (_, _, expires_at) in self.storage.reservations.items()
+                       if expires_at < now]
+            for reservation_id in expired:
+                self.storage.return_stock_unit(self.storage.reservations.pop(reservation_id)[0])
+            return len(expired)
+
+    def price_at(self, product_id, at):
+        prices = [price for changed_at, price in self.storage.price_history.get(product_id, ()) if changed_at <= at]
+        return prices[-1] if prices else None
+
+    def price_history(self, product_id, since, until):
+        history = self.storage.price_history.get(product_id, [])
+        start = [entry for entry in history if entry[0] <= since][-1:]
+        return start + [entry for entry in history if since < entry[0] <= until]
+
+
+class MemoryOrderRepo(OrderRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def create_with_items(self, user_id, user_username, phone_number, items, reservation_ids=()):
+        product_id, product_name, total = order_header(items)
+        needed = collections.Counter()
+        for item_product_id, _, _, quantity in items:
+            needed[item_product_id] += quantity
+        with self.storage._lock:
+            reserved = collections.Counter()
+            for reservation_id in reservation_ids:
+                reservation = self.storage.reservations.get(reservation_id)
+                if reservation:
+                    reserved[reservation[0]] += 1
+            # Avval tekshiramiz, keyin o'zgartiramiz: xatolikda SQLite'dagi kabi hech narsa o'zgarmaydi
+            for item_product_id, count in needed.items():
+                product = self.storage.products.get(item_product_id)
+                missing = count - reserved[item_product_id]
+                if product and product["stock"] is not None and missing > product["stock"]:
+                    raise OutOfStockError(item_product_id)
+            for reservation_id in reservation_ids:
+                self.storage.reservations.pop(reservation_id, None)
+            for item_product_id in needed.keys() | reserved.keys():
+                for _ in range(needed[item_product_id] - reserved[item_product_id]):
+                    self.storage.take_stock_unit(item_product_id)
+                for _ in range(reserved[item_product_id] - needed[item_product_id]):
+                    self.storage.return_stock_unit(item_product_id)
+            self.storage.order_status_counts[ORDER_STATUSES[0]] += 1
+            order_id = self.storage.next_id("orders")
+            self.storage.orders[order_id] = {
+                "id": order_id, "user_id": user_id, "user_username": user_username, "product_id": product_id,
+                "phone_number": phone_number, "product_name_at_order": product_name,
+                "product_price_at_order": total, "items": list(items), "status": ORDER_STATUSES[0],
+                # CURRENT_TIMESTAMP bilan bir xil format (UTC)
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())}
+            return order_id
+
+    def _row(self, o):
+        product = self.storage.products.get(o["product_id"]) or {}
+        first_name, last_name, _ = self.storage.users.get(o["user_id"], (None, None, None))
+        name = o["product_name_at_order"] or product.get("name") or UNKNOWN_PRODUCT_NAME
+        price = o["product_price_at_order"]
+        if price is None:
+            price = product.get("price", 0)
+        return (o["id"], o["user_id"], first_name or "", last_name or "", o["user_username"],
+                o["phone_number"], name, price, o["timestamp"])
+
+    def _newest_first(self, orders):
+        return sorted(orders, key=lambda o: (o["timestamp"], o["id"]), reverse=True)
+
+    def recent(self, limit):
+        return [self._row(o) for o in self._newest_first(self.storage.orders.values())[:limit]]
+
+    def get(self, order_id):
+        o = self.storage.orders.get(order_id)
+        return (*self._row(o), o["status"]) if o else None
+
+    def list_by_status(self, status, limit, before=None):
+        orders = [o for o in self.storage.orders.values() if o["status"] == status]
+        if before is not None:
+            orders = [o for o in orders if (o["timestamp"], o["id"]) < tuple(before)]
+        return [self._row(o) for o in self._newest_first(orders)[:limit]]
+
+    def set_status(self, order_id, status):
+        check_order_status(status)
+        with self.storage._lock:
+            order = self.storage.orders.get(order_id)
+            if order is None:
+                return None
+            previous = order["status"]
+            if previous != status:
+                order["status"] = status
+                self.storage.order_status_counts[previous] -= 1
+                self.storage.order_status_counts[status] += 1
+            return previous
+
+    def status_counts(self):
+        return dict(self.storage.order_status_counts)
+
+    def list_by_user(self, user_id, limit, before=None):
+        orders = [o for o in self.storage.orders.values() if o["user_id"] == user_id
+                  and (before is None or (o["timestamp"], o["id"]) < tuple(before))]
+        rows = []
+        for o in self._newest_first(orders)[:limit]:
+            _, _, _, _, _, _, name, price, timestamp = self._row(o)
+            rows.append((o["id"], timestamp, name, price, o["status"]))
+        return rows
+
+
+class MemoryUserRepo(UserRepo):
+    def __init__(self, storage):
+        self.storage = storage
+
+    def save(self, user_id, first_name, last_name, username):
+        with self.storage._lock:
+            current = self.storage.users.get(user_id)
+            if current is not None and current[0] == first_name and current[1] == last_name \
+                    and (current[2] == username or username is None):
+                return
+            if username is not None and any(other_username == username and other_id != user_id
+                                            for other_id, (_, _, other_username) in self.storage.users.items()):
+                raise DuplicateNameError(username)
+            self.storage.users[user_id] = (first_name, last_name, username)
+
+
+def open_repositories(backend, db_name=None, on_order_created=None, recent_orders_source=None,
+                      on_order_status_changed=None):
+    if backend == "sqlite":
+        storage = SQLiteStorage(db_name)
+        return Repositories(SQLiteCategoryRepo(storage), SQLiteProductRepo(storage),
+                            SQLiteOrderRepo(storage, on_order_created, recent_orders_source, on_order_status_changed),
+                            SQLiteUserRepo(storage))
+    if backend == "memory":
+        # Ilgaklar SQLite ulanishini oladi: xotiradagi omborda statistika va arxiv yo'q, ular e'tiborsiz qoldiriladi
+        storage = MemoryStorage()
+        return Repositories(MemoryCategoryRepo(storage), MemoryProductRepo(storage), MemoryOrderRepo(storage),
+                            MemoryUserRepo(storage))
+    raise ValueError(f"Noma'lum saqlash turi: {backend}")
@@ -0,0 +1,58 @@
+# Testlar haqiqiy jewelry_bot.db ga tegmaydi va Telegram'ga so'rov yubormaydi:
+# har bir test vaqtinchalik bazada, bot.DB_NAME va bot.repos almashtirilgan holda ishlaydi.
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DB_NAME"] = os.path.join(tempfile.gettempdir(), "jewelry_bot_test_import.db")
+os.environ["TRACE_FILE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import bot  # noqa: E402
+import storage  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    path = str(tmp_path / "test.db")
+    monkeypatch.setattr(bot, "DB_NAME", path)
+    bot.setup_database()
+    return path
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def repos(request, db, monkeypatch):
+    repositories = storage.open_repositories(request.param, db, on_order_created=bot.record_order_in_rollups,
+                                             recent_orders_source=bot.recent_orders_source_sql,
+                                             on_order_status_changed=bot.record_order_status_in_rollups)
+    monkeypatch.setattr(bot, "repos", repositories)
+    return repositories
+
+
+@pytest.fixture
+def add_product(repos):
+    def add(name="Uzuk", price=100_00, stock=None, category_id=None):
+        product_id = repos.products.add(category_id, name, None, price, None)
+        if stock is not None:
+            repos.products.update(product_id, stock=stock)
+        return product_id
+    return add
+
+
+@pytest.fixture
+def stock_of(repos):
+    return lambda product_id: repos.products.get(product_id)[6]
+
+
+@pytest.fixture
+def create_orders(repos, add_product):
+    # Har bir user_id uchun bitta 100 so'mlik buyurtma; ID lar yaratilish tartibida
+    def create(user_ids):
+        product_id = add_product()
+        return [repos.orders.create_with_items(user_id, "mijoz", "+998901234567", [(product_id, "Uzuk", 100_00, 1)])
+                for user_id in user_ids]
+    return create
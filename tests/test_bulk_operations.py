@@ -0,0 +1,107 @@
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def catalog(repos):
+    rings = repos.categories.add("Uzuklar")
+    chains = repos.categories.add("Zanjirlar")
+    products = {
+        "Oltin uzuk": repos.products.add(rings, "Oltin uzuk", None, 149_999_50, None),
+        "Kumush uzuk": repos.products.add(rings, "Kumush uzuk", None, 1000_00, None),
+        "Oltin zanjir": repos.products.add(chains, "Oltin zanjir", None, 100_000_00, None),
+        "50% chegirma": repos.products.add(None, "50% chegirma", None, 20_000_00, None),
+        "500 chegirma": repos.products.add(None, "500 chegirma", None, 30_000_00, None),
+    }
+    return {"rings": rings, "chains": chains, "products": products}
+
+
+def price_of(repos, product_id):
+    return repos.products.get(product_id)[3]
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("+10%", {"kind": "percent", "amount": 10.0, "round_to": 0, "round_mode": "nearest"}),
+    ("-2,5 %", {"kind": "percent", "amount": -2.5, "round_to": 0, "round_mode": "nearest"}),
+    ("+5000 1000 up", {"kind": "delta", "amount": 5000_00, "round_to": 1000_00, "round_mode": "up"}),
+    ("=99000 100 past", {"kind": "set", "amount": 99_000_00, "round_to": 100_00, "round_mode": "down"}),
+    ("=5%", None),
+    ("=0", None),
+    ("10%", None),
+    ("+10% 1000 sideways", None),
+])
+def test_parse_bulk_price_change(text, expected):
+    assert bot.parse_bulk_price_change(text) == expected
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+@pytest.mark.parametrize("text, old_price, new_price", [
+    ("+10%", 1_250_000_00, 1_375_000_00),
+    ("+10%", 149_999_50, 164_999_45),
+    ("+10% 1000", 149_999_50, 165_000_00),
+    ("+10% 1000 up", 149_999_50, 165_000_00),
+    # 1000 * 1.1 float'da 1100.0000000000002: aniq karrali narx yuqoriga yaxlitlashda bir qadam surilmaydi
+    ("+10% 10 up", 1000_00, 1100_00),
+    ("+10% 1000 up", 100_000_00, 110_000_00),
+    ("-10% 1000 down", 149_999_50, 134_000_00),
+    ("-10% 1000", 149_999_50, 135_000_00),
+    ("+5000", 149_999_50, 154_999_50),
+    ("-5000 1000", 149_999_50, 145_000_00),
+    ("=99000", 149_999_50, 99_000_00),
+    # Narx hech qachon 0 yoki manfiy bo'lmaydi: eng kami 1 so'm yoki yaxlitlash qadami
+    ("-100%", 149_999_50, 1_00),
+    ("-200000", 149_999_50, 1_00),
+    ("-200000 1000", 149_999_50, 1000_00),
+])
+def test_bulk_price_change_rounding(repos, text, old_price, new_price):
+    product_id = repos.products.add(None, "Uzuk", None, old_price, None)
+    change = bot.parse_bulk_price_change(text)
+    count, min_price, max_price, new_min, new_max = bot.preview_bulk_product_operation("price", "all", "", change)
+    assert (count, min_price, max_price, new_min, new_max) == (1, old_price, old_price, new_price, new_price)
+    assert bot.run_bulk_product_operation("price", "all", "", change) == 1
+    assert price_of(repos, product_id) == new_price
+    assert repos.products.price_history(product_id, "2000-01-01 00:00:00", "2100-01-01 00:00:00")[-1][1] == new_price
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+@pytest.mark.parametrize("source, name_filter, expected", [
+    ("all", "", ["Oltin uzuk", "Kumush uzuk", "Oltin zanjir", "50% chegirma", "500 chegirma"]),
+    ("rings", "", ["Oltin uzuk", "Kumush uzuk"]),
+    ("rings", "oltin", ["Oltin uzuk"]),
+    ("all", "Oltin", ["Oltin uzuk", "Oltin zanjir"]),
+    ("none", "", ["50% chegirma", "500 chegirma"]),
+    # % va _ LIKE belgisi emas, oddiy belgi sifatida qidiriladi
+    ("none", "50%", ["50% chegirma"]),
+    ("all", "0_c", []),
+])
+def test_bulk_filter_scopes_preview_and_price_change(repos, catalog, source, name_filter, expected):
+    source = str(catalog[source]) if source in catalog else source
+    change = bot.parse_bulk_price_change("+1000")
+    before = {name: price_of(repos, product_id) for name, product_id in catalog["products"].items()}
+    assert bot.preview_bulk_product_operation("price", source, name_filter, change)[0] == len(expected)
+    assert bot.run_bulk_product_operation("price", source, name_filter, change) == len(expected)
+    for name, product_id in catalog["products"].items():
+        assert price_of(repos, product_id) == before[name] + (1000_00 if name in expected else 0), name
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_bulk_move_only_touches_filtered_products(repos, catalog):
+    source = str(catalog["rings"])
+    assert bot.preview_bulk_product_operation("move", source, "Oltin")[0] == 1
+    assert bot.run_bulk_product_operation("move", source, "Oltin", target_category_id=catalog["chains"]) == 1
+    assert repos.products.count_in_category(catalog["rings"]) == 1
+    assert repos.products.count_in_category(catalog["chains"]) == 2
+    assert bot.run_bulk_product_operation("move", "none", "", target_category_id=None) == 2
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_bulk_delete_only_touches_filtered_products(repos, catalog):
+    order_id = repos.orders.create(10, "mijoz", catalog["products"]["Oltin zanjir"], "Oltin zanjir", 100_000_00,
+                                   "+998901234567")
+    assert bot.preview_bulk_product_operation("delete", str(catalog["chains"]), "")[0] == 1
+    assert bot.run_bulk_product_operation("delete", str(catalog["chains"]), "") == 1
+    assert sorted(name for _, name, _ in repos.products.list_with_category_names()) == [
+        "50% chegirma", "500 chegirma", "Kumush uzuk", "Oltin uzuk"]
+    # Buyurtma o'chirilgan mahsulot nomi va narxi bilan qoladi
+    assert repos.orders.get(order_id)[6:8] == ("Oltin zanjir", 100_000_00)
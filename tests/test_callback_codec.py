@@ -0,0 +1,80 @@
+import base64
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize("action, args", [
+    ("view_categories", ()),
+    ("category", (5,)),
+    ("next_product", (3, 1048577, 4)),
+    ("prodcat", (None,)),
+    ("bulk_op", ("price",)),
+    ("admin_analytics", (-7, 0)),
+    ("admin_order_queue", ("new", "2026-10-19 18:50:01", 123456)),
+    ("admin_share_link", ("p", 2 ** 40)),
+    ("bulk_src", ("Oltin uzuk ✨",)),
+])
+def test_round_trip(action, args):
+    data = bot.pack_callback(action, *args)
+    assert len(data.encode("utf-8")) <= bot.CALLBACK_DATA_MAX_BYTES
+    assert bot.unpack_callback(data) == (action, args)
+
+
+def test_every_action_round_trips():
+    for action in bot.CALLBACK_ACTIONS:
+        assert bot.unpack_callback(bot.pack_callback(action, 1)) == (action, (1,))
+
+
+def test_negative_and_large_integers():
+    values = (-1, -64, 63, 64, -(2 ** 40), 2 ** 62)
+    assert bot.unpack_callback(bot.pack_callback("category", *values)) == ("category", values)
+
+
+def test_rejects_data_over_64_bytes():
+    # "#" + base64(versiya, amal, teg, uzunlik, 43 bayt) = roppa-rosa 64 belgi
+    assert len(bot.pack_callback("bulk_op", "x" * 43)) == bot.CALLBACK_DATA_MAX_BYTES
+    with pytest.raises(ValueError):
+        bot.pack_callback("bulk_op", "x" * 44)
+
+
+def test_legacy_callback_data():
+    assert bot.unpack_callback("view_categories") == ("view_categories", ())
+    assert bot.unpack_callback("category_5") == ("category", (5,))
+    assert bot.unpack_callback("admin_view_prod_12") == ("admin_view_prod", (12,))
+    assert bot.unpack_callback("prodcat_None") == ("prodcat", (None,))
+
+
+def test_unknown_or_corrupt_data():
+    other_version = bytes((bot.CALLBACK_CODEC_VERSION + 1, 0))
+    assert bot.unpack_callback("#" + base64.urlsafe_b64encode(other_version).decode().rstrip("=")) == (None, ())
+    assert bot.unpack_callback("#AQ" + "%%") == (None, ())
+    assert bot.unpack_callback("no_such_action_1") == (None, ())
+    assert bot.unpack_callback("") == (None, ())
+
+
+def test_payload_store_shares_keyed_lists():
+    store = bot.CallbackPayloadStore(max_items=2)
+    products = [(1, "A", 100, None, None)]
+    token = store.put(products, key=("category", 1))
+    assert store.put(list(products), key=("category", 1)) == token
+    assert len(store) == 1
+    # Ro'yxat o'zgargan bo'lsa, yangi token beriladi
+    changed = store.put(products + [(2, "B", 200, None, None)], key=("category", 1))
+    assert changed != token and store.get(token) == products
+
+
+def test_payload_store_evicts_least_recently_used():
+    store = bot.CallbackPayloadStore(max_items=2)
+    first = store.put(["first"], key="a")
+    second = store.put(["second"])
+    store.get(first)
+    store.put(["third"])
+    assert store.get(second) is None
+    assert store.get(first) == ["first"]
+    store.put(["fourth"])
+    store.put(["fifth"])
+    assert store.get(first) is None
+    # Chiqarilgan kalit uchun eski token qayta ishlatilmaydi
+    assert store.put(["first"], key="a") != first
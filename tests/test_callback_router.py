@@ -0,0 +1,87 @@
+import asyncio
+import types
+
+import pytest
+from telegram import CallbackQuery, Update, User
+from telegram.ext import ConversationHandler
+
+import bot
+
+
+def callback_update(data, user_id):
+    user = User(id=user_id, first_name="F", is_bot=False)
+    return Update(update_id=1, callback_query=CallbackQuery(id="1", from_user=user, chat_instance="c", data=data))
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    # Telegram'ga so'rov yubormaslik uchun: javoblar ro'yxatga yoziladi
+    calls = []
+
+    async def answer(self, text=None, show_alert=None, **kwargs):
+        calls.append((text, show_alert))
+
+    monkeypatch.setattr(CallbackQuery, "answer", answer)
+    return calls
+
+
+def spy_router():
+    # Haqiqiy marshrutlar jadvali bilan, lekin handlerlar o'rniga chaqiruvlarni yozib boradigan spy
+    calls = []
+
+    def spy(action):
+        async def handler(update, context):
+            calls.append(action)
+        return handler
+
+    routes = {action: (spy(action), admin_only) for action, (_, admin_only) in bot.CALLBACK_ROUTES.items()}
+    return bot.CallbackRouter(routes, fallback=(spy("fallback"), False)), calls
+
+
+def test_every_action_resolves_to_its_handler():
+    router = bot.build_callback_router()
+    for action, route in bot.CALLBACK_ROUTES.items():
+        assert router.check_update(callback_update(bot.pack_callback(action, 1), 5)) == route
+    assert router.check_update(callback_update("eskirgan_tugma", 5)) == (bot.answer_unknown_callback, False)
+
+
+def test_admin_flag_matches_action_prefix():
+    for action, (_, admin_only) in bot.CALLBACK_ROUTES.items():
+        assert admin_only == action.startswith("admin_"), action
+
+
+def test_non_admin_is_rejected_on_every_admin_route(answers):
+    router, calls = spy_router()
+    admin_actions = [action for action, (_, admin_only) in bot.CALLBACK_ROUTES.items() if admin_only]
+    for action in admin_actions:
+        update = callback_update(bot.pack_callback(action), bot.ADMIN_ID + 1)
+        asyncio.run(router.handle_update(update, None, router.check_update(update), None))
+    assert calls == []
+    assert answers == [("Sizda bu amal uchun ruxsat yo'q.", True)] * len(admin_actions)
+
+
+def test_admin_and_public_routes_dispatch(answers):
+    router, calls = spy_router()
+    for action, user_id in (("admin_panel", bot.ADMIN_ID), ("cart_view", bot.ADMIN_ID + 1)):
+        update = callback_update(bot.pack_callback(action), user_id)
+        asyncio.run(router.handle_update(update, None, router.check_update(update), None))
+    # dispatch (BaseHandler callback'i) ham shu yo'ldan o'tadi
+    asyncio.run(router.dispatch(callback_update("eskirgan_tugma", 5), types.SimpleNamespace(application=None)))
+    assert calls == ["admin_panel", "cart_view", "fallback"]
+    assert answers == []
+
+
+def test_conversation_entry_points_are_admin_only(answers):
+    calls = []
+
+    async def entry(update, context):
+        calls.append(update.effective_user.id)
+        return 1
+
+    wrapped = bot.admin_conversation_entry(entry)
+    stranger = callback_update(bot.pack_callback("admin_add_category_prompt"), bot.ADMIN_ID + 1)
+    assert asyncio.run(wrapped(stranger, None)) == ConversationHandler.END
+    assert asyncio.run(wrapped(callback_update(bot.pack_callback("admin_add_category_prompt"), bot.ADMIN_ID),
+                               None)) == 1
+    assert calls == [bot.ADMIN_ID]
+    assert answers == [("Sizda bu amal uchun ruxsat yo'q.", True)]
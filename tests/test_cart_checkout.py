@@ -0,0 +1,51 @@
+import pytest
+
+from storage import OutOfStockError
+
+
+def test_checkout_writes_header_and_items(repos, add_product, stock_of):
+    ring = add_product("Uzuk", 150_000_00, 3)
+    chain = add_product("Zanjir", 80_000_00, None)
+    order_id = repos.orders.create_with_items(
+        10, "mijoz", "+998901234567", [(ring, "Uzuk", 150_000_00, 2), (chain, "Zanjir", 80_000_00, 1)])
+    assert repos.orders.list_by_user(10, 5) == [
+        (order_id, repos.orders.get(order_id)[8], "Uzuk va yana 1 ta mahsulot", 380_000_00, "new")]
+    assert stock_of(ring) == 1
+    assert stock_of(chain) is None
+    assert repos.orders.status_counts() == {"new": 1}
+
+
+def test_checkout_is_all_or_nothing(repos, add_product, stock_of):
+    ring = add_product("Uzuk", 150_000_00, 2)
+    earring = add_product("Sirg'a", 90_000_00, 1)
+    reservation_id = repos.products.reserve(ring, 10, 60)
+    with pytest.raises(OutOfStockError):
+        repos.orders.create_with_items(10, "mijoz", "+998901234567",
+                                       [(ring, "Uzuk", 150_000_00, 2), (earring, "Sirg'a", 90_000_00, 2)],
+                                       [reservation_id])
+    # Hech narsa yozilmagan: buyurtma yo'q, zaxira va bron avvalgidek
+    assert repos.orders.list_by_user(10, 5) == []
+    assert repos.orders.status_counts().get("new", 0) == 0
+    assert stock_of(ring) == 1
+    assert stock_of(earring) == 1
+    assert repos.products.release_reservation(reservation_id) is True
+
+
+def test_checkout_consumes_reservations_without_double_counting(repos, add_product, stock_of):
+    ring = add_product("Uzuk", 150_000_00, 3)
+    reservation_ids = [repos.products.reserve(ring, 10, 60)]
+    assert stock_of(ring) == 2
+    repos.orders.create_with_items(10, "mijoz", "+998901234567", [(ring, "Uzuk", 150_000_00, 2)], reservation_ids)
+    # Bitta dona bron orqali, ikkinchisi zaxiradan olindi
+    assert stock_of(ring) == 1
+    assert repos.products.release_reservation(reservation_ids[0]) is False
+
+
+def test_checkout_returns_surplus_reservations(repos, add_product, stock_of):
+    ring = add_product("Uzuk", 150_000_00, 2)
+    earring = add_product("Sirg'a", 90_000_00, 1)
+    reservation_ids = [repos.products.reserve(ring, 10, 60), repos.products.reserve(earring, 10, 60)]
+    # Sirg'a savatdan olib tashlangan: uning broni zaxiraga qaytadi
+    repos.orders.create_with_items(10, "mijoz", "+998901234567", [(ring, "Uzuk", 150_000_00, 1)], reservation_ids)
+    assert stock_of(ring) == 1
+    assert stock_of(earring) == 1
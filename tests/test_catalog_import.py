@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+import bot
+
+pytestmark = pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+
+
+def run_import(content, file_name, dry_run=False):
+    raw_bytes = content if isinstance(content, bytes) else content.encode("utf-8")
+    return bot.import_catalog_rows(bot.iter_catalog_import_rows(raw_bytes, file_name), dry_run=dry_run)
+
+
+def catalog(repos):
+    return sorted((category or "", name) for _, name, category in repos.products.list_with_category_names())
+
+
+CSV_WITH_ERRORS = (
+    "category;name;description;price;image_file_id\n"
+    "Uzuklar;Oltin uzuk;585 proba;1 250 000;img-1\n"
+    "Uzuklar;;bo'sh nom;100;\n"
+    "Zanjirlar;Oltin zanjir;;abc;\n"
+    "Zanjirlar;Kumush zanjir;;0;\n"
+    ";Sovg'a qutisi;;15000,50;\n"
+)
+
+
+def test_csv_import_reports_bad_rows(repos):
+    report = run_import(CSV_WITH_ERRORS, "katalog.csv")
+    assert (report["total"], report["valid"], report["inserted"], report["updated"]) == (5, 2, 2, 0)
+    assert report["new_categories"] == 1
+    # Qator raqamlari fayldagidek: 1-qator sarlavha
+    assert [row_no for row_no, _ in report["errors"]] == [3, 4, 5]
+    assert report["errors"][0][1] == "'name' bo'sh"
+    assert report["aborted"] is None
+    assert catalog(repos) == [("", "Sovg'a qutisi"), ("Uzuklar", "Oltin uzuk")]
+    product = repos.products.get(next(p for p, name, _ in repos.products.list_with_category_names()
+                                      if name == "Oltin uzuk"))
+    assert product[2:5] == ("585 proba", 1_250_000_00, "img-1")
+    text = bot.format_catalog_import_report(report, dry_run=False)
+    assert "• 3-qator: 'name' bo'sh" in text and "Qo'shildi: 2" in text
+
+
+def test_dry_run_writes_nothing(repos):
+    report = run_import(CSV_WITH_ERRORS, "katalog.csv", dry_run=True)
+    assert (report["total"], report["valid"], len(report["errors"])) == (5, 2, 3)
+    assert (report["inserted"], report["updated"], report["new_categories"]) == (0, 0, 1)
+    assert catalog(repos) == []
+    assert repos.categories.list() == []
+    assert "bazaga yozilmadi" in bot.format_catalog_import_report(report, dry_run=True)
+
+
+def test_reimport_updates_by_category_and_name(repos):
+    run_import(CSV_WITH_ERRORS, "katalog.csv")
+    rows = [
+        {"category": "Uzuklar", "name": "Oltin uzuk", "price": "1 300 000"},
+        {"category": "Sirg'alar", "name": "Oltin uzuk", "price": 500000},
+        # Fayldagi takror: oxirgisi ustun
+        {"category": None, "name": "Sovg'a qutisi", "price": "16000"},
+        {"category": None, "name": "Sovg'a qutisi", "price": "17000", "description": "katta"},
+    ]
+    report = run_import(json.dumps(rows), "katalog.json")
+    assert (report["valid"], report["inserted"], report["updated"], report["new_categories"]) == (4, 1, 2, 1)
+    products = {(category, name): product_id
+                for product_id, name, category in repos.products.list_with_category_names()}
+    # Rasm berilmasa eskisi saqlanadi
+    assert repos.products.get(products[("Uzuklar", "Oltin uzuk")])[2:5] == (None, 1_300_000_00, "img-1")
+    assert repos.products.get(products[(None, "Sovg'a qutisi")])[2:4] == ("katta", 17_000_00)
+    assert repos.products.get(products[("Sirg'alar", "Oltin uzuk")])[3] == 500_000_00
+
+
+def test_chunked_upsert_carries_categories_across_chunks(repos, monkeypatch):
+    monkeypatch.setattr(bot, "IMPORT_CHUNK_SIZE", 2)
+    lines = ["category,name,price"] + [f"Uzuklar,Uzuk {number},{100 + number}" for number in range(5)] \
+        + ["Uzuklar,Uzuk 0,999"]
+    report = run_import("\n".join(lines) + "\n", "katalog.csv")
+    assert (report["valid"], report["inserted"], report["updated"], report["new_categories"]) == (6, 5, 1, 1)
+    assert [name for _, name in repos.categories.list()] == ["Uzuklar"]
+    assert len(catalog(repos)) == 5
+    products = {name: product_id for product_id, name, _ in repos.products.list_with_category_names()}
+    assert repos.products.get(products["Uzuk 0"])[3] == 999_00
+
+
+def test_json_lines_and_non_object_rows(repos):
+    content = '{"name": "Uzuk", "price": 100}\n\n{"name": "Sirg\'a", "price": \n["ro\'yxat"]\n'
+    report = run_import(content, "katalog.jsonl")
+    assert report["errors"] == [(3, report["errors"][0][1]), (4, "qator obyekt emas")]
+    assert report["errors"][0][1].startswith("JSON xato")
+    assert report["inserted"] == 1 and report["aborted"] is None
+    report = run_import('[{"name": "Zanjir", "price": 5}, 7]', "katalog.json")
+    assert report["errors"] == [(2, "qator obyekt emas")]
+
+
+def test_truncated_json_array_keeps_rows_before_break(repos):
+    report = run_import('[{"name": "Uzuk", "price": 100}, {"name": "Zanjir", "price": 200}, {"name": "Sir',
+                        "katalog.json")
+    assert report["aborted"][0] == 2
+    assert (report["total"], report["inserted"]) == (2, 2)
+    assert catalog(repos) == [("", "Uzuk"), ("", "Zanjir")]
+    assert "2-qatordan keyin o'qilmadi" in bot.format_catalog_import_report(report, dry_run=False)
+
+
+def test_undecodable_csv_tail_aborts_after_written_rows(repos):
+    lines = ["category,name,price"] + [f"Uzuklar,Mahsulot raqami {number:05d},{number + 1}" for number in range(600)]
+    content = ("\n".join(lines) + "\n").encode("utf-8") + b"Uzuklar,\xff\xfe,100\n"
+    report = run_import(content, "katalog.csv")
+    last_row_no, error = report["aborted"]
+    # Yaroqli qatorlar bloklab o'qiladi: buzilgan joyga yetguncha o'qilganlari yozilgan
+    assert 2 <= last_row_no < 602
+    assert report["inserted"] == report["valid"] == last_row_no - 1
+    assert "utf-8" in error
+
+
+def test_unreadable_file(repos):
+    report = run_import(b"\xff\xfe[]", "katalog.json")
+    assert report["aborted"][0] == 0 and report["total"] == 0
+    assert "Faylni o'qib bo'lmadi" in bot.format_catalog_import_report(report, dry_run=False)
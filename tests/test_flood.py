@@ -0,0 +1,58 @@
+import asyncio
+import types
+
+import pytest
+from telegram.ext import ApplicationHandlerStop
+
+import bot
+
+
+def test_burst_then_refill():
+    buckets = bot.UserTokenBuckets(rate_per_second=2, burst=3, max_users=10)
+    assert [buckets.allow(10, now=0) for _ in range(4)] == [True, True, True, False]
+    # 0.5 soniyada bitta token tiklanadi
+    assert [buckets.allow(10, now=0.5) for _ in range(2)] == [True, False]
+    # Uzoq jimlikdan keyin ham chelak burst dan oshmaydi
+    assert [buckets.allow(10, now=100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_idle_buckets_expire_and_users_are_independent():
+    buckets = bot.UserTokenBuckets(rate_per_second=2, burst=3, max_users=10)
+    for _ in range(3):
+        buckets.allow(10, now=0)
+    assert buckets.allow(20, now=0) is True
+    assert len(buckets) == 2
+    # idle_ttl = burst / rate = 1.5 s: to'liq tiklangan chelaklar o'chiriladi
+    buckets.allow(30, now=2)
+    assert len(buckets) == 1
+
+
+def test_tracked_users_are_capped_lru():
+    buckets = bot.UserTokenBuckets(rate_per_second=2, burst=3, max_users=2)
+    buckets.allow(10, now=0)
+    buckets.allow(10, now=0)
+    buckets.allow(20, now=0)
+    buckets.allow(30, now=0)
+    assert len(buckets) == 2
+    # 10 eng eskisi sifatida o'chirildi: yangi to'liq chelak oladi
+    assert [buckets.allow(10, now=0) for _ in range(4)] == [True, True, True, False]
+
+
+def user_update(user_id, answers):
+    async def answer(text=None, **kwargs):
+        answers.append(text)
+    return types.SimpleNamespace(effective_user=types.SimpleNamespace(id=user_id),
+                                 callback_query=types.SimpleNamespace(answer=answer))
+
+
+def test_throttle_stops_flood_but_not_admin(monkeypatch):
+    monkeypatch.setattr(bot, "flood_buckets", bot.UserTokenBuckets(rate_per_second=0.001, burst=2, max_users=10))
+    answers = []
+    for _ in range(5):
+        asyncio.run(bot.throttle_updates(user_update(bot.ADMIN_ID, answers), None))
+    asyncio.run(bot.throttle_updates(user_update(bot.ADMIN_ID + 1, answers), None))
+    asyncio.run(bot.throttle_updates(user_update(bot.ADMIN_ID + 1, answers), None))
+    with pytest.raises(ApplicationHandlerStop):
+        asyncio.run(bot.throttle_updates(user_update(bot.ADMIN_ID + 1, answers), None))
+    assert answers == ["⏳ Juda tez! Biroz kuting."]
+    assert len(bot.flood_buckets) == 1
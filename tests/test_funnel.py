@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import bot
+
+
+def bucket(timestamp):
+    return time.strftime("%Y-%m-%d %H", time.gmtime(timestamp))
+
+
+def code(stage):
+    return bot.FUNNEL_STAGE_CODES[stage]
+
+
+def test_buffer_drops_oldest_when_full():
+    buffer = bot.FunnelEventBuffer(capacity=3)
+    for user_id in range(5):
+        buffer.record("product", user_id, 100 + user_id)
+    assert buffer.dropped == 2
+    assert [event[2] for event in buffer.drain(2)] == [2, 3]
+    assert [event[2] for event in buffer.drain(10)] == [4]
+    assert len(buffer) == 0
+
+
+def test_hourly_aggregates_count_users_once_per_hour(db):
+    hour = (int(time.time()) // 3600 - 1) * 3600
+    bot.write_funnel_events([
+        (hour + 10, code("categories"), 1, None),
+        (hour + 20, code("categories"), 1, None),
+        (hour + 30, code("categories"), 2, None),
+        (hour + 40, code("buy"), 1, 7),
+    ])
+    # Keyingi yozish: o'sha soatdagi foydalanuvchi qayta sanalmaydi, yangi soatda esa sanaladi
+    bot.write_funnel_events([
+        (hour + 50, code("categories"), 2, None),
+        (hour + 3600, code("categories"), 2, None),
+    ])
+    assert bot.db_fetch_all("SELECT bucket, stage, events, users FROM funnel_hourly ORDER BY bucket, stage") == [
+        (bucket(hour), code("categories"), 4, 2),
+        (bucket(hour), code("buy"), 1, 1),
+        (bucket(hour + 3600), code("categories"), 1, 1),
+    ]
+    assert bot.db_fetch_one("SELECT COUNT(*) FROM funnel_events")[0] == 6
+    report = dict((stage, (events, users)) for stage, events, users in bot.fetch_funnel_report(1))
+    assert report["categories"] == (5, 3)
+    assert report["buy"] == (1, 1)
+    assert report["order"] == (0, 0)
+
+
+def test_flush_job_drains_buffer_in_batches(db, monkeypatch):
+    buffer = bot.FunnelEventBuffer(capacity=100)
+    monkeypatch.setattr(bot, "funnel_events", buffer)
+    monkeypatch.setattr(bot, "FUNNEL_FLUSH_BATCH_SIZE", 4)
+    for user_id in range(10):
+        buffer.record("category", user_id, 3)
+    asyncio.run(bot.flush_funnel_events_job(None))
+    assert len(buffer) == 0
+    assert bot.db_fetch_one("SELECT SUM(events), SUM(users) FROM funnel_hourly")[0:2] == (10, 10)
+
+
+def test_prune_keeps_hourly_totals(db):
+    old = time.time() - 40 * 24 * 60 * 60
+    bot.write_funnel_events([(old, code("order"), 1, 5), (time.time(), code("order"), 1, 6)])
+    bot.prune_funnel_events(retention_days=30)
+    assert bot.db_fetch_all("SELECT subject_id FROM funnel_events") == [(6,)]
+    assert bot.db_fetch_one("SELECT COUNT(*) FROM funnel_hourly_users")[0] == 1
+    assert bot.db_fetch_one("SELECT SUM(events) FROM funnel_hourly")[0] == 2
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import bot
+
+# Pul migratsiyasidan oldingi sxema: narxlar so'mda, REAL
+LEGACY_SCHEMA = """
+CREATE TABLE categories (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, category_id INTEGER, name TEXT NOT NULL,
+                       description TEXT, price REAL NOT NULL, image_file_id TEXT,
+                       FOREIGN KEY (category_id) REFERENCES categories (id) ON DELETE SET NULL);
+CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, user_username TEXT,
+                     product_id INTEGER, phone_number TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                     product_name_at_order TEXT, product_price_at_order REAL,
+                     FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE SET NULL);
+CREATE TABLE users (id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT UNIQUE);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute("INSERT INTO categories (name) VALUES ('Uzuklar')")
+    conn.executemany("INSERT INTO products (id, category_id, name, price) VALUES (?, 1, ?, ?)",
+                     [(1, "Oltin uzuk", 1250000.0), (2, "Kumush uzuk", 149999.5), (7, "Zanjir", 0.1)])
+    conn.execute("DELETE FROM products WHERE id = 7")
+    conn.execute("INSERT INTO orders (user_id, product_id, phone_number, product_name_at_order, "
+                 "product_price_at_order) VALUES (10, 2, '+998901234567', 'Kumush uzuk', 149999.5)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(bot, "DB_NAME", path)
+    return path
+
+
+def test_parse_and_format_money():
+    assert bot.parse_money("150 000") == 150_000_00
+    assert bot.parse_money("149999,50") == 149_999_50
+    assert bot.parse_money("0.005") == 1
+    assert bot.parse_money("abc") is None
+    assert bot.parse_money("NaN") is None
+    assert bot.format_money(149_999_50) == "150,000"
+    assert bot.format_money(-1_250_000_00) == "-1,250,000"
+    assert bot.format_money(10_00, sign=True) == "+10"
+
+
+def test_legacy_prices_become_integer_tiyin(legacy_db):
+    bot.setup_database()
+    conn = sqlite3.connect(legacy_db)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] >= bot.SCHEMA_VERSION_INTEGER_MONEY
+        assert conn.execute("SELECT id, price, typeof(price) FROM products ORDER BY id").fetchall() == [
+            (1, 1_250_000_00, "integer"), (2, 149_999_50, "integer")]
+        assert conn.execute("SELECT product_price_at_order, typeof(product_price_at_order) FROM orders").fetchall() \
+            == [(149_999_50, "integer")]
+        products_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'products'").fetchone()[0]
+        assert "REAL" not in products_sql.upper()
+        assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+        assert conn.execute("PRAGMA foreign_key_check").fetchall() == []
+        # AUTOINCREMENT: o'chirilgan eng katta id qayta berilmaydi
+        assert conn.execute("INSERT INTO products (name, price) VALUES ('Yangi', 100)").lastrowid == 8
+    finally:
+        conn.close()
+
+
+def test_money_migration_runs_once(legacy_db):
+    bot.setup_database()
+    bot.setup_database()
+    conn = sqlite3.connect(legacy_db)
+    try:
+        assert conn.execute("SELECT price FROM products WHERE id = 1").fetchone()[0] == 1_250_000_00
+    finally:
+        conn.close()
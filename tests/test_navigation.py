@@ -0,0 +1,80 @@
+import asyncio
+import types
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    # Karta chizish o'rniga qaysi update bilan chizilgani yoziladi
+    calls = []
+
+    async def display_product(update, context, chat_id, edit_message=False):
+        calls.append((chat_id, update.tap, asyncio.get_running_loop().time()))
+
+    async def save_user_info(user):
+        pass
+
+    monkeypatch.setattr(bot, "display_product", display_product)
+    monkeypatch.setattr(bot, "save_user_info", save_user_info)
+    return calls
+
+
+def tap(number):
+    return types.SimpleNamespace(tap=number, callback_query=types.SimpleNamespace(from_user=None))
+
+
+def fake_context(tasks):
+    def create_task(coroutine, update=None):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        tasks.append(task)
+        return task
+    return types.SimpleNamespace(application=types.SimpleNamespace(create_task=create_task))
+
+
+def test_last_tap_wins(renders):
+    async def scenario():
+        tasks = []
+        coalescer, context = bot.NavigationCoalescer(0.05, 1.0), fake_context(tasks)
+        for number in range(3):
+            coalescer.schedule(tap(number), context, 7)
+        coalescer.schedule(tap(0), context, 8)
+        assert len(tasks) == 2 and len(coalescer) == 2
+        await asyncio.gather(*tasks)
+        assert len(coalescer) == 0
+
+    asyncio.run(scenario())
+    assert sorted((chat_id, number) for chat_id, number, _ in renders) == [(7, 2), (8, 0)]
+
+
+def test_continuous_taps_render_by_max_delay(renders):
+    async def scenario():
+        tasks = []
+        coalescer, context = bot.NavigationCoalescer(0.05, 0.12), fake_context(tasks)
+        started_at = asyncio.get_running_loop().time()
+        for number in range(8):
+            coalescer.schedule(tap(number), context, 7)
+            await asyncio.sleep(0.03)
+        await asyncio.gather(*tasks)
+        return started_at
+
+    started_at = asyncio.run(scenario())
+    # Bosishlar to'xtamasa ham birinchi karta max_delay dan kechikmay chiziladi, keyingilari yangi oynada
+    _, first_tap, first_rendered_at = renders[0]
+    assert 0 < first_tap < 7
+    assert first_rendered_at - started_at < 0.5
+    assert renders[-1][1] == 7
+
+
+def test_discard_cancels_pending_render(renders):
+    async def scenario():
+        tasks = []
+        coalescer, context = bot.NavigationCoalescer(0.05, 1.0), fake_context(tasks)
+        coalescer.schedule(tap(0), context, 7)
+        coalescer.discard(7)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert renders == []
@@ -0,0 +1,62 @@
+import pytest
+
+import bot
+
+
+def history_pages(repos, user_id, page_size):
+    pages, before = [], None
+    while True:
+        rows = repos.orders.list_by_user(user_id, page_size, before)
+        if not rows:
+            return pages
+        pages.append([row[0] for row in rows])
+        before = (rows[-1][1], rows[-1][0])
+
+
+def test_history_pages_only_own_orders(repos, create_orders):
+    order_ids = create_orders([10, 20, 10, 10, 20, 10])
+    own = [order_id for order_id, user_id in zip(order_ids, [10, 20, 10, 10, 20, 10]) if user_id == 10]
+    assert history_pages(repos, 10, 3) == [own[:0:-1], own[:1]]
+    assert history_pages(repos, 30, 3) == []
+
+
+def test_history_row_shape(repos, create_orders):
+    order_id, = create_orders([10])
+    repos.orders.set_status(order_id, "shipped")
+    (row_id, timestamp, name, price, status), = repos.orders.list_by_user(10, 5)
+    assert (row_id, name, price, status) == (order_id, "Uzuk", 100_00, "shipped")
+    assert len(timestamp) == len("2026-01-01 00:00:00")
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_history_continues_into_archive(repos, create_orders):
+    order_ids = create_orders([10] * 5)
+    placeholders = ",".join("?" * 2)
+    bot.db_query(f"UPDATE orders SET timestamp = '2000-01-01 00:00:00' WHERE id IN ({placeholders})", order_ids[:2])
+    assert bot.archive_orders_batch("2001-01-01 00:00:00") == 2
+    # Sahifa "issiq" jadvalda boshlanib, arxivda davom etadi
+    assert history_pages(repos, 10, 2) == [order_ids[:2:-1], [order_ids[2], order_ids[1]], [order_ids[0]]]
+
+
+def test_rendered_page_links_to_next_page(repos, create_orders, monkeypatch):
+    monkeypatch.setattr(bot, "ORDER_HISTORY_PAGE_SIZE", 2)
+    order_ids = create_orders([10] * 3)
+    text, reply_markup = bot.render_order_history_page(10)
+    cursors = [bot.unpack_callback(button.callback_data)[1] for row in reply_markup.inline_keyboard for button in row
+               if bot.unpack_callback(button.callback_data)[0] == "my_orders"]
+    assert len(cursors) == 1 and len(cursors[0]) == 2
+    next_text, _ = bot.render_order_history_page(10, cursors[0])
+    assert f"#{order_ids[2]}" in text and f"#{order_ids[0]}" not in text
+    assert f"#{order_ids[0]}" in next_text and f"#{order_ids[2]}" not in next_text
+
+
+def test_history_cache_is_lru_per_user():
+    cache = bot.OrderHistoryCache(max_users=2)
+    cache.put(10, None, "page-10")
+    cache.put(20, None, "page-20")
+    assert cache.get(10, None) == "page-10"
+    cache.put(30, None, "page-30")
+    assert cache.get(20, None) is None
+    cache.invalidate(10)
+    assert cache.get(10, None) is None
+    assert cache.get(30, None) == "page-30"
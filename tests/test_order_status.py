@@ -0,0 +1,86 @@
+import pytest
+
+import bot
+from storage import ORDER_STATUSES
+
+
+def queue_pages(repos, status, page_size):
+    pages, before = [], None
+    while True:
+        rows = repos.orders.list_by_status(status, page_size, before)
+        if not rows:
+            return pages
+        pages.append([row[0] for row in rows])
+        before = (rows[-1][8], rows[-1][0])
+
+
+def test_queue_pages_newest_first_without_gaps(repos, create_orders):
+    order_ids = create_orders([10] * 5)
+    # Hammasi bitta soniyada: tartib id bo'yicha ajratiladi
+    assert queue_pages(repos, "new", 2) == [order_ids[:2:-1], order_ids[2:0:-1], order_ids[:1]]
+
+
+def test_set_status_moves_order_between_queues(repos, create_orders):
+    order_ids = create_orders([10] * 3)
+    assert repos.orders.set_status(order_ids[1], "confirmed") == "new"
+    assert repos.orders.set_status(order_ids[1], "confirmed") == "confirmed"
+    assert repos.orders.set_status(10_000, "confirmed") is None
+    assert queue_pages(repos, "new", 10) == [[order_ids[2], order_ids[0]]]
+    assert queue_pages(repos, "confirmed", 10) == [[order_ids[1]]]
+    assert repos.orders.status_counts() == {"new": 2, "confirmed": 1}
+    assert repos.orders.get(order_ids[1])[9] == "confirmed"
+
+
+def test_unknown_status_is_rejected(repos, create_orders):
+    order_id, = create_orders([10])
+    with pytest.raises(ValueError):
+        repos.orders.set_status(order_id, "lost")
+    assert set(repos.orders.status_counts()) <= set(ORDER_STATUSES)
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_queue_cursor_survives_archived_anchor(repos, create_orders):
+    order_ids = create_orders([10] * 5)
+    first_page = repos.orders.list_by_status("new", 2)
+    anchor = first_page[-1]
+    # Langar buyurtma sahifalar orasida arxivga ko'chdi
+    bot.db_query("UPDATE orders SET timestamp = '2000-01-01 00:00:00' WHERE id = ?", (anchor[0],))
+    assert bot.archive_orders_batch("2001-01-01 00:00:00") == 1
+    next_page = repos.orders.list_by_status("new", 2, (anchor[8], anchor[0]))
+    assert [row[0] for row in next_page] == [order_ids[2], order_ids[1]]
+    assert repos.orders.status_counts() == {"new": 4}
+
+
+def rollup_snapshot():
+    return {
+        "rollup": bot.db_fetch_all("SELECT period, bucket, revenue, order_count FROM sales_rollup "
+                                   "WHERE order_count > 0 ORDER BY 1, 2"),
+        "products": bot.db_fetch_all("SELECT product_id, revenue, order_count FROM sales_product_totals "
+                                     "WHERE order_count > 0 ORDER BY 1"),
+        "categories": bot.db_fetch_all("SELECT category_id, revenue, order_count FROM sales_category_totals "
+                                       "WHERE order_count > 0 ORDER BY 1"),
+        "customers": bot.db_fetch_all("SELECT user_id, order_count, revenue FROM sales_customer_totals "
+                                      "WHERE order_count > 0 ORDER BY 1"),
+        "counters": dict(bot.db_fetch_all("SELECT name, value FROM sales_counters")),
+    }
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_cancelled_orders_leave_sales_rollups(repos, create_orders):
+    first, second = create_orders([10] * 2)
+    create_orders([20])
+    assert rollup_snapshot()["counters"] == {"customers": 2, "repeat_customers": 1}
+    repos.orders.set_status(second, "cancelled")
+    repos.orders.set_status(second, "cancelled")  # takroriy bekor qilish ikki marta ayirmaydi
+    snapshot = rollup_snapshot()
+    assert snapshot["counters"] == {"customers": 2, "repeat_customers": 0}
+    assert snapshot["customers"] == [(10, 1, 100_00), (20, 1, 100_00)]
+    assert [(revenue, count) for period, _, revenue, count in snapshot["rollup"] if period == "day"] == [(200_00, 2)]
+    repos.orders.set_status(first, "cancelled")
+    assert rollup_snapshot()["counters"] == {"customers": 1, "repeat_customers": 0}
+    repos.orders.set_status(second, "confirmed")
+    assert rollup_snapshot()["customers"] == [(10, 1, 100_00), (20, 1, 100_00)]
+    # Tarixdan qayta to'ldirish ham bekor qilinganlarni hisobga olmaydi va bir xil natija beradi
+    incremental = rollup_snapshot()
+    bot.backfill_sales_rollups()
+    assert rollup_snapshot() == incremental
@@ -0,0 +1,57 @@
+import pytest
+
+import bot
+import storage
+
+
+def backdate_history(repos, product_id, stamps):
+    # changed_at CURRENT_TIMESTAMP bilan yoziladi: test uchun o'zgarishlarni berilgan vaqtlarga suramiz
+    if isinstance(repos.products, storage.MemoryProductRepo):
+        history = repos.products.storage.price_history[product_id]
+        history[:] = [(stamp, price) for stamp, (_, price) in zip(stamps, history)]
+        return
+    history_ids = [row[0] for row in bot.db_fetch_all(
+        "SELECT id FROM price_history WHERE product_id = ? ORDER BY id", (product_id,))]
+    assert len(history_ids) == len(stamps)
+    for history_id, stamp in zip(history_ids, stamps):
+        bot.db_query("UPDATE price_history SET changed_at = ? WHERE id = ?", (stamp, history_id))
+
+
+@pytest.fixture
+def priced_product(repos):
+    product_id = repos.products.add(None, "Uzuk", None, 100_00, None)
+    repos.products.update(product_id, price=120_00)
+    repos.products.update(product_id, price=120_00)  # narx o'zgarmadi: yangi yozuv yo'q
+    repos.products.update(product_id, name="Oltin uzuk")
+    repos.products.update(product_id, price=90_00)
+    backdate_history(repos, product_id, ["2026-01-01 00:00:00", "2026-02-01 00:00:00", "2026-03-01 00:00:00"])
+    return product_id
+
+
+def test_price_at(repos, priced_product):
+    assert repos.products.price_at(priced_product, "2025-12-31 23:59:59") is None
+    assert repos.products.price_at(priced_product, "2026-01-15 12:00:00") == 100_00
+    assert repos.products.price_at(priced_product, "2026-02-01 00:00:00") == 120_00
+    assert repos.products.price_at(priced_product, "2026-12-31 23:59:59") == 90_00
+    assert repos.products.price_at(10_000, "2026-12-31 23:59:59") is None
+
+
+def test_price_history_range_starts_with_price_in_effect(repos, priced_product):
+    assert repos.products.price_history(priced_product, "2026-01-15 00:00:00", "2026-02-15 00:00:00") == [
+        ("2026-01-01 00:00:00", 100_00), ("2026-02-01 00:00:00", 120_00)]
+    assert repos.products.price_history(priced_product, "2026-03-01 00:00:00", "2026-04-01 00:00:00") == [
+        ("2026-03-01 00:00:00", 90_00)]
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_import_records_only_changed_prices(repos):
+    def import_prices(prices):
+        rows = [(row_no, {"category": "Uzuklar", "name": name, "price": price}, None)
+                for row_no, (name, price) in enumerate(prices.items(), start=2)]
+        return bot.import_catalog_rows(rows)
+
+    import_prices({"Uzuk": "100", "Sirg'a": "50"})
+    import_prices({"Uzuk": "110", "Sirg'a": "50"})
+    import_prices({"Uzuk": "110"})
+    assert bot.db_fetch_all("SELECT p.name, h.price FROM price_history h JOIN products p ON p.id = h.product_id "
+                            "ORDER BY h.id") == [("Uzuk", 100_00), ("Sirg'a", 50_00), ("Uzuk", 110_00)]
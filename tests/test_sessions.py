@@ -0,0 +1,83 @@
+import pytest
+
+import bot
+
+
+class FakeApplication:
+    def __init__(self, sessions):
+        self.user_data = sessions
+
+    def drop_user_data(self, user_id):
+        del self.user_data[user_id]
+
+
+def manager(memory_budget=10 ** 9, discarded=None, exempt_user_ids=()):
+    on_discard = (lambda session: discarded.append(dict(session))) if discarded is not None else None
+    return bot.SessionManager(idle_ttl=60, memory_budget=memory_budget, keep_keys=("cart",),
+                              exempt_user_ids=exempt_user_ids, on_discard=on_discard)
+
+
+def test_idle_sessions_are_compacted_or_dropped():
+    discarded = []
+    sessions = manager(discarded=discarded, exempt_user_ids=(1,))
+    application = FakeApplication({
+        1: {"cart": {5: 1}, "current_product_index": 3},
+        10: {"cart": {5: 1}, "current_product_index": 3},
+        20: {"current_product_index": 0},
+        30: {"current_product_index": 0},
+    })
+    for user_id in (1, 10, 20):
+        sessions.touch(user_id, now=0)
+    sessions.touch(30, now=50)
+    assert sessions.sweep(application, now=100)[:2] == (1, 1)
+    # Savat qoladi, qolgani tozalanadi; bo'sh qolgan sessiya o'chiriladi; admin va faol foydalanuvchiga tegilmaydi
+    assert application.user_data == {1: {"cart": {5: 1}, "current_product_index": 3},
+                                     10: {"cart": {5: 1}}, 30: {"current_product_index": 0}}
+    assert discarded == [{"cart": {5: 1}, "current_product_index": 3}, {"current_product_index": 0}]
+    assert len(sessions) == 3
+
+
+def test_cart_only_session_is_not_discarded_again():
+    discarded = []
+    sessions = manager(discarded=discarded)
+    application = FakeApplication({10: {"cart": {5: 1}}})
+    sessions.touch(10, now=0)
+    assert sessions.sweep(application, now=100)[:2] == (0, 0)
+    assert discarded == []
+
+
+def test_memory_budget_evicts_least_recently_used_first():
+    discarded = []
+    big = {"products": list(range(2000))}
+    application = FakeApplication({10: dict(big), 20: dict(big), 30: dict(big), 1: dict(big)})
+    size = bot.estimate_size(application.user_data[10])
+    sessions = manager(memory_budget=int(size * 2.5), discarded=discarded, exempt_user_ids=(1,))
+    for now, user_id in enumerate((1, 10, 20, 30)):
+        sessions.touch(user_id, now=now)
+    sessions.touch(10, now=5)
+    compacted, evicted, total_bytes = sessions.sweep(application, now=6)
+    # Admin eng eski bo'lsa ham o'chirilmaydi; keyin 20 va 30 (10 yaqinda murojaat qilgan)
+    assert (compacted, evicted) == (0, 2)
+    assert sorted(application.user_data) == [1, 10]
+    assert total_bytes <= size * 2.5
+    assert len(discarded) == 2
+
+
+@pytest.mark.parametrize("repos", ["sqlite"], indirect=True)
+def test_discarded_sessions_release_reservations(repos, add_product, stock_of):
+    product_id = add_product(stock=3)
+    buy_reservation = repos.products.reserve(product_id, 10, 600)
+    checkout_reservations, _ = repos.products.reserve_many({product_id: 2}, 20, 600)
+    assert stock_of(product_id) == 0
+    sessions = bot.SessionManager(idle_ttl=60, memory_budget=10 ** 9, keep_keys=("cart",),
+                                  on_discard=bot.release_session_reservations)
+    application = FakeApplication({
+        10: {"stock_reservation_id": buy_reservation, "product_to_buy_id": product_id},
+        20: {"cart": {product_id: 2}, "checkout_cart": True, "checkout_reservation_ids": checkout_reservations},
+    })
+    sessions.touch(10, now=0)
+    sessions.touch(20, now=0)
+    sessions.sweep(application, now=100)
+    # Bronlar muddati tugashini kutmasdan zaxiraga qaytdi, savat saqlandi
+    assert stock_of(product_id) == 3
+    assert application.user_data == {20: {"cart": {product_id: 2}}}
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from storage import OutOfStockError
+
+
+def test_reserve_takes_units_until_out_of_stock(repos, add_product, stock_of):
+    product_id = add_product(stock=2)
+    first = repos.products.reserve(product_id, 10, 60)
+    second = repos.products.reserve(product_id, 11, 60)
+    assert first != second
+    assert stock_of(product_id) == 0
+    with pytest.raises(OutOfStockError):
+        repos.products.reserve(product_id, 12, 60)
+    assert stock_of(product_id) == 0
+
+
+def test_untracked_stock_is_never_reserved(repos, add_product, stock_of):
+    product_id = add_product("Zanjir")
+    assert repos.products.reserve(product_id, 10, 60) is None
+    assert stock_of(product_id) is None
+
+
+def test_release_returns_unit_once(repos, add_product, stock_of):
+    product_id = add_product(stock=1)
+    reservation_id = repos.products.reserve(product_id, 10, 60)
+    assert repos.products.release_reservation(reservation_id) is True
+    assert repos.products.release_reservation(reservation_id) is False
+    assert stock_of(product_id) == 1
+
+
+def test_expired_reservations_are_released(repos, add_product, stock_of, monkeypatch):
+    product_id = add_product(stock=2)
+    repos.products.reserve(product_id, 10, 60)
+    repos.products.reserve(product_id, 11, 600)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    assert repos.products.release_expired_reservations() == 1
+    assert stock_of(product_id) == 1
+
+
+def test_reserve_many_takes_basket_in_one_call(repos, add_product, stock_of):
+    ring = add_product("Uzuk", stock=5)
+    earring = add_product("Sirg'a", stock=2)
+    chain = add_product("Zanjir")
+    reservation_ids, shortages = repos.products.reserve_many({ring: 3, earring: 2, chain: 4}, 10, 60)
+    assert shortages == {}
+    assert len(set(reservation_ids)) == 5
+    assert (stock_of(ring), stock_of(earring), stock_of(chain)) == (2, 0, None)
+
+
+def test_reserve_many_reports_shortages_with_remaining_units(repos, add_product, stock_of):
+    ring = add_product("Uzuk", stock=2)
+    earring = add_product("Sirg'a", stock=0)
+    reservation_ids, shortages = repos.products.reserve_many({ring: 3, earring: 1, 10_000: 1}, 10, 60)
+    # Yetmagan mahsulotdan qolgan donalar olinadi; qolmagani va topilmagani 0
+    assert shortages == {ring: 2, earring: 0, 10_000: 0}
+    assert len(reservation_ids) == 2
+    assert stock_of(ring) == 0
+    for reservation_id in reservation_ids:
+        assert repos.products.release_reservation(reservation_id) is True
+    assert stock_of(ring) == 2
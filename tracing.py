@@ -0,0 +1,137 @@
+# Yengil tracing: har bir Update uchun bitta trace va uning ichida vaqti o'lchanadigan ichma-ich spanlar.
+# Joriy trace va span contextvars orqali uzatiladi: sinxron DB chaqiruvi ham, handler ichida create_task
+# bilan boshlangan korutina ham o'z spanini to'g'ri ota spanga ulaydi. Trace bo'lmasa span() hech narsa qilmaydi.
+import atexit
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span_id = contextvars.ContextVar("current_span_id", default=None)
+
+
+class Trace:
+    def __init__(self, name, /, **attrs):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.duration = None
+        self.error = None
+        self.spans = []
+        self._span_ids = itertools.count(1)
+
+    @property
+    def finished(self):
+        return self.duration is not None
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "name": self.name, "attrs": self.attrs,
+                "started_at": round(self.started_at, 3), "duration_ms": round(self.duration * 1000, 2),
+                "error": self.error, "spans": sorted(self.spans, key=lambda record: record["id"])}
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def mark_error(error):
+    # Handler ichida ushlanmagan xatolik (Application.process_error orqali keladi)
+    trace = _current_trace.get()
+    if trace is not None and not trace.finished and trace.error is None:
+        trace.error = f"{type(error).__name__}: {error}"
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name, /, **attrs):
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        # Trace yo'q yoki tugagan (masalan, update'dan keyin ham ishlayotgan fon task'i): deyarli bepul
+        return _NO_SPAN
+    return _span(trace, name, attrs)
+
+
+@contextlib.contextmanager
+def _span(trace, name, attrs):
+    record = {"id": next(trace._span_ids), "parent": _current_span_id.get(), "name": name}
+    if attrs:
+        record["attrs"] = attrs
+    token = _current_span_id.set(record["id"])
+    started = time.monotonic()
+    record["start_ms"] = round((started - trace.started) * 1000, 2)
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["duration_ms"] = round((time.monotonic() - started) * 1000, 2)
+        _current_span_id.reset(token)
+        if not trace.finished:
+            trace.spans.append(record)
+
+
+@contextlib.contextmanager
+def start_trace(name, /, **attrs):
+    trace = Trace(name, **attrs)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span_id.set(None)
+    try:
+        with span(name):
+            yield trace
+    except BaseException as e:
+        trace.error = trace.error or f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        trace.finish()
+        _current_span_id.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+class TraceJsonFormatter(logging.Formatter):
+    # JSON ga aylantirish ham listener oqimida bajariladi
+    def format(self, record):
+        return json.dumps(record.msg.to_dict(), ensure_ascii=False, default=str)
+
+
+class TraceRecorder:
+    # Tail-sampling: trace tugagach qaror qilinadi. Xatolikli yoki sekin trace'lar doim saqlanadi,
+    # qolganidan sample_rate ulushi. Yozish aylanuvchi JSONL faylga, alohida oqimda.
+    def __init__(self, path, max_bytes, backup_count, slow_ms, sample_rate):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.kept = 0
+        self.dropped = 0
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                            encoding="utf-8", delay=True)
+        file_handler.setFormatter(TraceJsonFormatter())
+        self._queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(self._queue, file_handler)
+        self._listener.start()
+        atexit.register(self._listener.stop)
+
+    def should_keep(self, trace):
+        if trace.error or any("error" in record for record in trace.spans):
+            return True
+        return trace.duration * 1000 >= self.slow_ms or random.random() < self.sample_rate
+
+    def record(self, trace):
+        if not self.should_keep(trace):
+            self.dropped += 1
+            return False
+        self.kept += 1
+        self._queue.put_nowait(logging.makeLogRecord({"msg": trace}))
+        return True